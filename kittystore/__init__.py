@@ -17,11 +17,18 @@ license.
 
 from __future__ import absolute_import, print_function, unicode_literals
 
-__all__ = ("get_store", "create_store", "MessageNotFound",
-           "SchemaUpgradeNeeded")
+__all__ = ("get_store", "create_store", "setup_event_workers",
+           "setup_mailman_resolver", "MessageNotFound", "SchemaUpgradeNeeded")
 
-from kittystore.search import SearchEngine
-from kittystore.caching import register_events
+import threading
+
+from kittystore import events
+from kittystore.search import get_backend_class
+from kittystore.caching import register_events, _is_memory_db
+from kittystore.caching.mailman_user import start_resolver, RESOLVER_DELAY
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 def _check_settings(settings):
@@ -36,11 +43,24 @@ def _check_settings(settings):
     if settings.KITTYSTORE_URL.startswith("mongo://"):
         raise NotImplementedError
 
+# The search engines are shared by the stores of the process
+_search_indexes = {}
+_search_indexes_lock = threading.Lock()
+
 def _get_search_index(settings):
     search_index_path = settings.KITTYSTORE_SEARCH_INDEX
     if search_index_path is None:
         return None
-    return SearchEngine(search_index_path)
+    backend_name = getattr(settings, "KITTYSTORE_SEARCH_BACKEND", "whoosh")
+    timeout = getattr(settings, "KITTYSTORE_SEARCH_TIMEOUT", None)
+    strip_quoted = getattr(settings, "KITTYSTORE_SEARCH_STRIP_QUOTED", False)
+    key = (backend_name, search_index_path, timeout, strip_quoted)
+    with _search_indexes_lock:
+        if key not in _search_indexes:
+            backend = get_backend_class(backend_name)
+            _search_indexes[key] = backend(search_index_path,
+                    timeout=timeout, strip_quoted=strip_quoted)
+        return _search_indexes[key]
 
 def get_store(settings, debug=None, auto_create=False):
     """Factory for a KittyStore subclass"""
@@ -60,15 +80,52 @@ def get_store(settings, debug=None, auto_create=False):
     if search_index is not None and search_index.needs_upgrade():
         if auto_create:
             search_index.upgrade(store)
-        else:
+        elif search_index.get_version() is None:
             store.close()
             raise SchemaUpgradeNeeded()
+        else:
+            # The outdated index can still be used until it is upgraded
+            logger.warning("The search index needs to be upgraded, please "
+                           "run kittystore-updatedb")
 
     register_events()
-
     return store
 
 
+def setup_event_workers(settings, debug=None):
+    """
+    Run the event subscribers in KITTYSTORE_EVENT_WORKERS worker threads,
+    after the commits. Only for a long-running process like the web
+    application, the queued events are processed before it exits.
+    """
+    event_workers = getattr(settings, "KITTYSTORE_EVENT_WORKERS", 0)
+    # An in-memory database can't be reached from the workers' connections
+    if not event_workers or _is_memory_db(settings.KITTYSTORE_URL):
+        return None
+    if debug is None:
+        debug = getattr(settings, "KITTYSTORE_DEBUG", False)
+    return events.setup_dispatcher(event_workers,
+                                   lambda: get_store(settings, debug))
+
+
+def setup_mailman_resolver(settings, debug=None):
+    """
+    Look up the new senders in Mailman in a background thread, after
+    KITTYSTORE_MAILMAN_LOOKUP_DELAY seconds, instead of while archiving. Only
+    for a long-running process like the web application, the queued
+    addresses are looked up before it exits.
+    """
+    lookup_delay = getattr(settings, "KITTYSTORE_MAILMAN_LOOKUP_DELAY",
+                           RESOLVER_DELAY)
+    # An in-memory database can't be reached from the thread's connection
+    if lookup_delay is None or _is_memory_db(settings.KITTYSTORE_URL):
+        return None
+    if debug is None:
+        debug = getattr(settings, "KITTYSTORE_DEBUG", False)
+    return start_resolver(settings, lambda: get_store(settings, debug),
+                          lookup_delay)
+
+
 def create_store(settings, debug=None):
     """Factory for a KittyStore subclass"""
     _check_settings(settings)
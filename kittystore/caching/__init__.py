@@ -12,7 +12,18 @@ The computation is done in this module instead of in the model because it is
 (mostly) ORM-agnostic.
 """
 
+import random
+import threading
+from multiprocessing.pool import ThreadPool
+
 from pkg_resources import resource_listdir
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.backends.memcached import GenericMemcachedBackend
+from dogpile.cache.backends.memory import MemoryBackend
+from dogpile.cache.proxy import ProxyBackend
+from dogpile.core import NameRegistry
+
+from kittystore.caching.local import LocalCacheProxy, get_local_cache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -49,13 +60,365 @@ def setup_cache(cache, settings):
         arguments = { 'url': django_location, }
         return backend, arguments
     backend, arguments = find_backend()
-    cache.configure(backend, arguments=arguments)
+    # A local tier in front of a shared backend, see kittystore.caching.local
+    wrap = []
+    local_ttl = getattr(settings, "KITTYSTORE_CACHE_LOCAL_TTL", 5)
+    if local_ttl and backend != "dogpile.cache.memory":
+        local = get_local_cache(backend, arguments, local_ttl,
+                    getattr(settings, "KITTYSTORE_CACHE_LOCAL_SIZE", 10000))
+        wrap.append(LocalCacheProxy(local))
+    cache.configure(backend, arguments=arguments, wrap=wrap)
+    # Regenerate the expired values in the background. An in-memory database
+    # can't be reached from the background threads' connections.
+    workers = getattr(settings, "KITTYSTORE_CACHE_WORKERS", 2)
+    if workers and not _is_memory_db(settings.KITTYSTORE_URL):
+        cache.async_creation_runner = AsyncCreationRunner(workers)
+
+
+def _is_memory_db(url):
+    return url.startswith("sqlite") and (
+        url.rstrip("/").endswith(":") or ":memory:" in url)
+
+
+#
+# Background creation of the cached values
+#
+
+_creation_pool = None
+_creation_pool_lock = threading.Lock()
+
+def _get_creation_pool(workers):
+    # one pool per process, stores are created for each request
+    global _creation_pool
+    with _creation_pool_lock:
+        if _creation_pool is None:
+            _creation_pool = ThreadPool(workers)
+    return _creation_pool
+
+
+class DatabaseCreator(object):
+    """
+    A cache value creator running a database query. The query function is
+    given the caller's session when run synchronously, and a new session when
+    run in the background because sessions are not thread-safe.
+    """
+
+    def __init__(self, query, session, new_session):
+        self.query = query
+        self.session = session
+        self.new_session = new_session
+
+    def __call__(self):
+        return self.query(self.session)
+
+    def in_new_session(self):
+        session = self.new_session()
+        try:
+            return self.query(session)
+        finally:
+            session.close()
+
+
+class AsyncCreationRunner(object):
+    """
+    Dogpile's async_creation_runner: while a stale value is served, the new
+    value is computed by a pool of threads.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def __call__(self, cache, key, creator, mutex):
+        if not isinstance(creator, DatabaseCreator):
+            # it may use the caller's session, run it now (the stale value
+            # is still returned this time)
+            try:
+                cache.set(key, creator())
+            finally:
+                mutex.release()
+            return
+        return _get_creation_pool(self.workers).apply_async(
+                _create_in_background, (cache, key, creator, mutex))
+
+
+class _KeyLock(object):
+    """A lock of this process on a cache key"""
+
+    def __init__(self, key):
+        self.lock = threading.Lock()
+
+    def acquire(self, wait=True):
+        return self.lock.acquire(wait)
+
+    def release(self):
+        self.lock.release()
+
+# kept as long as they are used, like dogpile's own locks
+_key_locks = NameRegistry(_KeyLock)
+
+def _get_mutex(cache, key):
+    """
+    Return the lock held while the value of a key is created: the backend's
+    (shared with the other processes) if it has one, or a lock of this
+    process.
+    """
+    if cache.key_mangler:
+        mutex = cache.backend.get_mutex(cache.key_mangler(key))
+    else:
+        mutex = cache.backend.get_mutex(key)
+    if mutex is None:
+        mutex = _key_locks.get(key)
+    return mutex
+
+
+def _create_in_background(cache, key, creator, mutex, *other_keys):
+    try:
+        value = creator.in_new_session()
+        for k in (key, ) + other_keys:
+            cache.set(k, value)
+    except Exception:
+        logger.exception("Could not regenerate the cached value %s", key)
+    finally:
+        mutex.release()
+
+
+#
+# Versioned namespaces: the cached values of a namespace are invalidated all at
+# once by incrementing the namespace generation, and recomputed on next read.
+#
+
+def _generation_key(namespace):
+    return str("%s:generation" % namespace)
+
+def _new_generation():
+    # Random, so that a generation evicted from the cache is not re-seeded
+    # with a value that was already used (that would revive stale values).
+    return random.randint(1, 2**31 - 1)
+
+def get_generation(cache, namespace):
+    """Return the current generation of a cache namespace"""
+    generation = cache.get(_generation_key(namespace))
+    if generation is NO_VALUE:
+        generation = _new_generation()
+        cache.set(_generation_key(namespace), generation)
+    return generation
+
+def bump_generation(cache, namespace):
+    """Invalidate all the values cached in a namespace"""
+    generation = cache.get(_generation_key(namespace))
+    if generation is NO_VALUE:
+        generation = _new_generation()
+    else:
+        generation += 1
+    cache.set(_generation_key(namespace), generation)
+    return generation
+
+def get_generations(cache, namespaces):
+    """Return the current generations of several namespaces at once"""
+    generations = cache.get_multi(
+            [ _generation_key(namespace) for namespace in namespaces ])
+    missing = {}
+    for index, generation in enumerate(generations):
+        if generation is NO_VALUE:
+            generations[index] = _new_generation()
+            missing[_generation_key(namespaces[index])] = generations[index]
+    if missing:
+        cache.set_multi(missing)
+    return generations
+
+def key_in_generation(namespace, generation, name):
+    """Return the cache key of a value in a namespace generation"""
+    return str("%s:%s:%s" % (namespace, generation, name))
+
+def versioned_key(cache, namespace, name):
+    """Return the cache key of a value in the current namespace generation"""
+    return key_in_generation(namespace, get_generation(cache, namespace), name)
+
+def get_or_create_versioned(cache, namespace, name, creator,
+                            expiration_time=None):
+    """
+    Return a value cached in a versioned namespace, creating it if necessary.
+    If the value has not been computed yet for the current generation, the
+    latest value is served while the new one is created in the background.
+    """
+    key = versioned_key(cache, namespace, name)
+    runner = cache.async_creation_runner
+    if runner is None or not isinstance(creator, DatabaseCreator):
+        return cache.get_or_create(key, creator, expiration_time)
+    latest_key = key_in_generation(namespace, "latest", name)
+    if cache.get(key, ignore_expiration=True) is not NO_VALUE:
+        return cache.get_or_create(key, creator, expiration_time)
+    latest = cache.get(latest_key, ignore_expiration=True)
+    if latest is NO_VALUE:
+        value = cache.get_or_create(key, creator, expiration_time)
+        cache.set(latest_key, value)
+        return value
+    mutex = _get_mutex(cache, key)
+    if mutex.acquire(False): # otherwise it's already being created
+        _get_creation_pool(runner.workers).apply_async(_create_in_background,
+                (cache, key, creator, mutex, latest_key))
+    return latest
+
+#
+# Counters: integers stored raw in the cache backend, outside of dogpile's
+# pickled values, so that the backend can change them atomically (memcached's
+# incr and decr). The changes of a transaction are applied after its commit.
+# The counters are recounted from the database when they are missing, when
+# memcached expires them after COUNTERS_EXPIRATION, and by reconcile_counters()
+# (kittystore-reconcile-counters).
+#
+
+COUNTERS_EXPIRATION = 3600
+
+# the memory backend is only used by a single process
+_memory_counters_lock = threading.Lock()
+
+def _get_counters_backend(cache):
+    # the local tier is skipped, the counters are changed by other processes
+    backend = cache.backend
+    while isinstance(backend, ProxyBackend):
+        backend = backend.proxied
+    if isinstance(backend, (GenericMemcachedBackend, MemoryBackend)):
+        return backend
+    return None # not supported, the counters are recounted on each read
+
+def _mangle(cache, keys):
+    if cache.key_mangler:
+        return [ cache.key_mangler(key) for key in keys ]
+    return list(keys)
+
+def _is_count(value):
+    # values of other types may have been left by a previous version
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def get_counters(cache, keys):
+    """Return the values of the cached counters, None for the missing ones"""
+    backend = _get_counters_backend(cache)
+    if backend is None:
+        return [ None ] * len(keys)
+    keys = _mangle(cache, keys)
+    if isinstance(backend, MemoryBackend):
+        values = backend.get_multi(keys)
+    else:
+        found = backend.client.get_multi(keys)
+        values = [ found.get(key) for key in keys ]
+    return [ value if _is_count(value) else None for value in values ]
+
+def add_counters(cache, counts):
+    """Cache the counts recounted from the database, unless another process
+    has already cached them"""
+    backend = _get_counters_backend(cache)
+    if backend is None:
+        return
+    for key, value in zip(_mangle(cache, counts.keys()), counts.values()):
+        if isinstance(backend, MemoryBackend):
+            with _memory_counters_lock:
+                if not _is_count(backend.get(key)):
+                    backend.set(key, value)
+        else:
+            backend.client.add(key, value, COUNTERS_EXPIRATION)
+
+def set_counters(cache, counts):
+    """Overwrite the cached counters with counts from the database"""
+    backend = _get_counters_backend(cache)
+    if backend is None:
+        return
+    for key, value in zip(_mangle(cache, counts.keys()), counts.values()):
+        if isinstance(backend, MemoryBackend):
+            with _memory_counters_lock:
+                backend.set(key, value)
+        else:
+            backend.client.set(key, value, COUNTERS_EXPIRATION)
+
+def incr_counters(cache, deltas):
+    """
+    Add the deltas to the cached counters, atomically. The counters which are
+    not cached are left alone, they will be recounted from the database.
+    """
+    backend = _get_counters_backend(cache)
+    if backend is None:
+        return
+    for key, delta in zip(_mangle(cache, deltas.keys()), deltas.values()):
+        if not delta:
+            continue
+        if isinstance(backend, MemoryBackend):
+            with _memory_counters_lock:
+                value = backend.get(key)
+                if _is_count(value):
+                    backend.set(key, max(value + delta, 0))
+            continue
+        try:
+            if delta > 0:
+                backend.client.incr(key, delta)
+            else:
+                backend.client.decr(key, -delta) # stops at 0
+        except Exception, e:
+            # missing (pylibmc), or not an integer: recount it
+            logger.debug("Could not change the counter %s: %s", key, e)
+            backend.client.delete(key)
+
+def change_counters(db, deltas):
+    """
+    Record changes to the cached counters made by the current transaction,
+    they are applied after its commit by apply_counter_changes().
+
+    :param db: the session (or Storm store), with its cache region.
+    :param deltas: a dictionary of the changes by counter key.
+    """
+    changes = getattr(db, "counter_changes", None)
+    if changes is None:
+        changes = db.counter_changes = {}
+    for key, delta in deltas.iteritems():
+        changes[key] = changes.get(key, 0) + delta
+
+def counters_changed(db, keys):
+    """Whether the current transaction has changed some of the counters"""
+    changes = getattr(db, "counter_changes", None)
+    return bool(changes) and any(changes.get(key) for key in keys)
+
+def apply_counter_changes(db):
+    """Apply the changes of the transaction which was just committed"""
+    changes = getattr(db, "counter_changes", None)
+    if changes:
+        db.counter_changes = {}
+        incr_counters(db.cache, changes)
+
+def discard_counter_changes(db):
+    """Forget the changes of the transaction which was just rolled back"""
+    db.counter_changes = {}
+
+def get_or_create_counters(db, keys, creator):
+    """
+    Return the values of counters which are computed together: if one of
+    them is missing, they are all recounted with a single call to the
+    creator, which must return the values in the keys order. The counters
+    changed by the current transaction are recounted and not cached, so that
+    the transaction reads its own changes.
+    """
+    if counters_changed(db, keys):
+        return tuple(creator())
+    values = get_counters(db.cache, keys)
+    if None in values:
+        values = list(creator())
+        add_counters(db.cache, dict(zip(keys, values)))
+    return tuple(values)
+
+def reconcile_counters(store):
+    """Recount the cached vote counters from the database"""
+    set_counters(store.db.cache, store.get_vote_counters())
+
+
 
+_events_registered = False
 
 def register_events():
-    """Register event subscriptions"""
+    """Register event subscriptions, once per process"""
+    global _events_registered
+    if _events_registered:
+        return
     submodules = [ f[:-3] for f in resource_listdir("kittystore.caching", "")
                    if f.endswith(".py") and f != "__init__.py" ]
     for submod_name in submodules:
         # import the modules, decorators are used to register the right event
         __import__("kittystore.caching.%s" % submod_name)
+    _events_registered = True
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+A process-local cache tier in front of the shared cache backend (memcached).
+
+The values are kept in a size-bounded LRU for a few seconds, so that repeated
+reads in a request (or in close requests) don't need a network round trip.
+The values set or deleted by this process are updated in the local tier
+immediately. Changes made by other processes are seen after the local TTL at
+the latest: since most values are invalidated by a change of their namespace
+generation (see kittystore.caching.bump_generation), this is the delay before
+a new generation is noticed.
+"""
+
+from __future__ import absolute_import
+
+import time
+import threading
+from collections import OrderedDict
+
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+
+
+class LRUCache(object):
+    """A thread-safe LRU mapping with a time-to-live on the entries"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return NO_VALUE
+            if expires < time.time():
+                return NO_VALUE
+            self._data[key] = (expires, value) # most recently used
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# The local caches are shared by the cache regions of the process (a store is
+# created for each request), one per shared backend.
+_local_caches = {}
+_local_caches_lock = threading.Lock()
+
+def get_local_cache(backend, arguments, ttl, max_size):
+    location = (backend, tuple(sorted(arguments.get("url", []))))
+    with _local_caches_lock:
+        if location not in _local_caches:
+            _local_caches[location] = LRUCache(ttl, max_size)
+        return _local_caches[location]
+
+
+class LocalCacheProxy(ProxyBackend):
+    """Dogpile proxy backend serving the values from a local LRUCache first"""
+
+    def __init__(self, local):
+        super(LocalCacheProxy, self).__init__()
+        self.local = local
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is NO_VALUE:
+            value = self.proxied.get(key)
+            if value is not NO_VALUE:
+                self.local.set(key, value)
+        return value
+
+    def get_multi(self, keys):
+        values = [ self.local.get(key) for key in keys ]
+        missing = [ key for key, value in zip(keys, values)
+                    if value is NO_VALUE ]
+        if missing:
+            fetched = dict(zip(missing, self.proxied.get_multi(missing)))
+            for index, key in enumerate(keys):
+                if values[index] is not NO_VALUE:
+                    continue
+                values[index] = fetched[key]
+                if fetched[key] is not NO_VALUE:
+                    self.local.set(key, fetched[key])
+        return values
+
+    def set(self, key, value):
+        self.proxied.set(key, value)
+        self.local.set(key, value)
+
+    def set_multi(self, mapping):
+        self.proxied.set_multi(mapping)
+        for key, value in mapping.iteritems():
+            self.local.set(key, value)
+
+    def delete(self, key):
+        self.proxied.delete(key)
+        self.local.delete(key)
+
+    def delete_multi(self, keys):
+        self.proxied.delete_multi(keys)
+        for key in keys:
+            self.local.delete(key)
@@ -3,77 +3,450 @@
 Cached values concerning emails
 """
 
+import atexit
+import json
+import socket
+import threading
+from base64 import b64encode
+from collections import OrderedDict
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from multiprocessing.pool import ThreadPool
+from urllib import quote
 from urllib2 import HTTPError
+from urlparse import urlparse
 from uuid import UUID
 import mailmanclient
 
 from kittystore import events
-from kittystore.utils import get_mailman_client
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Addresses unknown to Mailman (former members, or people who never
+# subscribed) are not looked up again before this delay.
+UNKNOWN_ADDRESS_EXPIRATION = 86400
+# Delay before the queued addresses are looked up, for the archiving
+# transactions to be committed and for more addresses to be queued.
+RESOLVER_DELAY = 5
+RESOLVER_RETRY_DELAY = 60
 
-_MAILMAN_CLIENT = None
 
+def _unknown_address_key(email):
+    return str("mailman_user:unknown:%s" % email.encode("utf-8"))
 
-def get_user_id(store, sender):
-    global _MAILMAN_CLIENT
-    if _MAILMAN_CLIENT is None:
-        _MAILMAN_CLIENT = get_mailman_client(store.settings)
+def _unknown_address_expiration(settings):
+    return getattr(settings, "KITTYSTORE_MAILMAN_UNKNOWN_EXPIRATION",
+                   UNKNOWN_ADDRESS_EXPIRATION)
+
+def filter_unknown_addresses(store, emails):
+    """Remove the addresses recently found to be unknown to Mailman"""
+    emails = list(emails)
+    if not emails:
+        return emails
+    unknown = store.db.cache.get_multi(
+            [ _unknown_address_key(email) for email in emails ],
+            expiration_time=_unknown_address_expiration(store.settings))
+    return [ email for email, flag in zip(emails, unknown) if flag is not True ]
+
+def set_unknown_addresses(store, emails):
+    if emails:
+        store.db.cache.set_multi(dict(
+            (_unknown_address_key(email), True) for email in emails))
+
+
+class PendingLookups(object):
+    """
+    The addresses waiting to be looked up in Mailman, in arrival order. An
+    address queued several times before it is processed is looked up once.
+    """
+
+    def __init__(self):
+        self._emails = OrderedDict()
+        self._condition = threading.Condition()
+        self._woken = False
+
+    def add(self, emails):
+        with self._condition:
+            for email in emails:
+                self._emails[email] = True
+            self._condition.notify()
+
+    def take(self, limit=None):
+        with self._condition:
+            if limit is None:
+                limit = len(self._emails)
+            taken = []
+            while self._emails and len(taken) < limit:
+                taken.append(self._emails.popitem(last=False)[0])
+            return taken
+
+    def wait(self, timeout=None):
+        """Wait until there are addresses in the queue"""
+        with self._condition:
+            if not self._emails and not self._woken:
+                self._condition.wait(timeout)
+            return bool(self._emails)
+
+    def clear(self):
+        with self._condition:
+            self._emails.clear()
+
+    def wake(self):
+        """Stop waiting in wait(), now and for the next calls"""
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        return len(self._emails)
+
+    def __contains__(self, email):
+        return email in self._emails
+
+
+# One queue per database, the senders of a database must not be looked up
+# with a store of another one.
+_pending = {}
+_pending_lock = threading.Lock()
+
+def defer_lookups(settings):
+    """
+    Queue the addresses of the new senders of a database instead of looking
+    them up while archiving, and return the queue. It is processed by
+    process_pending(), see start_resolver().
+    """
+    with _pending_lock:
+        if settings.KITTYSTORE_URL not in _pending:
+            _pending[settings.KITTYSTORE_URL] = PendingLookups()
+        return _pending[settings.KITTYSTORE_URL]
+
+def get_pending(settings):
+    """Return the addresses waiting to be looked up for a database, or None
+    if the lookups are not deferred"""
+    with _pending_lock:
+        return _pending.get(settings.KITTYSTORE_URL)
+
+
+def _queue_senders(store, senders):
+    emails = set(sender.email for sender in senders
+                 if sender.user_id is None)
+    emails = filter_unknown_addresses(store, emails)
+    if not emails:
+        return
+    pending = get_pending(store.settings)
+    if pending is not None:
+        pending.add(emails)
+        return
+    # no resolver thread in this process (a command line tool for example)
+    resolver = MailmanUserResolver(store.settings)
     try:
-        mm_user = _MAILMAN_CLIENT.get_user(sender.email)
-    except HTTPError, e:
-        if e.code == 404:
-            return None
+        _resolve(store, emails, resolver)
+    except (HTTPError, mailmanclient.MailmanConnectionError):
+        return # Can't refresh at this time, see sync_mailman_user()
+    finally:
+        resolver.close()
+
+
+# When the resolver thread is running (see start_resolver()), the lookups are
+# not done while archiving: the addresses are queued and looked up in the
+# background. Otherwise they are looked up right away. The addresses which
+# could not be looked up are found by the next sync_mailman_user run.
+
+@events.subscribe_to(events.NewMessage)
+def on_new_message(event):
+    _queue_senders(event.store, [event.message.sender])
+
+
+@events.subscribe_to(events.NewMessageBatch, replaces=on_new_message)
+def on_new_message_batch(event):
+    _queue_senders(event.store,
+                   [ message.sender for message in event.messages ])
+
+
+def _link_senders(store, senders, user_ids):
+    """Set the user_id of the senders found in Mailman, and update their
+    messages in the search index"""
+    linked = {}
+    for sender in senders:
+        user_id = user_ids.get(sender.email)
+        if user_id is None or sender.user_id is not None:
+            continue
+        if store.get_user(user_id) is None:
+            store.create_user(sender.email, user_id)
+        sender.user_id = user_id
+        linked[sender.email] = user_id
+    if linked and store.search_index is not None:
+        messages = []
+        for user_id in set(linked.values()):
+            messages.extend(message for message
+                            in store.get_messages_by_user_id(user_id)
+                            if message.sender_email in linked)
+        store.search_index.update(messages)
+    return len(linked)
+
+
+class MailmanUserResolver(object):
+    """
+    Looks up the Mailman user IDs of many email addresses concurrently. Each
+    thread of the pool keeps its own persistent (keep-alive) connection to the
+    REST API, instead of opening a connection per request like mailmanclient.
+    """
+
+    def __init__(self, settings, workers=None, timeout=10):
+        url = urlparse("%s/3.0/" % settings.MAILMAN_REST_SERVER.rstrip("/"))
+        if url.scheme == "https":
+            self._connection_class = HTTPSConnection
         else:
-            raise
-    except ValueError:
-        return None
-    else:
-        user_id = mm_user.user_id
+            self._connection_class = HTTPConnection
+        self.netloc = url.netloc
+        self.base_path = url.path
+        auth = "%s:%s" % (settings.MAILMAN_API_USER, settings.MAILMAN_API_PASS)
+        self.headers = {
+            "Authorization": "Basic %s" % b64encode(auth),
+            "Accept": "application/json",
+        }
+        if workers is None:
+            workers = getattr(settings, "KITTYSTORE_MAILMAN_WORKERS", 8)
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = None
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connection_class(
+                    self.netloc, timeout=self.timeout)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self):
+        connection = self._local.connection
+        connection.close()
+        self._local.connection = None
+        with self._connections_lock:
+            self._connections.remove(connection)
+
+    def _get(self, path):
+        path = self.base_path + path
+        # The server may have closed an idle connection: retry once on a new
+        # one (the requests are all idempotent).
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request("GET", path, headers=self.headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (HTTPException, socket.error), e:
+                self._drop_connection()
+                if attempt:
+                    raise mailmanclient.MailmanConnectionError(
+                        "Could not connect to Mailman API: %s" % e)
+
+    def lookup(self, email):
+        """Returns the Mailman user ID of the address, or None if unknown"""
+        status, content = self._get(
+                "users/%s" % quote(email.encode("utf-8"), safe="@"))
+        if status == 404:
+            return None
+        if status // 100 != 2:
+            raise HTTPError(self.base_path, status, content, {}, None)
+        try:
+            user_id = json.loads(content)["user_id"]
+        except (ValueError, KeyError):
+            raise mailmanclient.MailmanConnectionError(
+                    "Invalid reply from the Mailman API: %r" % content)
         if user_id is None:
             return None
-        else:
-            return UUID(int=user_id)
+        return UUID(int=user_id)
 
+    def _lookup_pair(self, email):
+        return email, self.lookup(email)
 
-@events.subscribe_to(events.NewMessage)
-def on_new_message(event):
-    if event.message.sender.user_id is not None:
-        return
-    try:
-        user_id = get_user_id(event.store, event.message.sender)
-    except (HTTPError, mailmanclient.MailmanConnectionError):
-        return # Can't refresh at this time
-    if user_id is None:
-        return
-    user = event.store.get_user(user_id)
-    if user is None:
-        event.store.create_user(event.message.sender_email, user_id)
-    event.message.sender.user_id = user_id
+    def resolve(self, emails):
+        """Returns a dict of the Mailman user IDs (or None) by address"""
+        if self._pool is None:
+            if len(emails) == 1:
+                return dict([self._lookup_pair(emails[0])])
+            self._pool = ThreadPool(self.workers)
+        return dict(self._pool.imap_unordered(self._lookup_pair, emails))
 
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
 
-def sync_mailman_user(store):
+
+def sync_mailman_user(store, resolver=None, chunk_size=1000):
     """Sync the user ID from Mailman"""
     # There can be thousands of senders, break into smaller chuncks to avoid
-    # hogging up the memory
-    buffer_size = 1000
-    prev_count = store.get_senders_without_user().count()
+    # hogging up the memory. The chunks are read in address order from the
+    # last address of the previous chunk, so the senders which are still
+    # without a user (former members) are not read again, and no count query
+    # is needed to know when to stop.
+    own_resolver = resolver is None
+    if own_resolver:
+        resolver = MailmanUserResolver(store.settings)
+    processed = found = 0
+    last_email = None
     try:
         while True:
-            for sender in store.get_senders_without_user(limit=buffer_size):
-                user_id = get_user_id(store, sender)
-                if user_id is None:
-                    continue
-                user = store.get_user(user_id)
-                if user is None:
-                    store.create_user(sender.email, user_id)
+            senders = list(store.get_senders_without_user(
+                            limit=chunk_size, after=last_email))
+            if not senders:
+                break
+            last_email = senders[-1].email
+            emails = filter_unknown_addresses(
+                    store, [ sender.email for sender in senders ])
+            user_ids = resolver.resolve(emails)
+            found += _link_senders(store, senders, user_ids)
+            set_unknown_addresses(store, [ email for email in emails
+                                           if user_ids[email] is None ])
             store.commit()
-            count = store.get_senders_without_user().count()
-            if count == 0 or count == prev_count:
-                break # done, or no improvement (former members)
-            prev_count = count
-            logger.info("%d emails left to refresh" % count)
+            processed += len(senders)
+            logger.info("%d senders processed, %d users found"
+                        % (processed, found))
     except (HTTPError, mailmanclient.MailmanConnectionError):
         return # Can't refresh at this time
+    finally:
+        if own_resolver:
+            resolver.close()
+
+
+def _resolve(store, emails, resolver):
+    """Look up the addresses and link their senders to the Mailman users,
+    returns the number of linked senders"""
+    user_ids = resolver.resolve(emails)
+    # A sender may be missing if its message was not committed: it will be
+    # found by the next sync_mailman_user run.
+    senders = [ store.get_sender(email) for email in emails ]
+    found = _link_senders(store, [ s for s in senders if s is not None ],
+                          user_ids)
+    set_unknown_addresses(store, [ email for email in emails
+                                   if user_ids[email] is None ])
+    return found
+
+
+def process_pending(store, resolver=None, limit=1000):
+    """
+    Look up the queued addresses in Mailman and set the user_id of the
+    senders which are found. If Mailman can't be reached, the addresses are
+    queued again and the error is raised. Returns the number of senders
+    linked to a Mailman user.
+    """
+    pending = get_pending(store.settings)
+    if pending is None:
+        return 0
+    emails = filter_unknown_addresses(store, pending.take(limit))
+    if not emails:
+        return 0
+    own_resolver = resolver is None
+    if own_resolver:
+        resolver = MailmanUserResolver(store.settings)
+    try:
+        found = _resolve(store, emails, resolver)
+    except (HTTPError, mailmanclient.MailmanConnectionError):
+        pending.add(emails)
+        raise
+    finally:
+        if own_resolver:
+            resolver.close()
+    store.commit()
+    return found
+
+
+class ResolverThread(threading.Thread):
+    """Process the queued addresses of a database in the background"""
+
+    def __init__(self, pending, store_factory, delay=RESOLVER_DELAY):
+        super(ResolverThread, self).__init__(name="kittystore-mailman-users")
+        self.daemon = True
+        self.pending = pending
+        self.store_factory = store_factory
+        self.delay = delay
+        self.resolver = None
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self.pending.wait()
+            # interrupted by close()
+            self._stopping.wait(self.delay)
+            try:
+                self.process()
+            except (HTTPError, mailmanclient.MailmanConnectionError), e:
+                logger.warning("Could not look up the users in Mailman, "
+                               "retrying in %d seconds: %s",
+                               RESOLVER_RETRY_DELAY, e)
+                self._stopping.wait(RESOLVER_RETRY_DELAY)
+            except Exception:
+                logger.exception("Could not look up the users in Mailman")
+                self._stopping.wait(RESOLVER_RETRY_DELAY)
+        if self.resolver is not None:
+            self.resolver.close()
+
+    def process(self):
+        store = self.store_factory()
+        try:
+            if self.resolver is None:
+                # kept for the connections to be re-used
+                self.resolver = MailmanUserResolver(store.settings)
+            while len(self.pending):
+                process_pending(store, self.resolver)
+        except Exception:
+            store.rollback()
+            raise
+        finally:
+            store.close()
+
+    def close(self):
+        """Process the queued addresses now and stop the thread"""
+        self._stopping.set()
+        self.pending.wake()
+        self.join()
+        if len(self.pending):
+            logger.warning("%d addresses could not be looked up in Mailman, "
+                           "they will be by sync_mailman_user",
+                           len(self.pending))
+
+
+_resolver_threads = {}
+_resolver_threads_lock = threading.Lock()
+
+def start_resolver(settings, store_factory, delay=RESOLVER_DELAY):
+    """
+    Start the thread looking up the queued addresses of the database, once
+    per process. This is for long-running processes like the web
+    application, the queued addresses are processed before it exits.
+    """
+    with _resolver_threads_lock:
+        url = settings.KITTYSTORE_URL
+        if url not in _resolver_threads:
+            _resolver_threads[url] = ResolverThread(
+                    defer_lookups(settings), store_factory, delay)
+            _resolver_threads[url].start()
+            if len(_resolver_threads) == 1:
+                atexit.register(stop_resolvers)
+        return _resolver_threads[url]
+
+def stop_resolvers():
+    """
+    Process the queued addresses and stop the resolver threads, the next
+    lookups are done while archiving.
+    """
+    with _resolver_threads_lock:
+        threads = _resolver_threads.items()
+        _resolver_threads.clear()
+    for url, thread in threads:
+        thread.close()
+        with _pending_lock:
+            _pending.pop(url, None)
@@ -3,15 +3,26 @@
 Cached values concerning mailing-lists
 """
 
+import datetime
+from hashlib import sha1 # pylint: disable-msg=E0611
+from multiprocessing.pool import ThreadPool
 from urllib2 import HTTPError
 
 import mailmanclient
 from dateutil.parser import parse as date_parse
+from dateutil.tz import tzutc
+from dogpile.cache.api import NO_VALUE
 from mailman.interfaces.archiver import ArchivePolicy
 
-from kittystore import events
 from kittystore.utils import get_mailman_client
 
+import logging
+logger = logging.getLogger(__name__)
+
+
+PROPS_FINGERPRINT_EXPIRATION = 3600
+SYNC_WORKERS = 4
+
 
 class CompatibleMList(object):
     """
@@ -33,29 +44,90 @@ class CompatibleMList(object):
             setattr(self, prop, value)
 
 
+def _normalize(value):
+    # the database does not store the timezone
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = value.astimezone(tzutc()).replace(tzinfo=None)
+    return value
+
+def props_fingerprint(mlist, props):
+    """A digest of the values of the list properties"""
+    values = tuple(_normalize(getattr(mlist, prop)) for prop in props)
+    return sha1(repr(values)).hexdigest()
+
+def _fingerprint_key(list_name):
+    return str("list:%s:props_fingerprint" % list_name)
+
+
+def _update_list(l, mlist):
+    """Only set the properties which changed, returns True if any did"""
+    if props_fingerprint(l, l.mailman_props) == \
+            props_fingerprint(mlist, l.mailman_props):
+        return False
+    for propname in l.mailman_props:
+        value = getattr(mlist, propname)
+        if _normalize(getattr(l, propname)) != _normalize(value):
+            setattr(l, propname, value)
+    return True
+
+
 def update_props(store, mlist):
     l = store.get_list(mlist.fqdn_listname)
     if isinstance(mlist, mailmanclient._client._List):
         mlist = CompatibleMList(mlist, l.mailman_props)
-    for propname in l.mailman_props:
-        setattr(l, propname, getattr(mlist, propname))
+    changed = _update_list(l, mlist)
+    if not changed:
+        # Only remember a fingerprint which is in the database (not one that
+        # could be rolled back)
+        store.db.cache.set(_fingerprint_key(l.name),
+                (l.mailman_props, props_fingerprint(l, l.mailman_props)))
+    return changed
+
+
+def refresh_list_props(store, mlist):
+    """
+    Update the list properties from the mailing-list of a new message. It is
+    called by add_to_list() before the message is indexed, because the
+    indexing needs the current archive_policy.
+    """
+    # Most messages don't change the list properties: compare with the
+    # fingerprint of the last known values, without writing the list row.
+    cached = store.db.cache.get(_fingerprint_key(mlist.fqdn_listname),
+                                expiration_time=PROPS_FINGERPRINT_EXPIRATION)
+    if cached is not NO_VALUE:
+        props, fingerprint = cached
+        if props_fingerprint(mlist, props) == fingerprint:
+            return
+    update_props(store, mlist)
 
 
-@events.subscribe_to(events.NewMessage)
-def on_new_message(event):
-    update_props(event.store, event.mlist)
+def _fetch_list(mm_client, list_name, props):
+    try:
+        mm_mlist = mm_client.get_list(list_name)
+        if not mm_mlist:
+            return list_name, None
+        return list_name, CompatibleMList(mm_mlist, props)
+    except (HTTPError, mailmanclient.MailmanConnectionError):
+        return list_name, None
 
 
-def sync_list_properties(store):
+def sync_list_properties(store, workers=SYNC_WORKERS):
     """Sync the list properties from Mailman"""
     try:
         mm_client = get_mailman_client(store.settings)
     except HTTPError:
         return # Can't refresh at this time
-    for list_name in store.get_list_names():
-        try:
-            mm_mlist = mm_client.get_list(list_name)
-        except (HTTPError, mailmanclient.MailmanConnectionError):
-            continue
-        if mm_mlist:
-            update_props(store, mm_mlist)
+    lists = dict((l.name, l) for l in store.get_lists())
+    pool = ThreadPool(workers)
+    updated = 0
+    try:
+        for list_name, mlist in pool.imap_unordered(
+                lambda name: _fetch_list(mm_client, name,
+                                         lists[name].mailman_props),
+                lists):
+            if mlist is not None and _update_list(lists[list_name], mlist):
+                updated += 1
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("%d lists out of %d were updated" % (updated, len(lists)))
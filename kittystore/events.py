@@ -26,28 +26,305 @@ Author: Aurelien Bompard <abompard@fedoraproject.org>
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import atexit
+import threading
+from Queue import Queue
 from collections import defaultdict, namedtuple
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 subscribers = defaultdict(list)
+# single event subscribers replaced by a batch event subscriber
+replaced = []
+# set by setup_dispatcher() to run the subscribers in worker threads
+dispatcher = None
 
 
-def subscribe(target, eventclass):
+def subscribe(target, eventclass, replaces=None):
+    """
+    Subscribe a target to an event class. A subscriber to a batch event class
+    can replace the subscriber to the single event class (see
+    NewMessageBatch), which then won't be called for each event of the batch.
+    """
     subscribers[eventclass].append(target)
+    if replaces is not None:
+        replaced.append(replaces)
 
 def notify(event):
+    """
+    Run the subscribers of an event. If the event can be detached from its
+    store, it can instead be written to the store's outbox, to be processed
+    by another process (see process_outbox()), or if asynchronous dispatch is
+    enabled the subscribers will be run in a worker thread after the store's
+    transaction is committed.
+    """
+    if hasattr(event, "detach") and event.store.outbox:
+        event.store.add_to_outbox(event)
+        return
+    if dispatcher is not None and hasattr(event, "detach"):
+        event.store.pending_events.append(
+                (event.__class__, event.detach()))
+        return
+    for sub, sub_event in _targets(event):
+        sub(sub_event)
+
+def _targets(event):
+    """Yield the subscribers to run, and the event to run them with"""
     for sub in subscribers[event.__class__]:
-        sub(event)
+        yield sub, event
+    if not hasattr(event, "split"):
+        return
+    # the single event subscribers which are not batch-aware
+    singles = [ sub for sub in subscribers[event.single]
+                if sub not in replaced ]
+    if singles:
+        for single_event in event.split():
+            for sub in singles:
+                yield sub, single_event
 
-def subscribe_to(eventclass):
+def subscribe_to(eventclass, replaces=None):
     def wrapper(f):
-        subscribe(f, eventclass)
+        subscribe(f, eventclass, replaces)
         return f
     return wrapper
 
 def reset():
     for eventclass in subscribers.keys():
         del subscribers[eventclass]
+    del replaced[:]
+
+
+class NewMessage(namedtuple("NewMessage", ["store", "mlist", "message"])):
+
+    def detach(self):
+        return (self.message.list_name, self.mlist, self.message.message_id)
+
+    @classmethod
+    def attach(cls, store, list_name, mlist, message_id):
+        return cls(store, mlist,
+                   store.get_message_by_id_from_list(list_name, message_id))
+
+
+class NewThread(namedtuple("NewThread", ["store", "mlist", "thread"])):
+
+    def detach(self):
+        return (self.thread.list_name, self.mlist, self.thread.thread_id)
+
+    @classmethod
+    def attach(cls, store, list_name, mlist, thread_id):
+        return cls(store, mlist, store.get_thread(list_name, thread_id))
+
+
+#
+# Batch events: bulk operations emit one event per list for all the messages
+# or threads they have added (see Store.batch_events()), so that subscribers
+# can process them at once. The single event subscribers which have not been
+# replaced by a batch event subscriber are still called for each one.
+#
+
+class NewMessageBatch(namedtuple("NewMessageBatch",
+                                 ["store", "mlist", "messages"])):
+
+    single = NewMessage
+
+    def split(self):
+        return [ NewMessage(self.store, self.mlist, message)
+                 for message in self.messages ]
+
+    def detach(self):
+        return (self.messages[0].list_name, self.mlist,
+                [ message.message_id for message in self.messages ])
+
+    @classmethod
+    def attach(cls, store, list_name, mlist, message_ids):
+        return cls(store, mlist, [
+            store.get_message_by_id_from_list(list_name, message_id)
+            for message_id in message_ids ])
+
+
+class NewThreadBatch(namedtuple("NewThreadBatch",
+                                ["store", "mlist", "threads"])):
+
+    single = NewThread
+
+    def split(self):
+        return [ NewThread(self.store, self.mlist, thread)
+                 for thread in self.threads ]
+
+    def detach(self):
+        return (self.threads[0].list_name, self.mlist,
+                [ thread.thread_id for thread in self.threads ])
+
+    @classmethod
+    def attach(cls, store, list_name, mlist, thread_ids):
+        return cls(store, mlist, [ store.get_thread(list_name, thread_id)
+                                   for thread_id in thread_ids ])
+
+
+_batch_classes = {NewMessage: NewMessageBatch, NewThread: NewThreadBatch}
+
+def coalesce(event_list):
+    """
+    Group the events by class and list into batch events, in order of first
+    appearance. The events without a batch class are kept as they are.
+    """
+    result = []
+    batches = {}
+    for event in event_list:
+        batch_class = _batch_classes.get(event.__class__)
+        if batch_class is None:
+            result.append(event)
+            continue
+        key = (batch_class, event.mlist.fqdn_listname)
+        if key not in batches:
+            batches[key] = batch_class(event.store, event.mlist, [])
+            result.append(batches[key])
+        batches[key][2].append(event[2])
+    return result
+
+
+#
+# Event outbox: the events are written to a database table in the same
+# transaction as the change which emitted them, and processed by consumers
+# which may run in other processes. The events are processed at least once:
+# an event is removed from the outbox in the same transaction as the changes
+# of its subscribers, if they fail it will be claimed again when its lease
+# expires.
+#
+
+OUTBOX_MAX_ATTEMPTS = 5
+
+def process_outbox(store, limit=100, lease=300):
+    """
+    Claim a batch of events from the store's outbox and run their
+    subscribers.
+
+    :param store: The store to read the outbox from and to give the
+        subscribers.
+    :param limit: The maximum number of events to process.
+    :param lease: The time (in seconds) after which an event which has not
+        been processed can be claimed again.
+    :returns: The number of claimed events.
+    """
+    claimed = store.claim_outbox_events(limit, lease)
+    for event_id, eventclass, detached in claimed:
+        try:
+            event = eventclass.attach(store, *detached)
+            for sub, sub_event in _targets(event):
+                sub(sub_event)
+            store.ack_outbox_event(event_id)
+            store.commit()
+        except Exception:
+            logger.exception("Could not process the %s event %r from the "
+                             "outbox", eventclass.__name__, detached)
+            store.rollback()
+    return len(claimed)
+
+
+#
+# Asynchronous dispatch
+#
+
+def setup_dispatcher(workers, store_factory):
+    """
+    Run the subscribers of the events in worker threads. This is for
+    long-running processes like the web application, which must call it
+    explicitly. Once per process, the later calls are ignored. The queued
+    events are processed before the process exits, see shutdown_dispatcher().
+
+    :param workers: The number of worker threads.
+    :param store_factory: A function returning a new store, each worker
+        thread runs the subscribers with its own store.
+    """
+    global dispatcher
+    if dispatcher is None:
+        dispatcher = AsyncDispatcher(workers, store_factory)
+        atexit.register(shutdown_dispatcher)
+    return dispatcher
+
+def shutdown_dispatcher():
+    """Process the queued events and stop the worker threads, the events are
+    then run synchronously again"""
+    global dispatcher
+    if dispatcher is None:
+        return
+    dispatcher.close()
+    dispatcher = None
+
+
+class AsyncDispatcher(object):
+    """
+    Runs the subscribers of the committed events in a pool of threads. The
+    events of a list always go to the same worker queue, so they are
+    processed in order. A failing subscriber is logged and its changes are
+    rolled back, the other subscribers are still run.
+    """
+
+    def __init__(self, workers, store_factory):
+        self.store_factory = store_factory
+        # the schema check when creating a store is not thread-safe
+        self._factory_lock = threading.Lock()
+        self.queues = [ Queue() for _num in range(workers) ]
+        self.threads = []
+        for queue in self.queues:
+            thread = threading.Thread(target=self._work, args=(queue, ))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def dispatch(self, eventclass, detached):
+        list_name = detached[0]
+        queue = self.queues[hash(list_name) % len(self.queues)]
+        queue.put((eventclass, detached))
+
+    def queue_sizes(self):
+        """The number of events waiting in each worker queue"""
+        return [ queue.qsize() for queue in self.queues ]
+
+    def drain(self):
+        """Wait until all the queued events have been processed"""
+        for queue in self.queues:
+            queue.join()
+
+    def close(self):
+        """Process the queued events and stop the worker threads"""
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, queue):
+        store = None
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                if store is not None:
+                    store.close()
+                return
+            eventclass, detached = item
+            try:
+                if store is None:
+                    with self._factory_lock:
+                        store = self.store_factory()
+                self._run(store, eventclass, detached)
+            except Exception:
+                logger.exception("Could not process the %s event %r",
+                                 eventclass.__name__, detached)
+                if store is not None:
+                    store.rollback()
+            finally:
+                queue.task_done()
 
-NewMessage = namedtuple("NewMessage", ["store", "mlist", "message"])
-NewThread = namedtuple("NewThread", ["store", "mlist", "thread"])
+    def _run(self, store, eventclass, detached):
+        event = eventclass.attach(store, *detached)
+        for sub, sub_event in _targets(event):
+            try:
+                sub(sub_event)
+                store.commit()
+            except Exception:
+                logger.exception("Subscriber %r failed on the %s event %r",
+                                 sub, eventclass.__name__, detached)
+                store.rollback()
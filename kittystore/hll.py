@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+A HyperLogLog sketch, to estimate the number of distinct values in a set in a
+constant (and small) amount of memory. Sketches can be merged, so the daily
+sketches stored in the list activity table can be combined to estimate the
+number of participants over any range of days.
+
+See "HyperLogLog: the analysis of a near-optimal cardinality estimation
+algorithm", Flajolet et al., 2007.
+"""
+
+from __future__ import absolute_import, division
+
+import math
+from hashlib import sha1 # pylint: disable-msg=E0611
+
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog sketch with 2**precision registers of one byte. The default
+    precision gives a standard error of about 3% with 1kB of storage.
+    """
+
+    def __init__(self, registers=None, precision=10):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        else:
+            self.registers = bytearray(registers)
+            if len(self.registers) != self.size:
+                raise ValueError("Wrong sketch size: %d, expected %d"
+                                 % (len(self.registers), self.size))
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        hashed = long(sha1(value).hexdigest()[:16], 16) # 64 bits
+        index = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rest = hashed & ((1 << remaining_bits) - 1)
+        # position of the leftmost 1 bit in the rest of the hash
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+        return self
+
+    def update(self, other):
+        """Merge another sketch of the same precision into this one"""
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precisions")
+        for index, value in enumerate(other.registers):
+            if value > self.registers[index]:
+                self.registers[index] = value
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / sum(
+                2.0 ** -value for value in self.registers)
+        zeros = sum(1 for value in self.registers if value == 0)
+        if estimate <= 2.5 * self.size and zeros:
+            # small range correction (linear counting)
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def merged(cls, serialized_sketches, precision=10):
+        """Merge serialized sketches into a new sketch"""
+        result = cls(precision=precision)
+        for serialized in serialized_sketches:
+            result.update(cls(serialized, precision))
+        return result
@@ -87,6 +87,9 @@ U(?:rl|RL)[ ]?:[ ]([^\s]+)\s*\n
 
 TEXTWRAP_RE = re.compile("\n\s*")
 
+# number of imported messages in each batch event
+EVENTS_BATCH_SIZE = 1000
+
 
 def awarify(date):
     if date.tzinfo is None or date.tzinfo.utcoffset(date) is None:
@@ -144,79 +147,84 @@ class DbImporter(object):
         self.store.search_index = make_delayed(self.store.search_index)
         cnt_imported = 0
         cnt_read = 0
-        for message in mailbox.mbox(mbfile):
-            if self.since:
-                date = message["date"]
-                if date:
+        # coalesce the events, see kittystore.store.Store.batch_events()
+        with self.store.batch_events():
+            for message in mailbox.mbox(mbfile):
+                if self.since:
+                    date = message["date"]
+                    if date:
+                        try:
+                            date = awarify(parse(date))
+                        except ValueError, e:
+                            print "Can't parse date string in message %s: %s" \
+                                  % (message["message-id"], date)
+                            print e
+                            continue
+                        if date < self.since:
+                            continue
+                cnt_read = cnt_read + 1
+                self.total_imported += 1
+                if self.verbose:
+                    print "%s (%d)" % (message["Message-Id"], self.total_imported)
+                # Un-wrap the subject line if necessary
+                if message["subject"]:
+                    message.replace_header("subject",
+                            TEXTWRAP_RE.sub(" ", message["subject"]))
+                # Try to find the mailing-list subject prefix in the first email
+                if not self.mlist.subject_prefix and message["subject"]:
+                    subject_prefix = PREFIX_RE.search(message["subject"])
+                    if subject_prefix:
+                        self.mlist.subject_prefix = unicode(subject_prefix.group(1))
+                if self.force_import:
+                    while self.store.is_message_in_list(
+                                self.mlist.fqdn_listname,
+                                unquote(message["Message-Id"])):
+                        oldmsgid = message["Message-Id"]
+                        message.replace_header("Message-Id",
+                                "<%s-%s>" % (unquote(message["Message-Id"]),
+                                             str(randint(0, 100))))
+                        print("Found duplicate, changing message id from %s to %s"
+                              % (oldmsgid, message["Message-Id"]))
+                # Parse message to search for attachments
+                try:
+                    attachments = self.extract_attachments(message)
+                except DownloadError, e:
+                    print ("Could not download one of the attachments! "
+                           "Skipping this message. Error: %s" % e.args[0])
+                    continue
+                # Now insert the message
+                try:
+                    self.store.add_to_list(self.mlist, message)
+                except ValueError, e:
+                    if len(e.args) != 2:
+                        raise # Regular ValueError exception
                     try:
-                        date = awarify(parse(date))
-                    except ValueError, e:
-                        print "Can't parse date string in message %s: %s" \
-                              % (message["message-id"], date)
-                        print e
-                        continue
-                    if date < self.since:
-                        continue
-            cnt_read = cnt_read + 1
-            self.total_imported += 1
-            if self.verbose:
-                print "%s (%d)" % (message["Message-Id"], self.total_imported)
-            # Un-wrap the subject line if necessary
-            if message["subject"]:
-                message.replace_header("subject",
-                        TEXTWRAP_RE.sub(" ", message["subject"]))
-            # Try to find the mailing-list subject prefix in the first email
-            if not self.mlist.subject_prefix and message["subject"]:
-                subject_prefix = PREFIX_RE.search(message["subject"])
-                if subject_prefix:
-                    self.mlist.subject_prefix = unicode(subject_prefix.group(1))
-            if self.force_import:
-                while self.store.is_message_in_list(
+                        print "%s from %s about %s" % (e.args[0],
+                                e.args[1].get("From"), e.args[1].get("Subject"))
+                    except UnicodeDecodeError:
+                        print "%s with message-id %s" % (
+                                e.args[0], e.args[1].get("Message-ID"))
+                    continue
+                except DatabaseError:
+                    print_exc()
+                    print ("Message %s failed to import, skipping"
+                           % unquote(message["Message-Id"]))
+                    self.store.rollback()
+                    continue
+                # And insert the attachments
+                for counter, att in enumerate(attachments):
+                    self.store.add_attachment(
                             self.mlist.fqdn_listname,
-                            unquote(message["Message-Id"])):
-                    oldmsgid = message["Message-Id"]
-                    message.replace_header("Message-Id",
-                            "<%s-%s>" % (unquote(message["Message-Id"]),
-                                         str(randint(0, 100))))
-                    print("Found duplicate, changing message id from %s to %s"
-                          % (oldmsgid, message["Message-Id"]))
-            # Parse message to search for attachments
-            try:
-                attachments = self.extract_attachments(message)
-            except DownloadError, e:
-                print ("Could not download one of the attachments! "
-                       "Skipping this message. Error: %s" % e.args[0])
-                continue
-            # Now insert the message
-            try:
-                self.store.add_to_list(self.mlist, message)
-            except ValueError, e:
-                if len(e.args) != 2:
-                    raise # Regular ValueError exception
-                try:
-                    print "%s from %s about %s" % (e.args[0],
-                            e.args[1].get("From"), e.args[1].get("Subject"))
-                except UnicodeDecodeError:
-                    print "%s with message-id %s" % (
-                            e.args[0], e.args[1].get("Message-ID"))
-                continue
-            except DatabaseError:
-                print_exc()
-                print ("Message %s failed to import, skipping"
-                       % unquote(message["Message-Id"]))
-                self.store.rollback()
-                continue
-            # And insert the attachments
-            for counter, att in enumerate(attachments):
-                self.store.add_attachment(
-                        self.mlist.fqdn_listname,
-                        message["Message-Id"].strip(" <>"),
-                        counter, att[0], att[1], None, att[2])
-
-            self.store.flush()
-            cnt_imported += 1
-            # Commit every time to be able to rollback on error
-            self.store.commit()
+                            message["Message-Id"].strip(" <>"),
+                            counter, att[0], att[1], None, att[2])
+
+                self.store.flush()
+                cnt_imported += 1
+                if cnt_imported % EVENTS_BATCH_SIZE == 0:
+                    self.store.flush_events()
+                # Commit every time to be able to rollback on error
+                self.store.commit()
+        self.store.commit() # the changes of the last events subscribers
         self.store.search_index.flush() # Now commit to the search index
         if self.verbose:
             print '  %s email read' % cnt_read
@@ -3,11 +3,13 @@
 from __future__ import absolute_import, with_statement, unicode_literals, print_function
 
 import os
+import threading
 
 from pkg_resources import resource_filename
 from dogpile.cache import make_region
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, MetaData
+from sqlalchemy.exc import DisconnectionError, DBAPIError
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 import alembic
 import alembic.config
@@ -15,18 +17,61 @@ from alembic.script import ScriptDirectory
 from alembic.environment import EnvironmentContext
 
 from kittystore import SchemaUpgradeNeeded
-from kittystore.caching import setup_cache
+from kittystore.caching import setup_cache, _is_memory_db
 from .model import Base
 from .store import SAStore
 
 
 
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    # Pessimistic disconnect handling: SQLAlchemy retries the checkout with a
+    # new connection if this one has been closed by the server.
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+def _create_engine(settings, debug=False):
+    url = settings.KITTYSTORE_URL
+    if url.startswith("sqlite"):
+        # SQLite uses its own pools
+        return create_engine(url, echo=debug)
+    engine = create_engine(url, echo=debug,
+        pool_size=getattr(settings, "KITTYSTORE_DB_POOL_SIZE", 5),
+        max_overflow=getattr(settings, "KITTYSTORE_DB_POOL_OVERFLOW", 10),
+        # don't use connections the server may have dropped
+        pool_recycle=getattr(settings, "KITTYSTORE_DB_POOL_RECYCLE", 3600))
+    if getattr(settings, "KITTYSTORE_DB_PRE_PING", True):
+        event.listen(engine, "checkout", _ping_connection)
+    return engine
+
+
+
+_head_revision = None
+_head_revision_lock = threading.Lock()
+
+def get_head_revision():
+    """The latest revision of the migration scripts, read once per process"""
+    global _head_revision
+    with _head_revision_lock:
+        if _head_revision is None:
+            config = alembic.config.Config(resource_filename(
+                    "kittystore.sa", "alembic.ini"))
+            _head_revision = \
+                ScriptDirectory.from_config(config).get_current_head()
+        return _head_revision
+
+
+
 class SchemaManager(object):
 
     def __init__(self, settings, engine=None, debug=False):
         self.settings = settings
         if engine is None:
-            engine = create_engine(settings.KITTYSTORE_URL, echo=debug)
+            engine = _create_engine(settings, debug)
         self.engine = engine
         self.debug = debug
         self._config = None
@@ -47,15 +92,22 @@ class SchemaManager(object):
             self._script = ScriptDirectory.from_config(self.config)
         return self._script
 
+    def get_db_revision(self):
+        """The revision stored in the database, or None"""
+        try:
+            return self.engine.execute(
+                "SELECT version_num FROM alembic_version").scalar()
+        except DBAPIError:
+            return None # no version table yet
+
     def check(self):
-        def _do_check(db_rev, context):
-            head_rev = self.script.get_current_head()
-            if db_rev == head_rev:
-                return [] # already at the head revision
+        # A single query: the alembic environment is only loaded when the
+        # database must be upgraded
+        db_rev = self.get_db_revision()
+        head_rev = get_head_revision()
+        if db_rev != head_rev:
             raise SchemaUpgradeNeeded("version of the database: %s. Version of the code: %s" % (db_rev, head_rev))
-        with EnvironmentContext(self.config, self.script, fn=_do_check):
-            self.script.run_env()
-        return self.script.get_current_head()
+        return head_rev
 
     def _db_is_storm(self):
         md = MetaData()
@@ -97,24 +149,74 @@ class SchemaManager(object):
 
 
 def create_sa_db(settings, debug=False):
-    engine = create_engine(settings.KITTYSTORE_URL, echo=debug)
+    engine = _create_engine(settings, debug)
     schema_mgr = SchemaManager(settings, engine, debug)
     return schema_mgr.setup_db()
 
 
 
+class StoreFactory(object):
+    """
+    The resources shared by the stores of a database in the process: the
+    engine (and its connection pool), the cache region, and the session
+    registry which gives each thread its own session.
+    """
+
+    def __init__(self, settings, debug=False):
+        self.settings = settings
+        self.debug = debug
+        self.engine = _create_engine(settings, debug)
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.cache = make_region()
+        setup_cache(self.cache, settings)
+        self._schema_checked = False
+        self._lock = threading.Lock()
+
+    def check_schema(self, auto_create=False):
+        """Check the schema version once for the process"""
+        with self._lock:
+            if self._schema_checked:
+                return
+            schema_mgr = SchemaManager(self.settings, self.engine, self.debug)
+            try:
+                schema_mgr.check()
+            except SchemaUpgradeNeeded:
+                if not auto_create:
+                    raise
+                schema_mgr.setup_db()
+            self._schema_checked = True
+
+    def remove(self):
+        """Close and discard the current thread's session, for example at the
+        end of a web request"""
+        self.Session.remove()
+
+
+_factories = {}
+_factories_lock = threading.Lock()
+
+def get_store_factory(settings, debug=False):
+    """Returns the process-wide StoreFactory for the database"""
+    if _is_memory_db(settings.KITTYSTORE_URL):
+        # An in-memory database only exists in its engine, each store gets
+        # a new one
+        return StoreFactory(settings, debug)
+    key = (settings.KITTYSTORE_URL, debug)
+    with _factories_lock:
+        if key not in _factories:
+            _factories[key] = StoreFactory(settings, debug)
+        return _factories[key]
+
+
 def get_sa_store(settings, search_index=None, debug=False, auto_create=False):
-    engine = create_engine(settings.KITTYSTORE_URL, echo=debug)
-    schema_mgr = SchemaManager(settings, engine, debug)
-    try:
-        schema_mgr.check()
-    except SchemaUpgradeNeeded:
-        if not auto_create:
-            raise
-        schema_mgr.setup_db()
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    cache = make_region()
-    setup_cache(cache, settings)
-    session.cache = cache
-    return SAStore(session, search_index, settings, debug)
+    factory = get_store_factory(settings, debug)
+    factory.check_schema(auto_create)
+    session = factory.Session()
+    session.cache = factory.cache
+    # estimate the distinct participants counts from the daily sketches
+    session.approximate_counts = getattr(
+            settings, "KITTYSTORE_APPROXIMATE_COUNTS", False)
+    store = SAStore(session, search_index, settings, debug)
+    # write the events to the event_outbox table for the outbox consumers
+    store.outbox = getattr(settings, "KITTYSTORE_EVENT_OUTBOX", False)
+    return store
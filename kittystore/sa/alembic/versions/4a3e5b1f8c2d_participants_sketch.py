@@ -0,0 +1,37 @@
+"""Daily senders sketches and email sender index
+
+The sketches are filled by the kittystore-rebuild-activity command (also run
+by kittystore-updatedb after a schema upgrade).
+
+Revision ID: 4a3e5b1f8c2d
+Revises: b7bc23955ca5
+Create Date: 2026-10-19 16:02:27.310458
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a3e5b1f8c2d'
+down_revision = 'b7bc23955ca5'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    if not context.is_offline_mode():
+        # The column may have been created with the rest of the schema (for
+        # example when upgrading from Storm).
+        inspector = sa.inspect(op.get_bind())
+        columns = [ col["name"] for col in
+                    inspector.get_columns("list_activity_daily") ]
+        if "senders_sketch" in columns:
+            return
+    op.add_column("list_activity_daily",
+            sa.Column("senders_sketch", sa.LargeBinary, nullable=True))
+    op.create_index("ix_email_list_name_date_sender_email", "email",
+                    ["list_name", "date", "sender_email"])
+
+
+def downgrade():
+    op.drop_index("ix_email_list_name_date_sender_email", "email")
+    op.drop_column("list_activity_daily", "senders_sketch")
@@ -0,0 +1,41 @@
+"""Daily list activity table
+
+The table is filled by the kittystore-rebuild-activity command (also run by
+kittystore-updatedb after a schema upgrade).
+
+Revision ID: 53816e9d9233
+Revises: d1992a75f51
+Create Date: 2026-10-19 10:12:41.514022
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '53816e9d9233'
+down_revision = 'd1992a75f51'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    if not context.is_offline_mode():
+        # The table may have been created with the rest of the schema (for
+        # example when upgrading from Storm).
+        inspector = sa.inspect(op.get_bind())
+        if "list_activity_daily" in inspector.get_table_names():
+            return
+    op.create_table('list_activity_daily',
+        sa.Column('list_name', sa.Unicode(length=255), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('messages_count', sa.Integer(), nullable=False),
+        sa.Column('new_threads_count', sa.Integer(), nullable=False),
+        sa.Column('senders_count', sa.Integer(), nullable=False),
+        sa.Column('active_threads_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['list_name'], ['list.name'],
+                                onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('list_name', 'day')
+        )
+
+
+def downgrade():
+    op.drop_table('list_activity_daily')
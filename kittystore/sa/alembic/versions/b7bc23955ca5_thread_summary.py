@@ -0,0 +1,77 @@
+"""Thread summary columns
+
+Revision ID: b7bc23955ca5
+Revises: 53816e9d9233
+Create Date: 2026-10-19 14:38:05.871203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7bc23955ca5'
+down_revision = '53816e9d9233'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+COLUMNS = (
+    ("starting_email_id", sa.Unicode(255)),
+    ("starter_name", sa.UnicodeText),
+    ("last_email_id", sa.Unicode(255)),
+    ("subject", sa.UnicodeText),
+    ("emails_count", sa.Integer),
+    ("participants_count", sa.Integer),
+    ("likes", sa.Integer),
+    ("dislikes", sa.Integer),
+)
+
+IN_THREAD = ("email.list_name = thread.list_name "
+             "AND email.thread_id = thread.thread_id")
+VOTES = ("SELECT COUNT(*) FROM vote JOIN email "
+         "ON vote.list_name = email.list_name "
+         "AND vote.message_id = email.message_id "
+         "WHERE " + IN_THREAD + " AND vote.value = %d")
+
+
+def upgrade():
+    existing = []
+    if not context.is_offline_mode():
+        # The columns may have been created with the rest of the schema (for
+        # example when upgrading from Storm).
+        inspector = sa.inspect(op.get_bind())
+        existing = [ col["name"] for col in inspector.get_columns("thread") ]
+    for name, type_ in COLUMNS:
+        if name not in existing:
+            op.add_column("thread", sa.Column(name, type_, nullable=True))
+    if "emails_count" not in existing:
+        op.create_index("ix_thread_list_name_date_active", "thread",
+                        ["list_name", "date_active"])
+    # Compute the summaries
+    op.execute("UPDATE thread SET "
+        "starting_email_id = (SELECT message_id FROM email WHERE "
+            + IN_THREAD + " ORDER BY email.in_reply_to IS NOT NULL, "
+            "email.date LIMIT 1), "
+        "last_email_id = (SELECT message_id FROM email WHERE "
+            + IN_THREAD + " ORDER BY email.date DESC LIMIT 1), "
+        "emails_count = (SELECT COUNT(*) FROM email WHERE "
+            + IN_THREAD + "), "
+        "participants_count = (SELECT COUNT(DISTINCT sender_email) "
+            "FROM email WHERE " + IN_THREAD + "), "
+        "likes = (" + VOTES % 1 + "), "
+        "dislikes = (" + VOTES % -1 + ")"
+        )
+    op.execute("UPDATE thread SET "
+        "subject = (SELECT subject FROM email "
+            "WHERE email.list_name = thread.list_name "
+            "AND email.message_id = thread.starting_email_id), "
+        "starter_name = (SELECT sender.name FROM email JOIN sender "
+            "ON sender.email = email.sender_email "
+            "WHERE email.list_name = thread.list_name "
+            "AND email.message_id = thread.starting_email_id)"
+        )
+
+
+def downgrade():
+    op.drop_index("ix_thread_list_name_date_active", "thread")
+    for name, type_ in COLUMNS:
+        op.drop_column("thread", name)
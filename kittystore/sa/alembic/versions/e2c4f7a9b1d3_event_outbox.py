@@ -0,0 +1,41 @@
+"""Event outbox table
+
+Revision ID: e2c4f7a9b1d3
+Revises: 4a3e5b1f8c2d
+Create Date: 2026-10-19 17:21:44.902317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2c4f7a9b1d3'
+down_revision = '4a3e5b1f8c2d'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    if not context.is_offline_mode():
+        # The table may have been created with the rest of the schema (for
+        # example when upgrading from Storm).
+        inspector = sa.inspect(op.get_bind())
+        if "event_outbox" in inspector.get_table_names():
+            return
+    op.create_table('event_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_type', sa.Unicode(length=50), nullable=False),
+        sa.Column('list_name', sa.Unicode(length=255), nullable=False),
+        sa.Column('payload', sa.UnicodeText(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('claim_id', sa.Unicode(length=50), nullable=True),
+        sa.Column('claimed_until', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index('ix_event_outbox_claimed_until', 'event_outbox',
+                    ['claimed_until'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_event_outbox_claimed_until', 'event_outbox')
+    op.drop_table('event_outbox')
@@ -27,7 +27,7 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy import and_, desc
 from sqlalchemy import Column, ForeignKey, Integer, Unicode, UnicodeText
-from sqlalchemy import DateTime, LargeBinary
+from sqlalchemy import Date, DateTime, LargeBinary
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.sql import expression
@@ -36,8 +36,11 @@ from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import event as sa_event
 
 from kittystore import events
+from kittystore.caching import (versioned_key, bump_generation,
+    get_or_create_versioned, get_or_create_counters, change_counters)
 from kittystore.utils import get_message_id_hash
-from .utils import get_participants_count_between, get_threads_between
+from .utils import (get_participants_count_between,
+    get_active_threads_count, get_vote_counts, db_creator)
 
 Base = declarative_base()
 
@@ -81,20 +84,23 @@ class List(Base):
     def recent_participants_count(self):
         begin_date, end_date = self.get_recent_dates()
         session = object_session(self)
-        return session.cache.get_or_create(
-            str("list:%s:recent_participants_count" % self.name),
-            lambda: get_participants_count_between(session, self.name,
-                                                   begin_date, end_date),
+        name = self.name # don't use self in the background
+        approximate = getattr(session, "approximate_counts", False)
+        return get_or_create_versioned(session.cache, "list:%s" % name,
+            "recent_participants_count", db_creator(session,
+                lambda s: get_participants_count_between(
+                        s, name, begin_date, end_date, approximate)),
             86400)
 
     @property
     def recent_threads_count(self):
         begin_date, end_date = self.get_recent_dates()
         session = object_session(self)
-        return session.cache.get_or_create(
-            str("list:%s:recent_threads_count" % self.name),
-            lambda: get_threads_between(session, self.name,
-                                        begin_date, end_date).count(),
+        name = self.name # don't use self in the background
+        return get_or_create_versioned(session.cache, "list:%s" % name,
+            "recent_threads_count", db_creator(session,
+                lambda s: get_active_threads_count(s, name,
+                                                   begin_date, end_date)),
             86400)
 
     def get_month_activity(self, year, month):
@@ -102,15 +108,18 @@ class List(Base):
         begin_date = datetime.datetime(year, month, 1)
         end_date = begin_date + datetime.timedelta(days=32)
         end_date = end_date.replace(day=1)
-        participants_count = session.cache.get_or_create(
-            str("list:%s:participants_count:%s:%s" % (self.name, year, month)),
-            lambda: get_participants_count_between(session, self.name,
-                                                   begin_date, end_date),
+        name = self.name # don't use self in the background
+        namespace = "list:%s:month:%s:%s" % (name, year, month)
+        approximate = getattr(session, "approximate_counts", False)
+        participants_count = get_or_create_versioned(session.cache, namespace,
+            "participants_count", db_creator(session,
+                lambda s: get_participants_count_between(
+                        s, name, begin_date, end_date, approximate)),
             )
-        threads_count = session.cache.get_or_create(
-            str("list:%s:threads_count:%s:%s" % (self.name, year, month)),
-            lambda: get_threads_between(session, self.name,
-                                        begin_date, end_date).count(),
+        threads_count = get_or_create_versioned(session.cache, namespace,
+            "threads_count", db_creator(session,
+                lambda s: get_active_threads_count(s, name,
+                                                   begin_date, end_date)),
             )
         Activity = namedtuple('Activity',
                 ['year', 'month', 'participants_count', 'threads_count'])
@@ -118,20 +127,28 @@ class List(Base):
 
     @events.subscribe_to(events.NewMessage)
     def on_new_message(event): # will be called unbound (no self as 1st arg)
-        cache = event.store.db.cache
-        l = event.store.get_list(event.mlist.fqdn_listname)
-        # recent activity
-        begin_date = l.get_recent_dates()[0]
-        if event.message.date >= begin_date:
-            cache.delete(str("list:%s:recent_participants_count" % l.name))
-            l.recent_participants_count
-            cache.delete(str("list:%s:recent_threads_count" % l.name))
-            l.recent_threads_count
+        _bump_list_generations(event.store, event.mlist, [event.message])
+
+    @events.subscribe_to(events.NewMessageBatch, replaces=on_new_message)
+    def on_new_message_batch(event):
+        _bump_list_generations(event.store, event.mlist, event.messages)
+
+
+def _bump_list_generations(store, mlist, messages):
+    # the values are recomputed on demand, not on ingestion
+    cache = store.db.cache
+    l = store.get_list(mlist.fqdn_listname)
+    namespaces = set()
+    # recent activity
+    begin_date = l.get_recent_dates()[0]
+    for message in messages:
+        if message.date >= begin_date:
+            namespaces.add("list:%s" % l.name)
         # month activity
-        year, month = event.message.date.year, event.message.date.month
-        cache.delete(str("list:%s:participants_count:%s:%s"
-                         % (l.name, year, month)))
-        l.get_month_activity(year, month)
+        year, month = message.date.year, message.date.month
+        namespaces.add("list:%s:month:%s:%s" % (l.name, year, month))
+    for namespace in namespaces:
+        bump_generation(cache, namespace)
 
 
 
@@ -158,12 +175,12 @@ class User(Base):
     def get_votes_in_list(self, list_name):
         session = object_session(self)
         def getvotes():
-            req = session.query(Vote).filter(Vote.list_name == list_name)
-            likes = req.filter(Vote.value == 1).count()
-            dislikes = req.filter(Vote.value == -1).count()
-            return likes, dislikes # TODO: optimize with a Union statement?
-        cache_key = str("user:%s:list:%s:votes" % (self.id.int, list_name))
-        return session.cache.get_or_create(cache_key, getvotes)
+            return get_vote_counts(session.query(Vote).filter(
+                        Vote.list_name == list_name).with_parent(self))
+        return get_or_create_counters(session, (
+            str("user:%s:list:%s:likes" % (self.id.int, list_name)),
+            str("user:%s:list:%s:dislikes" % (self.id.int, list_name)),
+            ), getvotes)
 
 
 
@@ -247,24 +264,25 @@ class Email(Base):
                     Vote.message_id == self.message_id)
 
     @property
-    def likes(self):
+    def vote_counts(self):
+        """The likes and dislikes counts, computed and cached together"""
         session = object_session(self)
-        return session.cache.get_or_create(
+        return get_or_create_counters(session, (
             str("list:%s:email:%s:likes" % (self.list_name, self.message_id)),
-            lambda: self._get_votes_query().filter(Vote.value == 1).count()
-            )
+            str("list:%s:email:%s:dislikes" % (self.list_name, self.message_id)),
+            ), lambda: get_vote_counts(self._get_votes_query()))
+
+    @property
+    def likes(self):
+        return self.vote_counts[0]
 
     @property
     def dislikes(self):
-        session = object_session(self)
-        return session.cache.get_or_create(
-            str("list:%s:email:%s:dislikes" % (self.list_name, self.message_id)),
-            lambda: self._get_votes_query().filter(Vote.value == -1).count()
-            )
+        return self.vote_counts[1]
 
     @property
     def likestatus(self):
-        likes, dislikes = self.likes, self.dislikes
+        likes, dislikes = self.vote_counts
         # TODO: use an Enum?
         if likes - dislikes >= 10:
             return "likealot"
@@ -282,18 +300,15 @@ class Email(Base):
             return # Vote already recorded (should I raise an exception?)
         if value not in (0, 1, -1):
             raise ValueError("A vote can only be +1 or -1 (or 0 to cancel)")
-        # The vote can be added, changed or cancelled. Keep it simple and
-        # delete likes and dislikes cached values.
-        session.cache.delete_multi((
-            # this message's (dis)likes count
-            str("list:%s:email:%s:likes" % (self.list_name, self.message_id)),
-            str("list:%s:email:%s:dislikes" % (self.list_name, self.message_id)),
-            # this thread (dis)likes count
-            str("list:%s:thread:%s:likes" % (self.list_name, self.thread_id)),
-            str("list:%s:thread:%s:dislikes" % (self.list_name, self.thread_id)),
-            # the user's vote count on this list
-            str("user:%s:list:%s:votes" % (user_id.int, self.list_name)),
-            ))
+        # The vote can be added, changed or cancelled.
+        previous = existing.value if existing is not None else 0
+        likes = int(value == 1) - int(previous == 1)
+        dislikes = int(value == -1) - int(previous == -1)
+        # update the thread summary
+        thread = self.thread
+        if thread._likes is not None and thread._dislikes is not None:
+            thread._likes += likes
+            thread._dislikes += dislikes
         if existing is not None:
             # vote changed or cancelled
             if value == 0:
@@ -307,6 +322,15 @@ class Email(Base):
             session.add(Vote(list_name=self.list_name,
                              message_id=self.message_id,
                              user_id=user_id, value=value))
+        # change the cached counts of this message, this thread and the
+        # user's votes on this list, after the commit
+        deltas = {}
+        for prefix in ("list:%s:email:%s" % (self.list_name, self.message_id),
+                       "list:%s:thread:%s" % (self.list_name, self.thread_id),
+                       "user:%s:list:%s" % (user_id.int, self.list_name)):
+            deltas[str("%s:likes" % prefix)] = likes
+            deltas[str("%s:dislikes" % prefix)] = dislikes
+        change_counters(session, deltas)
 
     def get_vote_by_user_id(self, user_id):
         if user_id is None:
@@ -327,6 +351,9 @@ Index("ix_email_list_name_message_id_hash",
       unique=True)
 Index("ix_email_list_name_thread_id",
       Email.__table__.c.list_name, Email.__table__.c.thread_id)
+Index("ix_email_list_name_date_sender_email",
+      Email.__table__.c.list_name, Email.__table__.c.date,
+      Email.__table__.c.sender_email)
 
 
 
@@ -391,6 +418,17 @@ class Thread(Base):
     thread_id = Column(Unicode(255), primary_key=True, nullable=False)
     date_active = Column(DateTime, nullable=False, index=True)
     category_id = Column(Integer, ForeignKey("category.id"))
+    # Summary of the thread, maintained when emails and votes are added or
+    # removed, so that a thread listing does not need other queries. NULL
+    # values are computed by the properties.
+    starting_email_id = Column(Unicode(255))
+    starter_name = Column(UnicodeText)
+    last_email_id = Column(Unicode(255))
+    _subject = Column("subject", UnicodeText)
+    _emails_count = Column("emails_count", Integer)
+    _participants_count = Column("participants_count", Integer)
+    _likes = Column("likes", Integer)
+    _dislikes = Column("dislikes", Integer)
     emails = relationship("Email", order_by="Email.date", backref="thread",
                           cascade="all, delete-orphan")
     category_obj = relationship("Category", backref="threads")
@@ -400,6 +438,9 @@ class Thread(Base):
     def starting_email(self):
         """Return (and cache) the email starting this thread"""
         session = object_session(self)
+        if self.starting_email_id is not None:
+            return session.query(Email).get(
+                    (self.list_name, self.starting_email_id))
         message_id = session.cache.get_or_create(
             str("list:%s:thread:%s:starting_email_id"
                 % (self.list_name, self.thread_id)),
@@ -412,6 +453,9 @@ class Thread(Base):
 
     @property
     def last_email(self):
+        if self.last_email_id is not None:
+            return object_session(self).query(Email).get(
+                    (self.list_name, self.last_email_id))
         return object_session(self).query(Email).with_parent(self
                     ).order_by(desc(Email.date)).first()
 
@@ -430,10 +474,13 @@ class Thread(Base):
 
     @property
     def participants_count(self):
+        if self._participants_count is not None:
+            return self._participants_count
         session = object_session(self)
         return session.cache.get_or_create(
-            str("list:%s:thread:%s:participants_count"
-                % (self.list_name, self.thread_id)),
+            versioned_key(session.cache, "list:%s:thread:%s"
+                          % (self.list_name, self.thread_id),
+                          "participants_count"),
             lambda: self._get_participants().count())
 
     def get_emails(self, sort="date", limit=None, offset=None):
@@ -485,14 +532,19 @@ class Thread(Base):
 
     @property
     def emails_count(self):
+        if self._emails_count is not None:
+            return self._emails_count
         session = object_session(self)
         return session.cache.get_or_create(
-            str("list:%s:thread:%s:emails_count"
-                % (self.list_name, self.thread_id)),
+            versioned_key(session.cache, "list:%s:thread:%s"
+                          % (self.list_name, self.thread_id),
+                          "emails_count"),
             lambda: session.query(Email).with_parent(self).count())
 
     @property
     def subject(self):
+        if self._subject is not None:
+            return self._subject
         session = object_session(self)
         return session.cache.get_or_create(
             str("list:%s:thread:%s:subject"
@@ -506,26 +558,29 @@ class Thread(Base):
                 ))
 
     @property
-    def likes(self):
+    def vote_counts(self):
+        """The likes and dislikes counts, computed and cached together"""
+        if self._likes is not None and self._dislikes is not None:
+            return self._likes, self._dislikes
         session = object_session(self)
-        return session.cache.get_or_create(
+        return get_or_create_counters(session, (
             str("list:%s:thread:%s:likes" % (self.list_name, self.thread_id)),
-            lambda: self._getvotes().filter(Vote.value == 1).count()
-            )
+            str("list:%s:thread:%s:dislikes"
+                % (self.list_name, self.thread_id)),
+            ), lambda: get_vote_counts(self._getvotes()))
+
+    @property
+    def likes(self):
+        return self.vote_counts[0]
 
     @property
     def dislikes(self):
-        session = object_session(self)
-        return session.cache.get_or_create(
-            str("list:%s:thread:%s:dislikes"
-                % (self.list_name, self.thread_id)),
-            lambda: self._getvotes().filter(Vote.value == -1).count()
-            )
+        return self.vote_counts[1]
 
     @property
     def likestatus(self):
         # TODO: deduplicate with the equivalent function in the Email class
-        likes, dislikes = self.likes, self.dislikes
+        likes, dislikes = self.vote_counts
         # XXX: use an Enum?
         if likes - dislikes >= 10:
             return "likealot"
@@ -533,15 +588,60 @@ class Thread(Base):
             return "like"
         return "neutral"
 
+    def refresh_summary(self):
+        """Recompute the summary columns from the emails and the votes"""
+        session = object_session(self)
+        emails = session.query(Email).with_parent(self)
+        starter = emails.order_by(Email.in_reply_to != None, Email.date
+                    ).first()
+        if starter is None:
+            return # the thread is empty
+        self.starting_email_id = starter.message_id
+        self.starter_name = starter.sender.name
+        self._subject = starter.subject
+        self.last_email_id = emails.order_by(desc(Email.date)
+                    ).first().message_id
+        self._emails_count = emails.count()
+        self._participants_count = self._get_participants().count()
+        self._likes, self._dislikes = get_vote_counts(self._getvotes())
+
+    def add_to_summary(self, email, new_thread):
+        """Update the summary columns with a new email in this thread"""
+        if new_thread:
+            self.starting_email_id = email.message_id
+            self.starter_name = email.sender.name
+            self._subject = email.subject
+            self.last_email_id = email.message_id
+            self._emails_count = self._participants_count = 1
+            self._likes = self._dislikes = 0
+            return
+        if None in (self._emails_count, self._participants_count):
+            self.refresh_summary() # never computed
+            return
+        session = object_session(self)
+        if email.date >= session.query(Email.date).filter(and_(
+                Email.list_name == self.list_name,
+                Email.message_id == self.last_email_id)).scalar():
+            self.last_email_id = email.message_id
+        self._emails_count += 1
+        if session.query(Email.message_id).with_parent(self).filter(and_(
+                Email.sender_email == email.sender_email,
+                Email.message_id != email.message_id,
+                )).first() is None:
+            self._participants_count += 1
+
     @events.subscribe_to(events.NewMessage)
     def on_new_message(event): # will be called unbound (no self as 1st argument)
-        cache = event.store.db.cache
-        cache.delete(str("list:%s:thread:%s:emails_count"
-                         % (event.message.list_name, event.message.thread_id)))
-        event.message.thread.emails_count
-        cache.delete(str("list:%s:thread:%s:participants_count"
-                         % (event.message.list_name, event.message.thread_id)))
-        event.message.thread.participants_count
+        # the counts and the related threads are recomputed on demand
+        bump_generation(event.store.db.cache, "list:%s:thread:%s"
+                        % (event.message.list_name, event.message.thread_id))
+
+    @events.subscribe_to(events.NewMessageBatch, replaces=on_new_message)
+    def on_new_message_batch(event):
+        for thread_key in set((message.list_name, message.thread_id)
+                              for message in event.messages):
+            bump_generation(event.store.db.cache,
+                            "list:%s:thread:%s" % thread_key)
 
     @events.subscribe_to(events.NewThread)
     def on_new_thread(event): # will be called unbound (no self as 1st argument)
@@ -550,6 +650,18 @@ class Thread(Base):
                     % (event.thread.list_name, event.thread.thread_id)),
                 event.thread.starting_email.subject)
 
+    @events.subscribe_to(events.NewThreadBatch, replaces=on_new_thread)
+    def on_new_thread_batch(event):
+        event.store.db.cache.set_multi(dict(
+                (str("list:%s:thread:%s:subject"
+                     % (thread.list_name, thread.thread_id)),
+                 thread.starting_email.subject)
+                for thread in event.threads))
+
+# composite indexes
+Index("ix_thread_list_name_date_active",
+      Thread.__table__.c.list_name, Thread.__table__.c.date_active)
+
 @sa_event.listens_for(Thread, 'before_insert')
 def Thread_before_insert(mapper, connection, target):
     """Auto-set the active date from the last email in thread"""
@@ -604,3 +716,51 @@ Vote.__table__.append_constraint(
 # composite indexes
 Index("ix_vote_list_name_message_id",
       Vote.__table__.c.list_name, Vote.__table__.c.message_id)
+
+
+
+class ListActivity(Base):
+    """
+    The activity of a list on a given day, maintained when emails are added
+    or deleted. The activity charts and counters are computed from this
+    table instead of the email table.
+    """
+
+    __tablename__ = "list_activity_daily"
+
+    list_name = Column(Unicode(255),
+        ForeignKey("list.name", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False, primary_key=True)
+    day = Column(Date, nullable=False, primary_key=True)
+    messages_count = Column(Integer, nullable=False, default=0)
+    # threads started on this day
+    new_threads_count = Column(Integer, nullable=False, default=0)
+    # distinct senders on this day (they can't be summed over several days)
+    senders_count = Column(Integer, nullable=False, default=0)
+    # threads whose last activity is on this day
+    active_threads_count = Column(Integer, nullable=False, default=0)
+    # HyperLogLog sketch of the senders on this day, they can be merged to
+    # estimate the number of distinct senders over several days
+    senders_sketch = Column(LargeBinary)
+
+
+
+class OutboxEvent(Base):
+    """
+    An event waiting to be processed by an outbox consumer, written in the
+    same transaction as the change which emitted it (see
+    kittystore.events.process_outbox).
+    """
+
+    __tablename__ = "event_outbox"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    event_type = Column(Unicode(50), nullable=False)
+    list_name = Column(Unicode(255), nullable=False)
+    # JSON-encoded mailing-list properties and object ids
+    payload = Column(UnicodeText, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    # the claim of a consumer, until the lease expires
+    claim_id = Column(Unicode(50))
+    claimed_until = Column(DateTime, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
@@ -15,14 +15,19 @@ license.
 from __future__ import absolute_import, print_function, unicode_literals
 
 import datetime
+import json
+import uuid
 from email.utils import unquote
 
 from mailman.interfaces.archiver import ArchivePolicy
-from sqlalchemy import desc, and_
+from sqlalchemy import (desc, and_, or_, distinct, case, literal, Date,
+    Unicode)
 from sqlalchemy.sql import func
-from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from dateutil.tz import tzutc
+from dateutil.parser import parse as date_parse
 
 from kittystore import MessageNotFound, events
 from kittystore.store import Store
@@ -31,9 +36,12 @@ from kittystore.utils import header_to_unicode
 from kittystore.scrub import Scrubber
 from kittystore.utils import get_ref_and_thread_id
 from kittystore.analysis import compute_thread_order_and_depth
+from kittystore.caching.mlist import refresh_list_props
+from kittystore.hll import HyperLogLog
 
 from .model import List, Email, Attachment, Thread, Category
-from .model import Sender, User
+from .model import Sender, User, Vote, ListActivity, OutboxEvent
+from .utils import day_range
 
 import logging
 logger = logging.getLogger(__name__)
@@ -54,6 +62,9 @@ class SAStore(Store):
             for propname in l.mailman_props:
                 setattr(l, propname, getattr(mlist, propname))
             self.db.add(l)
+        else:
+            # before the search indexing, which uses the archive_policy
+            refresh_list_props(self, mlist)
         if mlist.archive_policy == ArchivePolicy.never:
             logger.info("Archiving disabled by list policy for %s" % list_name)
             return None
@@ -136,6 +147,7 @@ class SAStore(Store):
             self.db.add(thread)
         else:
             thread = self.db.query(Thread).get((list_name, thread_id))
+        previous_date_active = thread.date_active
         thread.date_active = email.date
 
         thread.emails.append(email)
@@ -143,13 +155,13 @@ class SAStore(Store):
         for attachment in attachments:
             self.add_attachment(list_name, msg_id, *attachment)
         self.flush()
+        thread.add_to_summary(email, new_thread)
+        self._add_activity(email, new_thread, previous_date_active)
         # invalidate the cache
-        events.notify(events.NewMessage(self, mlist, email))
+        self._notify(events.NewMessage(self, mlist, email))
         if new_thread:
-            events.notify(events.NewThread(self, mlist, thread))
+            self._notify(events.NewThread(self, mlist, thread))
         # search indexing
-        # do it after caching because we need some list properties (like
-        # archive_policy)
         if self.search_index is not None:
             self.search_index.add(email)
 
@@ -160,11 +172,22 @@ class SAStore(Store):
         msg = self.get_message_by_id_from_list(list_name, message_id)
         if msg is None:
             raise MessageNotFound(list_name, message_id)
+        dates = [msg.date, msg.thread.date_active]
+        thread = msg.thread
         self.db.delete(msg)
+        self.flush()
+        # The loaded thread.emails collection still holds the deleted email,
+        # and the thread deletion would cascade to it
+        self.db.expire(thread, ["emails"])
         # Remove the thread if necessary
-        if msg.thread.emails_count == 0:
-            self.db.delete(msg.thread)
+        if self.db.query(Email).with_parent(thread).count() == 0:
+            self.db.delete(thread)
+        else:
+            thread.refresh_summary()
         self.flush()
+        self.refresh_activity(list_name, dates)
+        if self.search_index is not None:
+            self.search_index.delete(msg.list_name, msg.message_id)
 
     def get_list_size(self, list_name):
         return self.db.query(Email).filter(
@@ -245,13 +268,16 @@ class SAStore(Store):
             the interval to query.
         :param end: A datetime object representing the ending date of
             the interval to query.
-        :returns: The list of thread-starting messages.
+        :returns: The list of thread-starting messages. The threads carry
+            their summary (statistics, subject, starter's name), so that a
+            listing only costs this query.
         """
         return self.db.query(Thread).filter(and_(
                     Thread.list_name == list_name,
                     Thread.date_active >= start,
                     Thread.date_active < end,
-                )).order_by(desc(Thread.date_active))
+                )).options(joinedload(Thread.category_obj)
+                ).order_by(desc(Thread.date_active))
 
     def get_start_date(self, list_name):
         """ Get the date of the first archived email in a list.
@@ -304,7 +330,20 @@ class SAStore(Store):
         :param thread_id: The thread_id as used in the web-pages. Used here to
             uniquely identify the thread in the database.
         """
-        self.db.delete(self.get_thread(list_name, thread_id))
+        thread = self.get_thread(list_name, thread_id)
+        dates = [ date for date, in self.db.query(Email.date).with_parent(
+                    thread) ] + [thread.date_active]
+        self.db.delete(thread)
+        self.flush()
+        self.refresh_activity(list_name, dates)
+
+    def refresh_thread_summary(self, thread):
+        """ Recompute the summary of a thread (its statistics, starting and
+        last emails).
+
+        :param thread: The thread to recompute the summary of.
+        """
+        thread.refresh_summary()
 
     def get_list(self, list_name):
         """ Return the list object for a mailing list name.
@@ -350,6 +389,91 @@ class SAStore(Store):
             part = part.limit(limit)
         return part.all()
 
+    def _compute_thread_stats(self, name, threads):
+        thread_ids = {}
+        for thread in threads:
+            thread_ids.setdefault(thread.list_name, []).append(
+                    thread.thread_id)
+        in_threads = or_(*[ and_(Email.list_name == list_name,
+                                 Email.thread_id.in_(ids))
+                            for list_name, ids in thread_ids.iteritems() ])
+        if name == "subject":
+            # the subject of the first email which is not a reply
+            rows = self.db.query(Email.list_name, Email.thread_id,
+                                 Email.subject
+                ).filter(in_threads).filter(Email.in_reply_to == None
+                ).order_by(Email.date)
+            subjects = {}
+            for list_name, thread_id, subject in rows:
+                subjects.setdefault((list_name, thread_id), subject)
+            return dict(((thread.list_name, thread.thread_id),
+                         subjects.get((thread.list_name, thread.thread_id),
+                                      thread.subject))
+                        for thread in threads)
+        if name == "emails_count":
+            query = self.db.query(Email.list_name, Email.thread_id,
+                                  func.count(Email.message_id))
+        elif name == "participants_count":
+            query = self.db.query(Email.list_name, Email.thread_id,
+                                  func.count(distinct(Email.sender_email)))
+        elif name in ("likes", "dislikes"):
+            query = self.db.query(Email.list_name, Email.thread_id,
+                                  func.count(Vote.user_id)
+                ).join(Vote, and_(Vote.list_name == Email.list_name,
+                                  Vote.message_id == Email.message_id)
+                ).filter(Vote.value == (1 if name == "likes" else -1))
+        else:
+            raise ValueError("Unknown thread statistic: %s" % name)
+        counts = dict(((list_name, thread_id), count)
+                      for list_name, thread_id, count in query.filter(
+                            in_threads).group_by(Email.list_name,
+                                                 Email.thread_id))
+        return dict(((thread.list_name, thread.thread_id),
+                     counts.get((thread.list_name, thread.thread_id), 0))
+                    for thread in threads)
+
+    def _compute_vote_summaries(self, emails):
+        message_ids = {}
+        for email in emails:
+            message_ids.setdefault(email.list_name, []).append(
+                    email.message_id)
+        rows = self.db.query(Vote.list_name, Vote.message_id,
+                    func.sum(case([(Vote.value == 1, 1)], else_=0)),
+                    func.sum(case([(Vote.value == -1, 1)], else_=0)),
+                ).filter(or_(*[ and_(Vote.list_name == list_name,
+                                     Vote.message_id.in_(ids))
+                                for list_name, ids in message_ids.iteritems()
+                ])).group_by(Vote.list_name, Vote.message_id)
+        return dict(((list_name, message_id), (int(likes), int(dislikes)))
+                    for list_name, message_id, likes, dislikes in rows)
+
+    def get_vote_counters(self):
+        likes = func.sum(case([(Vote.value == 1, 1)], else_=0))
+        dislikes = func.sum(case([(Vote.value == -1, 1)], else_=0))
+        counters = {}
+        def add_counters(prefix, likes_count, dislikes_count):
+            counters[str("%s:likes" % prefix)] = int(likes_count)
+            counters[str("%s:dislikes" % prefix)] = int(dislikes_count)
+        for list_name, message_id, email_likes, email_dislikes in \
+                self.db.query(Vote.list_name, Vote.message_id, likes,
+                    dislikes).group_by(Vote.list_name, Vote.message_id):
+            add_counters("list:%s:email:%s" % (list_name, message_id),
+                         email_likes, email_dislikes)
+        for list_name, thread_id, thread_likes, thread_dislikes in \
+                self.db.query(Email.list_name, Email.thread_id, likes,
+                    dislikes).join(Vote, and_(
+                        Vote.list_name == Email.list_name,
+                        Vote.message_id == Email.message_id,
+                    )).group_by(Email.list_name, Email.thread_id):
+            add_counters("list:%s:thread:%s" % (list_name, thread_id),
+                         thread_likes, thread_dislikes)
+        for user_id, list_name, user_likes, user_dislikes in \
+                self.db.query(Vote.user_id, Vote.list_name, likes,
+                    dislikes).group_by(Vote.user_id, Vote.list_name):
+            add_counters("user:%s:list:%s" % (user_id.int, list_name),
+                         user_likes, user_dislikes)
+        return counters
+
 
     def get_categories(self):
         """ Return the list of available categories
@@ -385,13 +509,20 @@ class SAStore(Store):
             self.db.add(sender)
         sender.user_id = user_id
 
+    def get_sender(self, email):
+        """ Returns the Sender object for an email address """
+        return self.db.query(Sender).get(email)
+
     def get_sender_name(self, user_id):
         """ Returns a user's fullname when given his user_id """
         return self.db.query(Sender.name).filter(
                               Sender.user_id == user_id).scalar()
 
-    def get_senders_without_user(self, limit=None):
+    def get_senders_without_user(self, limit=None, after=None):
         q = self.db.query(Sender).filter(Sender.user_id == None)
+        if after is not None:
+            q = q.filter(Sender.email > after)
+        q = q.order_by(Sender.email)
         if limit:
             q = q.limit(limit)
         return q
@@ -424,8 +555,30 @@ class SAStore(Store):
             req = req.filter(Thread.list_name == list_name)
         return req.distinct()
 
-    def get_all_messages(self):
-        return self.db.query(Email).order_by(Email.archived_date).all()
+    def get_all_messages(self, after=None, limit=None):
+        """
+        Return the messages in archival order. ``after`` is the
+        (archived_date, list_name, message_id) key of a message, to only
+        return the messages following it (keyset pagination).
+        """
+        q = self.db.query(Email).order_by(
+                Email.archived_date, Email.list_name, Email.message_id)
+        if after is not None:
+            date, list_name, message_id = after
+            if self.db.bind.dialect.name == "sqlite" and not date.microsecond:
+                # SQLite stores the server default (CURRENT_TIMESTAMP)
+                # without microseconds, compare with the same text
+                date = literal(unicode(date.strftime("%Y-%m-%d %H:%M:%S")),
+                               Unicode)
+            q = q.filter(or_(
+                Email.archived_date > date,
+                and_(Email.archived_date == date, or_(
+                    Email.list_name > list_name,
+                    and_(Email.list_name == list_name,
+                         Email.message_id > message_id)))))
+        if limit:
+            q = q.limit(limit)
+        return q
 
     def get_message_dates(self, list_name, start, end):
         """ Return all email dates between two given dates.
@@ -444,6 +597,212 @@ class SAStore(Store):
                     Email.date < end,
                  )).order_by(desc(Email.date)) ]
 
+    # List activity
+
+    def get_daily_activity(self, list_name, start, end):
+        """ Return the activity of a list on each day between two dates.
+
+        :param list_name: The name of the mailing list.
+        :param start: A datetime object representing the starting date of
+            the interval to query.
+        :param end: A datetime object representing the ending date of
+            the interval to query.
+        :returns: The list of ListActivity objects, in day order. The days
+            without any activity are not included.
+        """
+        begin_day, end_day = day_range(start, end)
+        return self.db.query(ListActivity).filter(and_(
+                    ListActivity.list_name == list_name,
+                    ListActivity.day >= begin_day,
+                    ListActivity.day < end_day,
+                )).order_by(ListActivity.day).all()
+
+    def _add_activity(self, email, new_thread, previous_date_active):
+        """Update the daily activity with a new email"""
+        day = email.date.date()
+        day_start = datetime.datetime.combine(day, datetime.time(0))
+        first_post = self.db.query(Email.message_id).filter(and_(
+                    Email.list_name == email.list_name,
+                    Email.sender_email == email.sender_email,
+                    Email.date >= day_start,
+                    Email.date < day_start + datetime.timedelta(days=1),
+                    Email.message_id != email.message_id,
+                )).first() is None
+        increments = { day: {
+            "messages_count": 1,
+            "new_threads_count": int(new_thread),
+            "senders_count": int(first_post),
+            "active_threads_count": 1,
+            } }
+        if previous_date_active is not None:
+            previous = increments.setdefault(previous_date_active.date(),
+                        {"active_threads_count": 0})
+            previous["active_threads_count"] -= 1
+        for day, values in increments.iteritems():
+            updated = self._increment_activity(email.list_name, day, values)
+            if not updated and min(values.values()) >= 0:
+                # not found, and not a decrement (the activity has not
+                # been computed yet)
+                if not self._insert_activity(email.list_name, day, values):
+                    # another archiver inserted it in the meantime
+                    self._increment_activity(email.list_name, day, values)
+        if first_post:
+            self.flush()
+            activity = self.db.query(ListActivity).get(
+                    (email.list_name, email.date.date()))
+            if activity is not None and activity.senders_sketch is not None:
+                activity.senders_sketch = HyperLogLog(
+                        activity.senders_sketch).add(
+                        email.sender_email).to_bytes()
+            elif activity is not None and activity.messages_count == 1:
+                # first email of the day
+                activity.senders_sketch = HyperLogLog().add(
+                        email.sender_email).to_bytes()
+        self.flush()
+
+    def _increment_activity(self, list_name, day, values):
+        return self.db.query(ListActivity).filter_by(
+                list_name=list_name, day=day).update(dict(
+                    (getattr(ListActivity, name),
+                     getattr(ListActivity, name) + value)
+                    for name, value in values.iteritems()
+                ), synchronize_session=False)
+
+    def _insert_activity(self, list_name, day, values):
+        """Returns False if the row already exists"""
+        activity = ListActivity(list_name=list_name, day=day, **values)
+        if self.db.bind.dialect.name == "sqlite":
+            # The UPDATE has already locked the database until the commit,
+            # and pysqlite would commit before a SAVEPOINT
+            self.db.add(activity)
+            return True
+        try:
+            with self.db.begin_nested():
+                self.db.add(activity)
+        except IntegrityError:
+            return False
+        return True
+
+    def refresh_activity(self, list_name, dates):
+        """ Recompute the daily activity of a list on some days.
+
+        :param list_name: The name of the mailing list.
+        :param dates: The datetime objects of the days to recompute.
+        """
+        for day in set(date.date() for date in dates if date is not None):
+            self._compute_activity(list_name, day,
+                                   day + datetime.timedelta(days=1))
+
+    def rebuild_activity(self, list_name=None):
+        """ Recompute the daily activity from the emails and the threads.
+
+        :param list_name: The name of the mailing list to recompute the
+            activity of. If None or not specified, recompute all the lists.
+        """
+        if list_name is None:
+            list_names = self.get_list_names()
+        else:
+            list_names = [list_name]
+        for name in list_names:
+            self._compute_activity(name)
+
+    def _compute_activity(self, list_name, begin_day=None, end_day=None):
+        def in_days(column):
+            conditions = []
+            if begin_day is not None:
+                conditions.append(column >= begin_day)
+            if end_day is not None:
+                conditions.append(column < end_day)
+            return and_(*conditions)
+        email_day = func.date(Email.date, type_=Date)
+        thread_day = func.date(Thread.date_active, type_=Date)
+        activity = {}
+        def get_day(day):
+            if day not in activity:
+                activity[day] = ListActivity(list_name=list_name, day=day,
+                        messages_count=0, new_threads_count=0,
+                        senders_count=0, active_threads_count=0)
+            return activity[day]
+        for day, messages, senders, new_threads in self.db.query(
+                    email_day, func.count(Email.message_id),
+                    func.count(distinct(Email.sender_email)),
+                    # the thread_id of a new thread is its first email's hash
+                    func.sum(case([(Email.thread_id == Email.message_id_hash,
+                                    1)], else_=0)),
+                ).filter(Email.list_name == list_name
+                ).filter(in_days(email_day)).group_by(email_day):
+            get_day(day).messages_count = messages
+            get_day(day).senders_count = senders
+            get_day(day).new_threads_count = new_threads
+        for day, threads in self.db.query(thread_day, func.count(
+                    Thread.thread_id)
+                ).filter(Thread.list_name == list_name
+                ).filter(in_days(thread_day)).group_by(thread_day):
+            get_day(day).active_threads_count = threads
+        sketches = {}
+        for day, sender_email in self.db.query(email_day, Email.sender_email
+                ).filter(Email.list_name == list_name
+                ).filter(in_days(email_day)).distinct():
+            sketches.setdefault(day, HyperLogLog()).add(sender_email)
+        for day, sketch in sketches.iteritems():
+            get_day(day).senders_sketch = sketch.to_bytes()
+        self.db.query(ListActivity).filter(
+                ListActivity.list_name == list_name).filter(
+                in_days(ListActivity.day)).delete(synchronize_session=False)
+        self.db.add_all(activity.values())
+        self.flush()
+
+    # Event outbox
+
+    def add_to_outbox(self, event):
+        list_name, mlist, ids = event.detach()
+        props = {}
+        for propname in List.mailman_props:
+            value = getattr(mlist, propname, None)
+            if isinstance(value, ArchivePolicy):
+                value = value.name
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            props[propname] = value
+        self.db.add(OutboxEvent(event_type=unicode(event.__class__.__name__),
+                list_name=list_name,
+                payload=unicode(json.dumps({"mlist": props, "ids": ids})),
+                created_at=datetime.datetime.utcnow(), attempts=0))
+
+    def claim_outbox_events(self, limit, lease):
+        now = datetime.datetime.utcnow()
+        claimable = and_(
+                or_(OutboxEvent.claimed_until == None,
+                    OutboxEvent.claimed_until < now),
+                OutboxEvent.attempts < events.OUTBOX_MAX_ATTEMPTS)
+        event_ids = [ event_id for event_id, in
+                      self.db.query(OutboxEvent.id).filter(claimable
+                        ).order_by(OutboxEvent.id).limit(limit) ]
+        if not event_ids:
+            return []
+        # another consumer may have claimed some of them in the meantime
+        claim_id = unicode(uuid.uuid4().hex)
+        self.db.query(OutboxEvent).filter(
+                OutboxEvent.id.in_(event_ids)).filter(claimable).update({
+                    OutboxEvent.claim_id: claim_id,
+                    OutboxEvent.claimed_until: now + datetime.timedelta(
+                                                    seconds=lease),
+                    OutboxEvent.attempts: OutboxEvent.attempts + 1,
+                }, synchronize_session=False)
+        self.commit()
+        claimed = []
+        for event in self.db.query(OutboxEvent).filter(
+                OutboxEvent.claim_id == claim_id).order_by(OutboxEvent.id):
+            payload = json.loads(event.payload)
+            mlist = OutboxMailingList(event.list_name, payload["mlist"])
+            claimed.append((event.id, getattr(events, event.event_type),
+                            (event.list_name, mlist, payload["ids"])))
+        return claimed
+
+    def ack_outbox_event(self, event_id):
+        self.db.query(OutboxEvent).filter(OutboxEvent.id == event_id
+                ).delete(synchronize_session=False)
+
     # Attachments
 
     def add_attachment(self, mlist, msg_id, counter, name, content_type,
@@ -491,3 +850,22 @@ class SAStore(Store):
         """
         return self.db.query(Attachment).get(
                     (list_name, message_id[:254], counter))
+
+
+
+class OutboxMailingList(object):
+    """
+    The mailing-list of an event read from the outbox, with the properties it
+    had when the event was emitted (implementing the part of the
+    IMailingList interface used by the subscribers).
+    """
+
+    def __init__(self, fqdn_listname, props):
+        self.fqdn_listname = fqdn_listname
+        for propname in List.mailman_props:
+            value = props.get(propname)
+            if value is not None and propname == "archive_policy":
+                value = getattr(ArchivePolicy, value)
+            elif value is not None and propname == "created_at":
+                value = date_parse(value)
+            setattr(self, propname, value)
@@ -17,24 +17,57 @@ license.
 
 from __future__ import absolute_import
 
-from sqlalchemy import and_
+import datetime
+
+from sqlalchemy import and_, case, distinct, func
+from sqlalchemy.orm import Session
 from dogpile.cache import make_region
 
+from kittystore.caching import DatabaseCreator
+from kittystore.hll import HyperLogLog
+
 
-def get_participants_count_between(session, list_name, begin_date, end_date):
+def get_participants_count_between(session, list_name, begin_date, end_date,
+                                   approximate=False):
+        """
+        Returns the number of distinct senders between two dates. If
+        approximate is True, the count is estimated by merging the daily
+        senders sketches of the list activity (the dates are then rounded to
+        the day), falling back to the exact count if a sketch is missing.
+        """
         from .model import Email
+        if approximate:
+            count = get_approximate_participants_count(
+                    session, list_name, begin_date, end_date)
+            if count is not None:
+                return count
         # We filter on emails dates instead of threads dates because that would
         # also include last month's participants when threads carry from one
         # month to the next
-        result = session.query(Email.sender_email).filter(and_(
+        return session.query(func.count(distinct(Email.sender_email))
+                    ).filter(and_(
                         Email.list_name == list_name,
                         Email.date >= begin_date,
                         Email.date < end_date,
-                        )).distinct()
-        return result.count()
-        # TODO: check that ------v
-        #return result.count() # generates a sub-query
-        return len(list(result))
+                    )).scalar()
+
+def get_approximate_participants_count(session, list_name, begin_date,
+                                       end_date):
+        """
+        Returns the estimated number of distinct senders between two days, or
+        None if the senders sketch of a day has not been computed yet.
+        """
+        from .model import ListActivity
+        begin_day, end_day = day_range(begin_date, end_date)
+        sketches = [ sketch for sketch, in
+                     session.query(ListActivity.senders_sketch).filter(and_(
+                        ListActivity.list_name == list_name,
+                        ListActivity.day >= begin_day,
+                        ListActivity.day < end_day,
+                    )) ]
+        if None in sketches:
+            return None
+        return HyperLogLog.merged(sketches).count()
 
 def get_threads_between(session, list_name, begin_date, end_date):
         from .model import Thread
@@ -43,3 +76,47 @@ def get_threads_between(session, list_name, begin_date, end_date):
                     Thread.date_active >= begin_date,
                     Thread.date_active < end_date,
                 ))
+
+def day_range(begin_date, end_date):
+    """
+    Returns the days covering the [begin_date, end_date) interval, the end
+    day being excluded.
+    """
+    end_day = end_date.date()
+    if end_date.time() != datetime.time(0):
+        end_day += datetime.timedelta(days=1)
+    return begin_date.date(), end_day
+
+def get_active_threads_count(session, list_name, begin_date, end_date):
+        """
+        Returns the number of threads active between two dates, from the daily
+        list activity (the dates are thus rounded to the day).
+        """
+        from .model import ListActivity
+        begin_day, end_day = day_range(begin_date, end_date)
+        return session.query(func.sum(ListActivity.active_threads_count)
+                    ).filter(and_(
+                        ListActivity.list_name == list_name,
+                        ListActivity.day >= begin_day,
+                        ListActivity.day < end_day,
+                    )).scalar() or 0
+
+def get_vote_counts(query):
+        """
+        Returns the likes and dislikes counts of a query on votes, with a
+        single database query.
+        """
+        from .model import Vote
+        likes, dislikes = query.with_entities(
+                func.sum(case([(Vote.value == 1, 1)], else_=0)),
+                func.sum(case([(Vote.value == -1, 1)], else_=0)),
+            ).one()
+        return int(likes or 0), int(dislikes or 0)
+
+def db_creator(session, query):
+    """
+    Returns a cache value creator calling the query function with a database
+    session (see kittystore.caching.DatabaseCreator).
+    """
+    return DatabaseCreator(query, session,
+                           lambda: Session(bind=session.get_bind()))
@@ -26,13 +26,19 @@ Author: Aurelien Bompard <abompard@fedoraproject.org>
 from __future__ import absolute_import
 
 import importlib
+import os
 import sys
+import time
 import logging
 from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from kittystore import get_store, create_store, SchemaUpgradeNeeded
 
-from kittystore.caching import sync_mailman
+from kittystore.caching import sync_mailman, reconcile_counters
+from kittystore.events import process_outbox
+from kittystore.search import get_backend_class
 
 
 #
@@ -103,8 +109,99 @@ def updatedb():
         sync_mailman(store)
         store.commit()
         print "  ...done!"
+        print "Computing the lists activity..."
+        store.rebuild_activity()
+        store.commit()
+        print "  ...done!"
     else:
-        print "No schema upgrade needed."
+        if (store.search_index is not None
+                and store.search_index.needs_upgrade()):
+            print "Upgrading the search index, the current index will be " \
+                  "used for searching until it is done..."
+            store.search_index.upgrade(store)
+            print "  ...done!"
+        else:
+            print "No schema upgrade needed."
+
+
+
+#
+# Search index benchmark
+#
+
+def _get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, filename))
+               for filename in os.listdir(path))
+
+def search_benchmark():
+    parser = OptionParser(usage="%prog -s settings_module [-b backends] "
+                                "[-q query ...]")
+    parser.add_option("-s", "--settings", default="settings",
+                      help="the Python path to a Django-like settings module")
+    parser.add_option("-p", "--pythonpath",
+                      help="a directory to add to the Python path")
+    parser.add_option("-d", "--debug", action="store_true",
+                      help="show SQL queries")
+    parser.add_option("-b", "--backends", default="whoosh,sqlite",
+                      help="comma-separated list of the search backends to "
+                           "compare (default: %default)")
+    parser.add_option("-q", "--query", action="append", dest="queries",
+                      help="a query to time, can be repeated")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("no arguments allowed.")
+    try:
+        backends = [ (name, get_backend_class(name))
+                     for name in opts.backends.split(",") ]
+    except ValueError, e:
+        parser.error(e.args[0])
+    queries = opts.queries or ["test", "python", "release AND update"]
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    try:
+        store = get_store_from_options(opts)
+    except (StoreFromOptionsError, AttributeError), e:
+        parser.error(e.args[0])
+    except SchemaUpgradeNeeded:
+        print >>sys.stderr, ("The database schema needs to be upgraded, "
+                             "please run kittystore-updatedb first")
+        sys.exit(1)
+    print "Building the search index from %d messages..." \
+          % store.get_all_messages().count()
+    tmpdir = mkdtemp(prefix="kittystore-benchmark-")
+    results = []
+    try:
+        for name, backend in backends:
+            for strip_quoted in (False, True):
+                title = name
+                if strip_quoted:
+                    title += " (no quotes)"
+                location = os.path.join(tmpdir, title)
+                search_index = backend(location, strip_quoted=strip_quoted)
+                start = time.time()
+                search_index.upgrade(store)
+                build_time = time.time() - start
+                start = time.time()
+                for query in queries:
+                    search_index.search(query, limit=20)
+                search_time = (time.time() - start) / len(queries)
+                results.append((title, _get_dir_size(location), build_time,
+                                search_time))
+    finally:
+        rmtree(tmpdir)
+    print "%-22s %13s %10s %12s" % ("", "index size", "rebuild",
+                                    "avg search")
+    for title, size, build_time, search_time in results:
+        print "%-22s %10d kB %8.1f s %9.1f ms" % (
+                title, size / 1024, build_time, search_time * 1000)
+    reference = results[0]
+    for title, size, build_time, search_time in results[1:]:
+        if not (reference[1] and reference[2] and reference[3]):
+            break
+        print "%s compared to %s: index size %+.1f%%, rebuild time %+.1f%%, " \
+              "search time %+.1f%%" % (title, reference[0],
+                (size * 100.0 / reference[1]) - 100,
+                (build_time * 100.0 / reference[2]) - 100,
+                (search_time * 100.0 / reference[3]) - 100)
 
 
 
@@ -143,6 +240,120 @@ def sync_mailman_cmd():
 
 
 
+#
+# List activity
+#
+
+def rebuild_activity_cmd():
+    parser = OptionParser(usage="%prog -s settings_module [-l list_name]")
+    parser.add_option("-s", "--settings", default="settings",
+                      help="the Python path to a Django-like settings module")
+    parser.add_option("-p", "--pythonpath",
+                      help="a directory to add to the Python path")
+    parser.add_option("-d", "--debug", action="store_true",
+                      help="show SQL queries")
+    parser.add_option("-l", "--list-name",
+                      help="only recompute the activity of this list")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("no arguments allowed.")
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    print 'Computing the daily activity of the lists...'
+    try:
+        store = get_store_from_options(opts)
+    except (StoreFromOptionsError, AttributeError), e:
+        parser.error(e.args[0])
+    except SchemaUpgradeNeeded:
+        print >>sys.stderr, ("The database schema needs to be upgraded, "
+                             "please run kittystore-updatedb first")
+        sys.exit(1)
+    store.rebuild_activity(opts.list_name)
+    store.commit()
+    print "  ...done!"
+
+
+
+#
+# Vote counters
+#
+
+def reconcile_counters_cmd():
+    parser = OptionParser(usage="%prog -s settings_module")
+    parser.add_option("-s", "--settings", default="settings",
+                      help="the Python path to a Django-like settings module")
+    parser.add_option("-p", "--pythonpath",
+                      help="a directory to add to the Python path")
+    parser.add_option("-d", "--debug", action="store_true",
+                      help="show SQL queries")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("no arguments allowed.")
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    print 'Recounting the cached vote counters...'
+    try:
+        store = get_store_from_options(opts)
+    except (StoreFromOptionsError, AttributeError), e:
+        parser.error(e.args[0])
+    except SchemaUpgradeNeeded:
+        print >>sys.stderr, ("The database schema needs to be upgraded, "
+                             "please run kittystore-updatedb first")
+        sys.exit(1)
+    try:
+        reconcile_counters(store)
+    finally:
+        store.close()
+    print "  ...done!"
+
+
+def outbox_consumer_cmd():
+    parser = OptionParser(usage="%prog -s settings_module [--once]")
+    parser.add_option("-s", "--settings", default="settings",
+                      help="the Python path to a Django-like settings module")
+    parser.add_option("-p", "--pythonpath",
+                      help="a directory to add to the Python path")
+    parser.add_option("-d", "--debug", action="store_true",
+                      help="show SQL queries")
+    parser.add_option("-b", "--batch-size", type="int", default=100,
+                      help="the number of events to claim at once")
+    parser.add_option("-l", "--lease", type="int", default=300,
+                      help="the time in seconds after which an unprocessed "
+                           "event is claimed again")
+    parser.add_option("-i", "--interval", type="float", default=5,
+                      help="the time in seconds to wait when the outbox "
+                           "is empty")
+    parser.add_option("--once", action="store_true",
+                      help="process the waiting events and exit")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("no arguments allowed.")
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.INFO)
+    try:
+        store = get_store_from_options(opts)
+    except (StoreFromOptionsError, AttributeError), e:
+        parser.error(e.args[0])
+    except SchemaUpgradeNeeded:
+        print >>sys.stderr, ("The database schema needs to be upgraded, "
+                             "please run kittystore-updatedb first")
+        sys.exit(1)
+    # the subscribers must be run, not write new events to the outbox
+    store.outbox = False
+    try:
+        while True:
+            processed = process_outbox(store, opts.batch_size, opts.lease)
+            if processed:
+                logging.info("Processed %d events", processed)
+            elif opts.once:
+                break
+            else:
+                time.sleep(opts.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+
+
+
 #
 # Mailman 2 archives downloader
 #
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+"""
+Full-text search backends.
+
+The backend is selected with the KITTYSTORE_SEARCH_BACKEND setting: "whoosh"
+(the default), "sqlite", or the Python path to a SearchBackend subclass.
+"""
+
+from __future__ import absolute_import
+
+import importlib
+
+from kittystore.search.base import (SearchBackend, IndexMigration,
+    DelayedSearchEngine, make_delayed, email_to_search_doc, strip_quotes)
+from kittystore.search.whoosh_engine import SearchEngine
+
+
+BACKENDS = {
+    "whoosh": "kittystore.search.whoosh_engine.SearchEngine",
+    "sqlite": "kittystore.search.sqlite_engine.SQLiteSearchEngine",
+}
+
+
+def get_backend_class(name):
+    path = BACKENDS.get(name, name)
+    module_name, class_name = path.rsplit(".", 1)
+    try:
+        return getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError), e:
+        raise ValueError("Unknown search backend %s: %s" % (name, e))
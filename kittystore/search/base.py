@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2012 Aurélien Bompard <abompard@fedoraproject.org>
+Author: Aurélien Bompard <abompard@fedoraproject.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or (at
+your option) any later version.
+See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+license.
+"""
+
+from __future__ import absolute_import
+
+import re
+import threading
+
+from mailman.interfaces.archiver import ArchivePolicy
+from mailman.interfaces.messages import IMessage
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+QUOTED_LINE_RE = re.compile(r"^\s*>")
+# "On Mon, Jan 1, 2013 at 10:00 AM, John Doe <john@example.com> wrote:"
+ATTRIBUTION_RE = re.compile(r"\bwrote\s*:\s*$", re.I)
+
+def strip_quotes(content):
+    """
+    Remove the quoted lines, their attribution line and the signature from an
+    email's content. The text quoted from earlier messages is already indexed
+    with those messages.
+    """
+    if not content:
+        return content
+    lines = []
+    for line in content.splitlines():
+        if line.rstrip() == "--":
+            break # signature separator, the rest is the signature
+        if QUOTED_LINE_RE.match(line):
+            # drop the attribution line introducing the quoted block
+            while lines and not lines[-1].strip():
+                lines.pop()
+            if lines and ATTRIBUTION_RE.search(lines[-1]):
+                lines.pop()
+            continue
+        lines.append(line)
+    return u"\n".join(lines).strip()
+
+
+def email_to_search_doc(email, strip_quoted=False):
+    if not IMessage.providedBy(email):
+        raise ValueError("not an instance of the Email class")
+    private_list = (email.mlist.archive_policy == ArchivePolicy.private)
+    content = email.content
+    if strip_quoted:
+        content = strip_quotes(content)
+    search_doc = {
+            "list_name": email.list_name,
+            "message_id": email.message_id,
+            "thread_id": email.thread_id,
+            "sender": u"%s %s" % (email.sender_name, email.sender_email),
+            "subject": email.subject,
+            "content": content,
+            "date": email.date, # UTC
+            "private_list": private_list,
+    }
+    user_id = email.sender.user_id
+    if user_id is not None:
+        user_id = unicode(user_id.int)
+    search_doc["user_id"] = user_id
+    attachments = [a.name for a in email.attachments]
+    if attachments:
+        search_doc["attachments"] = " ".join(attachments)
+    return search_doc
+
+
+class SearchBackend(object):
+    """
+    The interface of the full-text search backends. The backend is selected
+    with the KITTYSTORE_SEARCH_BACKEND setting, and its data is stored in the
+    KITTYSTORE_SEARCH_INDEX directory.
+
+    The index is versioned: when the backend's schema changes, a new index is
+    built from the Store's content by upgrade(), and the outdated index is
+    used for searching until it is done.
+    """
+
+    def __init__(self, location, timeout=None, strip_quoted=False):
+        self.location = location
+        self.timeout = timeout
+        # Don't index the quoted text and the signatures, the database
+        # content is left untouched
+        self.strip_quoted = strip_quoted
+
+    def add(self, doc):
+        """Index an email, or a dict as returned by email_to_search_doc()"""
+        raise NotImplementedError
+
+    def add_batch(self, documents):
+        raise NotImplementedError
+
+    def delete(self, list_name, message_id):
+        """Remove an email from the index, and from the index being built
+        by an upgrade if there is one"""
+        raise NotImplementedError
+
+    def update(self, documents):
+        """Re-index emails already in the index (when their sender's user_id
+        is found for example)"""
+        for doc in documents:
+            if IMessage.providedBy(doc):
+                doc = email_to_search_doc(doc, self.strip_quoted)
+            self.delete(doc["list_name"], doc["message_id"])
+            self.add(doc)
+
+    def search(self, query, list_name=None, page=None, limit=10,
+               sortedby=None, reverse=False, start=None, end=None,
+               timeout=None, list_names=None, collapse=None):
+        """
+        Returns a dict with the "total" number of results, the "results"
+        (dicts with at least the list_name and message_id keys), and a
+        "partial" boolean set when the timeout was reached. See
+        Store.search() for the arguments.
+        """
+        raise NotImplementedError
+
+    def get_key_terms(self, text, numterms=10):
+        """Return the most significant terms of the text, compared to the
+        content of the index"""
+        raise NotImplementedError
+
+    def get_related_threads(self, text, list_name, thread_id, limit=10):
+        """
+        Return the ids of the threads in the list matching the key terms of
+        the text ("more like this"), except the given thread.
+        """
+        terms = self.get_key_terms(text)
+        if not terms:
+            return []
+        results = self.search(" OR ".join(terms), list_name, limit=limit + 1,
+                              collapse="thread")
+        return [ r["thread_id"] for r in results["results"]
+                 if r.get("thread_id") not in (None, thread_id) ][:limit]
+
+    def optimize(self):
+        pass
+
+    def get_version(self):
+        """Return the schema version of the index in use, or None if there is
+        no index yet."""
+        raise NotImplementedError
+
+    def needs_upgrade(self):
+        raise NotImplementedError
+
+    def upgrade(self, store, background=False):
+        """
+        Build a new index with the current schema from the contents of a
+        Store. Until it is done, the previous index (if any) is still used for
+        searching.
+
+        :param store: the Store to read the messages from. If ``background``
+            is True, it must not be used by another thread until the upgrade
+            is done.
+        :param background: run the upgrade in a separate thread.
+        :returns: the IndexMigration instance.
+        """
+        migration = IndexMigration(self, store)
+        if background:
+            migration.start()
+        else:
+            migration.run()
+        return migration
+
+    def initialize_with(self, store):
+        """Create and populate the index with the contents of a Store"""
+        self.upgrade(store)
+
+    # The steps of an upgrade, see IndexMigration.run()
+
+    def _create_new_index(self):
+        """Create an empty index with the current schema, and return it"""
+        raise NotImplementedError
+
+    def _index_batch(self, index, messages):
+        """Add or update the messages in the index being built"""
+        raise NotImplementedError
+
+    def _switch_to(self, index):
+        """Use the newly built index for searching"""
+        raise NotImplementedError
+
+    def _remove_old_indexes(self):
+        raise NotImplementedError
+
+
+
+class IndexMigration(object):
+    """
+    Build an index with the current schema from the contents of a Store, in
+    batches, and switch the search engine over to it when it is complete.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, engine, store):
+        self.engine = engine
+        self.store = store
+        self.done = 0
+        self.total = None
+        self.last_key = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name="search-index-upgrade")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _backfill(self, index):
+        # Keyset pagination: the messages deleted while we are running don't
+        # shift the following ones (the deletions are applied to the new
+        # index by the engine's delete()). Messages archived meanwhile come
+        # last in archival order, they will be picked up by the last batches.
+        while True:
+            batch = list(self.store.get_all_messages(
+                            after=self.last_key, limit=self.batch_size))
+            if not batch:
+                break
+            self.engine._index_batch(index, batch)
+            last = batch[-1]
+            self.last_key = (last.archived_date, last.list_name,
+                             last.message_id)
+            self.done += len(batch)
+            logger.info("...still indexing (%d/%d)..."
+                        % (self.done, max(self.done, self.total)))
+
+    def run(self):
+        engine = self.engine
+        if not engine.needs_upgrade():
+            return
+        index = engine._create_new_index()
+        self.total = self.store.get_all_messages().count()
+        self._backfill(index)
+        engine._switch_to(index)
+        # Messages archived in the old index between the last batch and the
+        # switch must be copied too.
+        self._backfill(index)
+        engine._remove_old_indexes()
+
+
+
+class DelayedSearchEngine(object):
+    """
+    Wraps a search backend to index the added documents in a single batch
+    when flush() is called.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._add_buffer = []
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def add(self, doc):
+        self._add_buffer.append(doc)
+
+    def flush(self):
+        self.engine.add_batch(self._add_buffer)
+        self._add_buffer = []
+
+
+def make_delayed(engine):
+    return DelayedSearchEngine(engine)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2012 Aurélien Bompard <abompard@fedoraproject.org>
+Author: Aurélien Bompard <abompard@fedoraproject.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or (at
+your option) any later version.
+See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+license.
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from math import ceil, log
+
+from dateutil import tz
+from mailman.interfaces.messages import IMessage
+# Same algorithm as the "porter" tokenizer of FTS5
+from whoosh.lang.porter import stem
+from whoosh.analysis import STOP_WORDS
+
+from kittystore.search.base import SearchBackend, email_to_search_doc
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Bump this number every time the tables in SQLiteSearchEngine._create_tables()
+# change, the index will be rebuilt by SQLiteSearchEngine.upgrade().
+SCHEMA_VERSION = 2
+
+# The fields searched by default, and their weights (same as the field boosts
+# in the Whoosh schema)
+FIELDS = ("sender", "subject", "content", "attachments")
+WEIGHTS = (1.5, 2.0, 1.0, 1.0)
+SORTABLE = ("date", "list_name")
+# Number of SQLite virtual machine instructions between the timeout checks
+PROGRESS_STEPS = 100
+
+# A term, optionally restricted to a field, Whoosh-style: subject:"some words"
+QUERY_TERM_RE = re.compile(r'(?:(\w+):)?("[^"]*"?|[^\s"]+)', re.U)
+OPERATORS = ("AND", "OR", "NOT")
+WORD_RE = re.compile(r"\w{3,}", re.U)
+
+
+def _format_date(date):
+    """Dates are stored as UTC strings, which can be compared and sorted"""
+    if date is None:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(tz.tzutc()).replace(tzinfo=None)
+    # strftime() does not support years before 1900 in Python 2
+    return u"%04d-%02d-%02d %02d:%02d:%02d.%06d" % (date.year, date.month,
+            date.day, date.hour, date.minute, date.second, date.microsecond)
+
+
+def to_fts_query(query):
+    """
+    Convert a query string in the Whoosh syntax to the FTS5 syntax. The
+    supported subset is: terms, "phrases", field:term restrictions, prefix*
+    searches, and the AND, OR and NOT operators.
+    """
+    items = []
+    for field, term in QUERY_TERM_RE.findall(query):
+        if not field and term in OPERATORS:
+            # Operators are only valid between two terms
+            if items and items[-1] not in OPERATORS:
+                items.append(term)
+            continue
+        if field and field not in FIELDS + ("user_id",):
+            # not a field name, for example an URL
+            term = "%s:%s" % (field, term)
+            field = None
+        prefix = (term.endswith("*") and not term.startswith('"'))
+        term = term.strip('"*')
+        if not term:
+            continue
+        phrase = '"%s"' % term.replace('"', '""')
+        if prefix:
+            phrase += " *"
+        if field:
+            items.append("%s : %s" % (field, phrase))
+        else:
+            items.append("{%s} : %s" % (" ".join(FIELDS), phrase))
+    while items and items[-1] in OPERATORS:
+        items.pop()
+    return " ".join(items)
+
+
+
+class SQLiteSearchEngine(SearchBackend):
+    """
+    A search backend using the FTS5 extension of SQLite, in a database file
+    stored in the index directory.
+    """
+
+    def __init__(self, *args, **kw):
+        super(SQLiteSearchEngine, self).__init__(*args, **kw)
+        # SQLite connections can't be shared between threads
+        self._local = threading.local()
+
+    @property
+    def _path(self):
+        return os.path.join(self.location, "search.sqlite")
+
+    @property
+    def db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if not os.path.isdir(self.location):
+                os.makedirs(self.location)
+            db = sqlite3.connect(self._path, timeout=30)
+            # Readers don't block the writer
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def _get_tables(self, version):
+        return ("docs_v%d" % version, "fts_v%d" % version)
+
+    def _create_tables(self, version):
+        docs, fts = self._get_tables(version)
+        self.db.executescript("""
+            DROP TABLE IF EXISTS %(docs)s;
+            DROP TABLE IF EXISTS %(fts)s;
+            CREATE TABLE %(docs)s (
+                id INTEGER PRIMARY KEY,
+                list_name TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                thread_id TEXT,
+                date TEXT,
+                private_list INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (list_name, message_id)
+            );
+            CREATE INDEX ix_%(docs)s_date ON %(docs)s (date);
+            CREATE INDEX ix_%(docs)s_private_list ON %(docs)s (private_list);
+            CREATE VIRTUAL TABLE %(fts)s USING fts5(
+                sender, subject, content, attachments, user_id,
+                tokenize = 'porter unicode61'
+            );
+            """ % {"docs": docs, "fts": fts})
+
+    def get_version(self):
+        if not os.path.exists(self._path):
+            return None
+        return self.db.execute("PRAGMA user_version").fetchone()[0] or None
+
+    def needs_upgrade(self):
+        version = self.get_version()
+        return version is None or version < SCHEMA_VERSION
+
+    def _get_write_version(self):
+        version = self.get_version()
+        if version is None:
+            raise RuntimeError("The search index in %s has not been created "
+                    "yet, run kittystore-updatedb" % self.location)
+        return version
+
+    def _delete(self, version, list_name, message_id):
+        docs, fts = self._get_tables(version)
+        row = self.db.execute(
+                "SELECT id FROM %s WHERE list_name = ? AND message_id = ?"
+                % docs, (list_name, message_id)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM %s WHERE id = ?" % docs, row)
+        self.db.execute("DELETE FROM %s WHERE rowid = ?" % fts, row)
+
+    def _write(self, version, doc):
+        if IMessage.providedBy(doc):
+            doc = email_to_search_doc(doc, self.strip_quoted)
+        docs, fts = self._get_tables(version)
+        self._delete(version, doc["list_name"], doc["message_id"])
+        values = {
+            "list_name": doc["list_name"],
+            "message_id": doc["message_id"],
+            "date": _format_date(doc.get("date")),
+            "private_list": bool(doc.get("private_list")),
+        }
+        if version >= 2:
+            values["thread_id"] = doc.get("thread_id")
+        cursor = self.db.execute("INSERT INTO %s (%s) VALUES (%s)" % (
+                docs, ", ".join(values), ", ".join("?" * len(values))),
+                values.values())
+        self.db.execute(
+                "INSERT INTO %s (rowid, sender, subject, content, "
+                "attachments, user_id) VALUES (?, ?, ?, ?, ?, ?)" % fts,
+                (cursor.lastrowid, doc.get("sender"), doc.get("subject"),
+                 doc.get("content"), doc.get("attachments"),
+                 doc.get("user_id")))
+
+    def add(self, doc):
+        version = self._get_write_version()
+        with self.db:
+            self._write(version, doc)
+
+    def update(self, documents):
+        # _write() replaces the existing document
+        version = self._get_write_version()
+        with self.db:
+            for doc in documents:
+                self._write(version, doc)
+
+    def add_batch(self, documents):
+        logger.info("Indexing all messages")
+        version = self._get_write_version()
+        with self.db:
+            for num, doc in enumerate(documents):
+                self._write(version, doc)
+                if num % 1000 == 0:
+                    logger.info("...still indexing (%d)..." % num)
+
+    def _has_tables(self, version):
+        if not os.path.exists(self._path):
+            return False
+        return self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = ?", (self._get_tables(version)[0],)
+                ).fetchone() is not None
+
+    def delete(self, list_name, message_id):
+        version = self.get_version()
+        with self.db:
+            if version is not None:
+                self._delete(version, list_name, message_id)
+            if (version is None or version < SCHEMA_VERSION) \
+                    and self._has_tables(SCHEMA_VERSION):
+                # being built by an upgrade
+                self._delete(SCHEMA_VERSION, list_name, message_id)
+
+    def search(self, query, list_name=None, page=None, limit=10,
+               sortedby=None, reverse=False, start=None, end=None,
+               timeout=None, list_names=None, collapse=None):
+        """
+        Same semantics as the Whoosh backend. When the timeout is reached the
+        query is interrupted, and the results which were already fetched are
+        returned.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if page is not None and page < 1:
+            raise ValueError("page must be >= 1")
+        if sortedby is not None and sortedby not in SORTABLE:
+            raise ValueError("can't sort by %s" % sortedby)
+        if collapse not in (None, "thread"):
+            raise ValueError("can't collapse on %s" % collapse)
+        return_value = {"total": 0, "results": [], "partial": False}
+        fts_query = to_fts_query(query)
+        if not fts_query:
+            return return_value
+        version = self.get_version()
+        if version is None:
+            return return_value # no index yet
+        if version < 2:
+            collapse = None # outdated index
+        docs, fts = self._get_tables(version)
+        clauses = ["%s MATCH ?" % fts]
+        params = [fts_query]
+        if list_name:
+            list_names = [list_name]
+        if list_names is not None:
+            list_names = list(list_names)
+            if not list_names:
+                return return_value
+            clauses.append("%s.list_name IN (%s)"
+                           % (docs, ", ".join("?" * len(list_names))))
+            params.extend(list_names)
+        else:
+            # When searching all lists, only the public lists are searched
+            clauses.append("%s.private_list = 0" % docs)
+        if start is not None:
+            clauses.append("%s.date >= ?" % docs)
+            params.append(_format_date(start))
+        if end is not None:
+            clauses.append("%s.date < ?" % docs)
+            params.append(_format_date(end))
+        from_where = "FROM %s JOIN %s ON %s.id = %s.rowid WHERE %s" % (
+                fts, docs, docs, fts, " AND ".join(clauses))
+        columns = ["list_name", "message_id"]
+        if version >= 2:
+            columns.append("thread_id")
+        # bm25() is lower for better matches
+        matches = "SELECT %s, %s.id AS id, %s.date AS date, " \
+                  "bm25(%s, %s) AS score %s" % (
+                  ", ".join("%s.%s" % (docs, c) for c in columns), docs, docs,
+                  fts, ", ".join(str(w) for w in WEIGHTS + (0.0,)),
+                  from_where)
+        direction = "DESC" if reverse else "ASC"
+        order_by = "%s %s, id %s" % (sortedby or "score", direction,
+                                     direction)
+        if collapse:
+            # Messages without a thread are not collapsed
+            thread = "COALESCE(thread_id, id)"
+            count_query = "SELECT COUNT(DISTINCT COALESCE(%s.thread_id, " \
+                          "%s.id)) %s" % (docs, docs, from_where)
+            # Keep the first message of each thread in the results order
+            results_query = "SELECT %s, hits FROM (SELECT *, " \
+                    "ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %s) " \
+                    "AS position, COUNT(*) OVER (PARTITION BY %s) AS hits " \
+                    "FROM (%s)) WHERE position = 1" % (", ".join(columns),
+                    thread, order_by, thread, matches)
+            columns.append("hits")
+        else:
+            count_query = "SELECT COUNT(*) %s" % from_where
+            results_query = "SELECT %s FROM (%s)" % (", ".join(columns),
+                                                      matches)
+        start_time = time.time()
+        if timeout:
+            deadline = start_time + timeout
+            self.db.set_progress_handler(
+                    lambda: time.time() > deadline, PROGRESS_STEPS)
+        try:
+            return_value["total"] = self.db.execute(
+                    count_query, params).fetchone()[0]
+            offset = 0
+            if page:
+                # Like Whoosh, return the last page if the page is too far
+                last_page = max(1, int(ceil(return_value["total"]
+                                            / float(limit))))
+                offset = (min(page, last_page) - 1) * limit
+            cursor = self.db.execute(
+                    "%s ORDER BY %s LIMIT ? OFFSET ?"
+                    % (results_query, order_by), params + [limit, offset])
+            for row in cursor:
+                return_value["results"].append(dict(zip(columns, row)))
+        except sqlite3.OperationalError, e:
+            if "interrupted" in str(e):
+                return_value["partial"] = True
+            elif "fts5" in str(e):
+                logger.warning("Invalid search query %r: %s" % (query, e))
+            else:
+                raise
+        finally:
+            if timeout:
+                self.db.set_progress_handler(None, PROGRESS_STEPS)
+        logger.debug("Search for %r took %.3f seconds (%d results%s)"
+                     % (query, time.time() - start_time,
+                        return_value["total"],
+                        ", partial" if return_value["partial"] else ""))
+        return return_value
+
+    def get_key_terms(self, text, numterms=10):
+        """The terms with the highest TF-IDF weight"""
+        frequencies = Counter(stem(word)
+                              for word in WORD_RE.findall(text.lower())
+                              if word not in STOP_WORDS)
+        version = self.get_version()
+        if not frequencies or version is None:
+            return []
+        fts = self._get_tables(version)[1]
+        # The vocabulary table is only visible to this connection
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.%s_vocab "
+                        "USING fts5vocab(main, %s, row)" % (fts, fts))
+        total = self.db.execute("SELECT COUNT(*) FROM %s" % fts).fetchone()[0]
+        # Only the most frequent words, SQLite limits the number of variables
+        candidates = [ term for term, _count
+                       in frequencies.most_common(500) ]
+        weights = []
+        for term, doc_count in self.db.execute(
+                "SELECT term, doc FROM temp.%s_vocab WHERE term IN (%s)"
+                % (fts, ", ".join("?" * len(candidates))), candidates):
+            weights.append((frequencies[term] * log(float(total) / doc_count),
+                            term))
+        weights.sort(reverse=True)
+        return [ term for weight, term in weights[:numterms] if weight > 0 ]
+
+    def optimize(self):
+        version = self.get_version()
+        if version is None:
+            return
+        fts = self._get_tables(version)[1]
+        with self.db:
+            self.db.execute("INSERT INTO %s (%s) VALUES ('optimize')"
+                            % (fts, fts))
+
+    def _create_new_index(self):
+        previous_version = self.get_version()
+        if previous_version is None:
+            logger.info("Creating the search index")
+        else:
+            logger.info("Upgrading the search index from version %d to %d, "
+                        "the current index will be used until it is done"
+                        % (previous_version, SCHEMA_VERSION))
+        # Drops the leftovers from an interrupted upgrade
+        self._create_tables(SCHEMA_VERSION)
+        return SCHEMA_VERSION
+
+    def _index_batch(self, version, messages):
+        with self.db:
+            for message in messages:
+                self._write(version, message)
+
+    def _switch_to(self, version):
+        fts = self._get_tables(version)[1]
+        with self.db:
+            self.db.execute("INSERT INTO %s (%s) VALUES ('optimize')"
+                            % (fts, fts))
+        self.db.execute("PRAGMA user_version = %d" % version)
+
+    def _remove_old_indexes(self):
+        for old_version in range(1, SCHEMA_VERSION):
+            for table in self._get_tables(old_version):
+                self.db.execute("DROP TABLE IF EXISTS %s" % table)
+        logger.info("The search index is now at version %d" % SCHEMA_VERSION)
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2012 Aurélien Bompard <abompard@fedoraproject.org>
+Author: Aurélien Bompard <abompard@fedoraproject.org>
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or (at
+your option) any later version.
+See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+license.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from collections import defaultdict
+
+from whoosh.index import create_in, exists_in, open_dir
+from whoosh.fields import Schema, ID, TEXT, DATETIME, KEYWORD, BOOLEAN
+from whoosh.analysis import StemmingAnalyzer
+from whoosh.qparser import MultifieldParser
+from whoosh.collectors import (TimeLimitCollector, TimeLimit,
+    WrappingCollector, CollapseCollector)
+from whoosh.searching import ResultsPage
+from whoosh.query import Term, DateRange, And
+from whoosh.sorting import FieldFacet
+from mailman.interfaces.messages import IMessage
+
+from kittystore.search.base import SearchBackend, email_to_search_doc
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Bump this number every time the schema in SearchEngine._get_schema() changes,
+# the index will be rebuilt in the background by SearchEngine.upgrade().
+# Version 0 is the unversioned index created by older releases.
+SCHEMA_VERSION = 3
+
+# Only one writer can hold the lock of an index: the archiver, the Mailman
+# users resolver and the upgrade wait for each other (in seconds).
+WRITER_TIMEOUT = 60
+
+
+class _AllowCollector(WrappingCollector):
+    """Only let the allowed documents through, and stop when the time limit
+    is reached"""
+
+    def __init__(self, child, allow, timelimit=None, on_match=None):
+        self.child = child
+        self.allow = allow
+        self.timelimit = timelimit
+        self.on_match = on_match
+
+    def matches(self):
+        if self.timelimit:
+            deadline = time.time() + self.timelimit
+        for sub_docnum in self.child.matches():
+            if self.timelimit and time.time() > deadline:
+                raise TimeLimit
+            if self.offset + sub_docnum in self.allow:
+                self.on_match(sub_docnum)
+                yield sub_docnum
+
+
+class ThreadCollapseCollector(CollapseCollector):
+    """
+    Only keep the best message of each thread, in the results order. Whoosh's
+    FilterCollector and TimeLimitCollector bypass the collapsing when they
+    wrap a CollapseCollector, so the filtering and the time limit are handled
+    below it. The collapsed_counts are not reliable either (the replaced
+    documents are not counted), so the matches of each thread are counted
+    here.
+    """
+
+    def __init__(self, child, allow, timelimit=None, order=None):
+        super(ThreadCollapseCollector, self).__init__(
+                _AllowCollector(child, allow, timelimit, self._count),
+                "thread_id", order=order)
+
+    def prepare(self, top_searcher, q, context):
+        super(ThreadCollapseCollector, self).prepare(top_searcher, q, context)
+        self.thread_hits = defaultdict(int)
+        self.unthreaded_count = 0
+
+    def _count(self, sub_docnum):
+        thread_id = self.keyer.key_to_name(
+                self.keyer.key_for(self.child.matcher, sub_docnum))
+        if thread_id:
+            self.thread_hits[thread_id] += 1
+        else:
+            self.unthreaded_count += 1
+
+    def count(self):
+        return len(self.thread_hits) + self.unthreaded_count
+
+    def results(self):
+        results = super(ThreadCollapseCollector, self).results()
+        # The results' length is the number of threads
+        results.collector = self
+        results._total = None
+        return results
+
+    def hits(self, thread_id):
+        """The number of matching messages in a thread"""
+        return self.thread_hits.get(thread_id, 1)
+
+
+
+class SearchEngine(SearchBackend):
+
+    # Maximum number of filters kept in the cache for an index generation
+    filter_cache_size = 100
+
+    def __init__(self, *args, **kw):
+        super(SearchEngine, self).__init__(*args, **kw)
+        self._index = None
+        self._version = None
+        self._filter_cache = {}
+        self._filter_cache_key = None
+        self._filter_cache_lock = threading.Lock()
+
+    def _get_schema(self):
+        stem_ana = StemmingAnalyzer()
+        return Schema(
+                # sortable fields are stored in columns, which makes sorting
+                # and faceting on them much faster
+                list_name=ID(stored=True, sortable=True),
+                message_id=ID(stored=True, unique=True),
+                thread_id=ID(stored=True, sortable=True),
+                sender=TEXT(field_boost=1.5),
+                user_id=TEXT,
+                subject=TEXT(field_boost=2.0, analyzer=stem_ana),
+                content=TEXT(analyzer=stem_ana),
+                date=DATETIME(sortable=True),
+                attachments=TEXT,
+                tags=KEYWORD(commas=True, scorable=True),
+                private_list=BOOLEAN(),
+            )
+
+    # Schema versions. Each version is stored as a separate Whoosh index in
+    # the same directory, and the CURRENT file points to the one to use.
+
+    def _get_index_name(self, version):
+        if version == 0:
+            return "MAIN" # Whoosh's default index name
+        return "v%d" % version
+
+    @property
+    def _current_path(self):
+        return os.path.join(self.location, "CURRENT")
+
+    def get_version(self):
+        """Return the schema version of the index in use, or None if there is
+        no index yet."""
+        try:
+            with open(self._current_path) as current_file:
+                return int(current_file.read().strip())
+        except (IOError, ValueError):
+            if exists_in(self.location):
+                return 0
+            return None
+
+    def _set_version(self, version):
+        # Write then rename, other processes must never see a partial file
+        tmp_path = "%s.%d" % (self._current_path, os.getpid())
+        with open(tmp_path, "w") as current_file:
+            current_file.write("%d\n" % version)
+        os.rename(tmp_path, self._current_path)
+
+    def _remove_index_files(self, version):
+        index_name = self._get_index_name(version)
+        prefixes = ("%s_" % index_name, "_%s_" % index_name)
+        for filename in os.listdir(self.location):
+            if filename.startswith(prefixes):
+                os.remove(os.path.join(self.location, filename))
+
+    @property
+    def index(self):
+        version = self.get_version()
+        if self._index is None or version != self._version:
+            # Open the index or switch to the one that has just been built
+            self._index = open_dir(self.location,
+                                   indexname=self._get_index_name(version))
+            self._version = version
+        return self._index
+
+    def _to_index_doc(self, doc, schema):
+        if IMessage.providedBy(doc):
+            doc = email_to_search_doc(doc, self.strip_quoted)
+        # The outdated index used until the upgrade is done may not have all
+        # the fields yet
+        return dict( (key, value) for key, value in doc.items()
+                     if key in schema )
+
+    def _replace_documents(self, writer, documents):
+        # Not update_document(): the message_id field is declared unique, but
+        # a message cross-posted to several lists is indexed once per list.
+        for doc in documents:
+            doc = self._to_index_doc(doc, writer.schema)
+            writer.delete_by_query(And([Term("list_name", doc["list_name"]),
+                                        Term("message_id", doc["message_id"])]))
+            writer.add_document(**doc)
+
+    def add(self, doc):
+        writer = self.index.writer(timeout=WRITER_TIMEOUT)
+        try:
+            writer.add_document(**self._to_index_doc(doc, writer.schema))
+        except Exception:
+            writer.cancel()
+            raise
+        else:
+            writer.commit()
+
+    def update(self, documents):
+        writer = self.index.writer(timeout=WRITER_TIMEOUT)
+        try:
+            self._replace_documents(writer, documents)
+        except Exception:
+            writer.cancel()
+            raise
+        else:
+            writer.commit()
+
+    def _get_new_index(self):
+        """The index being built by an upgrade, or None"""
+        version = self.get_version()
+        indexname = self._get_index_name(SCHEMA_VERSION)
+        if (version is not None and version >= SCHEMA_VERSION) or \
+                not exists_in(self.location, indexname=indexname):
+            return None
+        return open_dir(self.location, indexname=indexname)
+
+    def _delete_from(self, index, list_name, message_id):
+        writer = index.writer(timeout=WRITER_TIMEOUT)
+        try:
+            writer.delete_by_query(And([Term("list_name", list_name),
+                                        Term("message_id", message_id)]))
+        except Exception:
+            writer.cancel()
+            raise
+        else:
+            writer.commit()
+
+    def delete(self, list_name, message_id):
+        if self.get_version() is not None:
+            self._delete_from(self.index, list_name, message_id)
+        new_index = self._get_new_index()
+        if new_index is not None:
+            # waits for the upgrade to write its current batch
+            self._delete_from(new_index, list_name, message_id)
+
+    def _get_filter_docs(self, searcher, query):
+        """
+        Return the set of document numbers matching the query. The sets are
+        cached until the index changes, since the document numbers are only
+        valid for a given generation.
+        """
+        cache_key = (self._version, searcher.reader().generation())
+        with self._filter_cache_lock:
+            if cache_key != self._filter_cache_key \
+                    or len(self._filter_cache) >= self.filter_cache_size:
+                self._filter_cache = {}
+                self._filter_cache_key = cache_key
+            docs = self._filter_cache.get(query)
+        if docs is None:
+            docs = set(searcher.docs_for_query(query))
+            with self._filter_cache_lock:
+                if cache_key == self._filter_cache_key:
+                    self._filter_cache[query] = docs
+        return docs
+
+    def _get_filter(self, searcher, list_names, start, end):
+        if list_names is not None:
+            # One cached set per list, so that they can be reused whatever
+            # the combination of lists the user has access to
+            docs = set().union(*[
+                self._get_filter_docs(searcher, Term("list_name", list_name))
+                for list_name in list_names ])
+        else:
+            # When searching all lists, only the public lists are searched
+            docs = self._get_filter_docs(searcher, Term("private_list", False))
+        if start is not None or end is not None:
+            docs = docs & self._get_filter_docs(searcher,
+                    DateRange("date", start, end, endexcl=True))
+        return docs
+
+    def search(self, query, list_name=None, page=None, limit=10,
+               sortedby=None, reverse=False, start=None, end=None,
+               timeout=None, list_names=None, collapse=None):
+        """
+        If list_names is given, the search is restricted to these lists,
+        private or not. Otherwise, if list_name is None, all public lists are
+        searched.
+
+        If collapse is "thread", only the best message of each thread is
+        returned, with the number of matching messages in the thread in the
+        "hits" key.
+
+        If the search takes more than ``timeout`` seconds (defaults to the
+        engine's timeout), it is stopped and the results found so far are
+        returned, with the "partial" key set to True.
+
+        TODO: Should the searcher be shared?
+        http://pythonhosted.org/Whoosh/threads.html#concurrency
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if page is not None and page < 1:
+            raise ValueError("page must be >= 1")
+        if collapse not in (None, "thread"):
+            raise ValueError("can't collapse on %s" % collapse)
+        if "thread_id" not in self.index.schema:
+            collapse = None # outdated index
+        query_string = query
+        query = MultifieldParser(
+                ["sender", "subject", "content", "attachments"],
+                self.index.schema).parse(query)
+        return_value = {"total": 0, "results": [], "partial": False}
+        start_time = time.time()
+        with self.index.searcher() as searcher:
+            if list_name:
+                list_names = [list_name]
+            results_filter = self._get_filter(searcher, list_names, start, end)
+            if not results_filter:
+                # Whoosh would ignore an empty filter
+                return return_value
+            if collapse:
+                # The collapsing ignores the reverse order of sorted results
+                order = None
+                if sortedby:
+                    order = FieldFacet(sortedby, reverse=reverse)
+                # Skipping low-quality blocks would skip the collapsing too
+                collector = ThreadCollapseCollector(searcher.collector(
+                        limit=limit * (page or 1), sortedby=sortedby,
+                        reverse=reverse, optimize=False), results_filter,
+                        timeout, order)
+            else:
+                collector = searcher.collector(
+                        limit=limit * (page or 1), sortedby=sortedby,
+                        reverse=reverse, filter=results_filter)
+                if timeout:
+                    # Signals can only be used in the main thread
+                    use_alarm = isinstance(threading.current_thread(),
+                                           threading._MainThread)
+                    collector = TimeLimitCollector(collector, timeout,
+                                                   use_alarm=use_alarm)
+            try:
+                searcher.search_with_collector(query, collector)
+            except TimeLimit:
+                return_value["partial"] = True
+            results = collector.results()
+            if page:
+                results = ResultsPage(results, page, limit)
+                return_value["total"] = results.total
+            # http://pythonhosted.org/Whoosh/searching.html#results-object
+            elif collapse or results.has_exact_length():
+                return_value["total"] = len(results)
+            else:
+                return_value["total"] = results.estimated_length()
+            return_value["results"] = [ dict(r) for r in results ]
+            if collapse:
+                for result in return_value["results"]:
+                    result["hits"] = collector.hits(
+                            result.get("thread_id"))
+        logger.debug("Search for %r took %.3f seconds (%d results%s)"
+                     % (query_string, time.time() - start_time,
+                        return_value["total"],
+                        ", partial" if return_value["partial"] else ""))
+        return return_value
+
+    def get_key_terms(self, text, numterms=10):
+        with self.index.searcher() as searcher:
+            return [ term for term, _score in searcher.key_terms_from_text(
+                     "content", text, numterms=numterms) ]
+
+    def optimize(self):
+        return self.index.optimize()
+
+    def add_batch(self, documents):
+        """
+        See http://pythonhosted.org/Whoosh/batch.html
+        """
+        logger.info("Indexing all messages")
+        # Don't use optimizations below, it will eat up lots of memory and can
+        # go as far as preventing forking (OSError), tested on a 3GB VM with
+        # the Fedora archives
+        #writer = self.index.writer(limitmb=256, procs=4, multisegment=True)
+        writer = self.index.writer(multisegment=True)
+        # remove the LRU cache limit from the stemanalyzer
+        for component in writer.schema["content"].analyzer:
+            try:
+                component.cachesize = -1
+                component.clear()
+            except AttributeError:
+                continue
+        try:
+            total = len(documents)
+        except TypeError: # it's a ResultSet
+            total = documents.count()
+        try:
+            for num, doc in enumerate(documents):
+                writer.add_document(**self._to_index_doc(doc, writer.schema))
+                if num % 1000 == 0:
+                    logger.info("...still indexing (%d/%d)..." % (num, total))
+        except Exception:
+            writer.cancel()
+            raise
+        else:
+            writer.commit()
+
+    def needs_upgrade(self):
+        version = self.get_version()
+        return version is None or version < SCHEMA_VERSION
+
+    def _create_new_index(self):
+        previous_version = self.get_version()
+        if previous_version is None:
+            logger.info("Creating the search index")
+        else:
+            logger.info("Upgrading the search index from version %d to %d, "
+                        "the current index will be used until it is done"
+                        % (previous_version, SCHEMA_VERSION))
+        if not os.path.isdir(self.location):
+            os.makedirs(self.location)
+        # Leftovers from an interrupted upgrade
+        self._remove_index_files(SCHEMA_VERSION)
+        return create_in(self.location, self._get_schema(),
+                         indexname=self._get_index_name(SCHEMA_VERSION))
+
+    def _index_batch(self, index, messages):
+        writer = index.writer(timeout=WRITER_TIMEOUT)
+        try:
+            self._replace_documents(writer, messages)
+        except Exception:
+            writer.cancel()
+            raise
+        else:
+            writer.commit()
+
+    def _switch_to(self, index):
+        index.optimize()
+        self._set_version(SCHEMA_VERSION)
+
+    def _remove_old_indexes(self):
+        for old_version in range(SCHEMA_VERSION):
+            self._remove_index_files(old_version)
+        logger.info("The search index is now at version %d" % SCHEMA_VERSION)
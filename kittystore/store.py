@@ -15,10 +15,20 @@ license.
 from __future__ import absolute_import, print_function, unicode_literals
 
 
+from itertools import islice
+from contextlib import contextmanager
+
 from zope.interface import implements
 from mailman.interfaces.messages import IMessageStore
 
+from kittystore import events
 from kittystore.analysis import compute_thread_order_and_depth
+from dogpile.cache.api import NO_VALUE
+
+from kittystore.caching import (versioned_key, get_generations,
+    key_in_generation, get_counters, add_counters, counters_changed,
+    apply_counter_changes, discard_counter_changes)
+from kittystore.search import strip_quotes
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,6 +52,15 @@ class Store(object):
         self.debug = debug
         self.search_index = search_index
         self.settings = settings
+        # events waiting for the commit, see kittystore.events.notify()
+        self.pending_events = []
+        # events to coalesce, see batch_events(), and how many of them were
+        # emitted by committed changes
+        self._event_batch = None
+        self._committed_batch_size = 0
+        # write the events to the outbox table instead of running the
+        # subscribers (set by the backends supporting it)
+        self.outbox = False
 
 
     # IMessageStore methods
@@ -158,16 +177,63 @@ class Store(object):
         if email.date <= thread.starting_email.date:
             raise ValueError("Can't attach emails older than the first "
                              "email in a thread")
+        dates = [email.date, thread.date_active]
+        former_thread = self.get_thread(email.list_name, email.thread_id)
         email.thread_id = thread.thread_id
         email.in_reply_to = thread.starting_email.message_id
         if email.date > thread.date_active:
             thread.date_active = email.date
         compute_thread_order_and_depth(thread)
         self.flush()
+        for changed_thread in (former_thread, thread):
+            if changed_thread is not None:
+                self.refresh_thread_summary(changed_thread)
+        self.refresh_activity(email.list_name, dates)
+
+    def refresh_thread_summary(self, thread):
+        """ Recompute the summary of a thread (its statistics, starting and
+        last emails). Does nothing if the backend does not store it.
+
+        :param thread: The thread to recompute the summary of.
+        """
+        pass
+
+    def get_daily_activity(self, list_name, start, end):
+        """ Return the activity of a list on each day between two dates.
+
+        :param list_name: The name of the mailing list.
+        :param start: A datetime object representing the starting date of
+            the interval to query.
+        :param end: A datetime object representing the ending date of
+            the interval to query.
+        :returns: The list of the daily activity objects (with the day,
+            messages_count, new_threads_count, senders_count and
+            active_threads_count attributes), in day order.
+        """
+        raise NotImplementedError
+
+    def refresh_activity(self, list_name, dates):
+        """ Recompute the daily activity of a list on some days. Does nothing
+        if the backend does not store the daily activity.
+
+        :param list_name: The name of the mailing list.
+        :param dates: The datetime objects of the days to recompute.
+        """
+        pass
+
+    def rebuild_activity(self, list_name=None):
+        """ Recompute the daily activity from the emails and the threads. Does
+        nothing if the backend does not store the daily activity.
+
+        :param list_name: The name of the mailing list to recompute the
+            activity of. If None or not specified, recompute all the lists.
+        """
+        pass
 
 
     def search(self, query, list_name=None, page=None, limit=10,
-               sortedby=None, reverse=False):
+               sortedby=None, reverse=False, start=None, end=None,
+               timeout=None, list_names=None, collapse=None):
         """
         Returns a list of email corresponding to the query string. The
         sender, subject, content and attachment names are searched. If
@@ -182,15 +248,263 @@ class Store(object):
         :param sortedby: the field to sort by. If None or not specified, sort
             by match score.
         :param reverse: reverse the order of the results.
+        :param start: if not None, only return emails sent on or after this
+            datetime.
+        :param end: if not None, only return emails sent before this
+            datetime.
+        :param timeout: the maximum time, in seconds, to spend searching. If
+            it is reached, the results found so far are returned and the
+            "partial" key of the result is set to True.
+        :param list_names: the names of the mailing lists to search in, for
+            example the public lists and the private lists the user is
+            subscribed to. Overrides the default of searching all the public
+            lists.
+        :param collapse: if "thread", only return the best email of each
+            thread. The number of matching emails in each thread is then
+            available in the "hits" list.
         """
         results = self.search_index.search(
                 query, list_name, page, limit, sortedby=sortedby,
-                reverse=reverse)
+                reverse=reverse, start=start, end=end, timeout=timeout,
+                list_names=list_names, collapse=collapse)
+        if collapse:
+            results["hits"] = [ r.get("hits", 1) for r in results["results"] ]
         results["results"] = [ self.get_message_by_id_from_list(
                                     r["list_name"], r["message_id"])
                                for r in results["results"] ]
         return results
 
+    # Maximum number of related threads, and number of emails in a thread
+    # used to find them
+    related_threads_count = 10
+    related_threads_emails = 20
+
+    def get_related_threads(self, list_name, thread_id, limit=5):
+        """
+        Returns the threads of the same list with similar contents. The
+        results are cached until the thread gets a new email.
+
+        :param list_name: The name of the mailing list.
+        :param thread_id: The thread_id of the thread to find similar threads
+            for.
+        :param limit: The number of threads to return (at most
+            related_threads_count).
+        """
+        if self.search_index is None:
+            return []
+        def find_related():
+            thread = self.get_thread(list_name, thread_id)
+            if thread is None:
+                return []
+            text = "\n".join("%s\n%s" % (email.subject,
+                                          strip_quotes(email.content) or "")
+                              for email in islice(thread.emails,
+                                                  self.related_threads_emails))
+            return self.search_index.get_related_threads(text, list_name,
+                    thread_id, self.related_threads_count)
+        # Only store the thread ids, they are small and serializable
+        related_ids = self.db.cache.get_or_create(
+                versioned_key(self.db.cache, "list:%s:thread:%s"
+                              % (list_name, thread_id), "related"),
+                find_related, expiration_time=24*3600)
+        related = [ self.get_thread(list_name, related_id)
+                    for related_id in related_ids[:limit] ]
+        return [ thread for thread in related if thread is not None ]
+
+    # The thread statistics returned by get_thread_stats(), and the ones
+    # invalidated by the thread namespace generation
+    thread_stats = ("emails_count", "participants_count", "likes", "dislikes",
+                    "subject")
+    versioned_thread_stats = ("emails_count", "participants_count")
+
+    def get_thread_stats(self, threads):
+        """
+        Returns the cached statistics of several threads (for example the
+        threads of a listing page) with a single cache query. The missing
+        values are computed with one database query per statistic and cached.
+
+        :param threads: The threads to get the statistics of.
+        :returns: A list of dictionaries, one for each thread in the same
+            order, with the names in thread_stats as keys.
+        """
+        cache = self.db.cache
+        threads = list(threads)
+        namespaces = [ "list:%s:thread:%s" % (thread.list_name,
+                                              thread.thread_id)
+                       for thread in threads ]
+        generations = get_generations(cache, namespaces)
+        keys = []
+        for namespace, generation in zip(namespaces, generations):
+            for name in self.thread_stats:
+                if name in self.versioned_thread_stats:
+                    keys.append(key_in_generation(namespace, generation, name))
+                else:
+                    keys.append(str("%s:%s" % (namespace, name)))
+        values = iter(cache.get_multi(keys))
+        stats = [ dict((name, next(values)) for name in self.thread_stats)
+                  for thread in threads ]
+        to_cache = {}
+        for name_index, name in enumerate(self.thread_stats):
+            missing = [ index for index, thread_stats in enumerate(stats)
+                        if thread_stats[name] is NO_VALUE ]
+            if not missing:
+                continue
+            computed = self._compute_thread_stats(
+                    name, [ threads[index] for index in missing ])
+            for index in missing:
+                value = computed[(threads[index].list_name,
+                                  threads[index].thread_id)]
+                stats[index][name] = value
+                key = keys[index * len(self.thread_stats) + name_index]
+                to_cache[key] = value
+        if to_cache:
+            cache.set_multi(to_cache)
+        return stats
+
+    def _compute_thread_stats(self, name, threads):
+        """
+        Computes a statistic for several threads, see get_thread_stats().
+
+        :returns: A dictionary with (list_name, thread_id) tuples as keys.
+        """
+        raise NotImplementedError
+
+    def get_vote_summaries(self, emails):
+        """
+        Returns the likes and dislikes counts of several emails (for example
+        the emails of a thread or of a page) with a single cache query. The
+        missing counts are computed with a single database query and cached,
+        unless the current transaction has changed them.
+
+        :param emails: The emails to get the vote counts of.
+        :returns: A list of (likes, dislikes) tuples, one for each email in
+            the same order.
+        """
+        cache = self.db.cache
+        emails = list(emails)
+        keys = []
+        for email in emails:
+            for name in ("likes", "dislikes"):
+                keys.append(str("list:%s:email:%s:%s" % (
+                    email.list_name, email.message_id, name)))
+        values = get_counters(cache, keys)
+        summaries = [ tuple(values[index*2:index*2+2])
+                      for index in range(len(emails)) ]
+        changed = set(index for index in range(len(emails))
+                      if counters_changed(self.db, keys[index*2:index*2+2]))
+        missing = [ index for index, summary in enumerate(summaries)
+                    if None in summary or index in changed ]
+        if missing:
+            computed = self._compute_vote_summaries(
+                    [ emails[index] for index in missing ])
+            to_cache = {}
+            for index in missing:
+                summaries[index] = computed.get(
+                        (emails[index].list_name, emails[index].message_id),
+                        (0, 0))
+                if index not in changed:
+                    to_cache.update(zip(keys[index*2:index*2+2],
+                                        summaries[index]))
+            add_counters(cache, to_cache)
+        return summaries
+
+    def _compute_vote_summaries(self, emails):
+        """
+        Computes the vote counts of several emails, see get_vote_summaries().
+
+        :returns: A dictionary with (list_name, message_id) tuples as keys
+            and (likes, dislikes) tuples as values. The emails without any
+            vote may be omitted.
+        """
+        raise NotImplementedError
+
+    def get_vote_counters(self):
+        """
+        Counts all the votes, to reconcile the cached counters (see
+        kittystore.caching.reconcile_counters()).
+
+        :returns: A dictionary with the likes and dislikes counts of the
+            emails, of the threads and of the users in each list, by counter
+            cache key. The counters without any vote are omitted.
+        """
+        raise NotImplementedError
+
+    # Events
+
+    def _notify(self, event):
+        """Emit an event, or add it to the current batch"""
+        if self._event_batch is not None:
+            self._event_batch.append(event)
+        else:
+            events.notify(event)
+
+    @contextmanager
+    def batch_events(self):
+        """
+        Context manager for bulk operations: the events emitted in the block
+        are coalesced into one batch event per list and event type (see
+        kittystore.events.coalesce()), emitted at the end of the block. The
+        events of the rolled back changes are dropped. If the block raises an
+        exception, the uncommitted changes are rolled back and the events of
+        the committed ones are still emitted.
+        """
+        if self._event_batch is not None:
+            yield # already batching
+            return
+        self._event_batch = []
+        self._committed_batch_size = 0
+        try:
+            yield
+            self.flush_events()
+        except Exception:
+            self.rollback()
+            try:
+                self.flush_events()
+                self.commit()
+            except Exception:
+                logger.exception("Could not emit the events of the "
+                                 "committed changes")
+                self.rollback()
+            raise
+        finally:
+            self._event_batch = None
+
+    def flush_events(self):
+        """Emit the batch events of the current batch_events() block"""
+        if not self._event_batch:
+            return
+        batch, self._event_batch = self._event_batch, []
+        self._committed_batch_size = 0
+        for event in events.coalesce(batch):
+            events.notify(event)
+
+    # Event outbox
+
+    def add_to_outbox(self, event):
+        """
+        Write an event to the outbox, in the current transaction. See
+        kittystore.events.process_outbox().
+        """
+        raise NotImplementedError
+
+    def claim_outbox_events(self, limit, lease):
+        """
+        Claim the oldest unclaimed events of the outbox (or the events whose
+        claim has expired) and commit the claim.
+
+        :param limit: The maximum number of events to claim.
+        :param lease: The duration of the claim, in seconds. The events which
+            have not been acknowledged by then can be claimed again.
+        :returns: A list of (event_id, eventclass, detached) tuples, see
+            kittystore.events.NewMessage.detach().
+        """
+        raise NotImplementedError
+
+    def ack_outbox_event(self, event_id):
+        """Remove a processed event from the outbox, in the current
+        transaction."""
+        raise NotImplementedError
+
     # Generic database operations
 
     def flush(self):
@@ -200,10 +514,31 @@ class Store(object):
     def commit(self):
         """Commit transaction to the database."""
         self.db.commit()
+        apply_counter_changes(self.db)
+        if self._event_batch is not None:
+            self._committed_batch_size = len(self._event_batch)
+        pending_events, self.pending_events = self.pending_events, []
+        if events.dispatcher is None:
+            return
+        for eventclass, detached in pending_events:
+            events.dispatcher.dispatch(eventclass, detached)
 
     def close(self):
         """Close the connection."""
         self.db.close()
+        discard_counter_changes(self.db)
+        self._drop_pending_events("closed without a commit")
 
     def rollback(self):
         self.db.rollback()
+        discard_counter_changes(self.db)
+        self._drop_pending_events("rolled back")
+
+    def _drop_pending_events(self, reason):
+        # their changes were not committed, there is nothing to process
+        if self._event_batch:
+            del self._event_batch[self._committed_batch_size:]
+        if self.pending_events:
+            logger.info("Dropping %d events, the transaction was %s"
+                        % (len(self.pending_events), reason))
+        self.pending_events = []
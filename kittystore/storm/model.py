@@ -26,8 +26,11 @@ from mailman.interfaces.archiver import ArchivePolicy
 from mailman.database.types import Enum
 
 from kittystore import events
+from kittystore.caching import (versioned_key, bump_generation,
+    get_or_create_versioned, get_or_create_counters, change_counters)
 from kittystore.utils import get_message_id_hash
-from .utils import get_participants_count_between, get_threads_between
+from .utils import (get_participants_count_between, get_threads_between,
+    get_vote_counts, db_creator)
 from .hack_datetime import DateTime
 
 # pylint: disable-msg=R0902,R0913,R0903
@@ -77,20 +80,22 @@ class List(Storm):
     def recent_participants_count(self):
         store = Store.of(self)
         begin_date, end_date = self.get_recent_dates()
-        return store.cache.get_or_create(
-            str("list:%s:recent_participants_count" % self.name),
-            lambda: get_participants_count_between(store, self.name,
-                                                   begin_date, end_date),
+        name = self.name # don't use self in the background
+        return get_or_create_versioned(store.cache, "list:%s" % name,
+            "recent_participants_count", db_creator(store,
+                lambda s: get_participants_count_between(
+                        s, name, begin_date, end_date)),
             86400)
 
     @property
     def recent_threads_count(self):
         store = Store.of(self)
         begin_date, end_date = self.get_recent_dates()
-        return store.cache.get_or_create(
-            str("list:%s:recent_threads_count" % self.name),
-            lambda: get_threads_between(store, self.name,
-                                        begin_date, end_date).count(),
+        name = self.name # don't use self in the background
+        return get_or_create_versioned(store.cache, "list:%s" % name,
+            "recent_threads_count", db_creator(store,
+                lambda s: get_threads_between(s, name,
+                                              begin_date, end_date).count()),
             86400)
 
     def get_month_activity(self, year, month):
@@ -100,34 +105,44 @@ class List(Storm):
         end_date = end_date.replace(day=1)
         Activity = namedtuple('Activity',
                 ['year', 'month', 'participants_count', 'threads_count'])
-        participants_count = store.cache.get_or_create(
-            str("list:%s:participants_count:%s:%s" % (self.name, year, month)),
-            lambda: get_participants_count_between(store, self.name,
-                                                   begin_date, end_date),
+        name = self.name # don't use self in the background
+        namespace = "list:%s:month:%s:%s" % (name, year, month)
+        participants_count = get_or_create_versioned(store.cache, namespace,
+            "participants_count", db_creator(store,
+                lambda s: get_participants_count_between(
+                        s, name, begin_date, end_date)),
             )
-        threads_count = store.cache.get_or_create(
-            str("list:%s:threads_count:%s:%s" % (self.name, year, month)),
-            lambda: get_threads_between(store, self.name,
-                                        begin_date, end_date).count(),
+        threads_count = get_or_create_versioned(store.cache, namespace,
+            "threads_count", db_creator(store,
+                lambda s: get_threads_between(s, name,
+                                              begin_date, end_date).count()),
             )
         return Activity(year, month, participants_count, threads_count)
 
     @events.subscribe_to(events.NewMessage)
     def on_new_message(event): # will be called unbound (no self as 1st argument)
-        cache = event.store.db.cache
-        l = event.store.get_list(event.mlist.fqdn_listname)
-        # recent activity
-        begin_date = l.get_recent_dates()[0]
-        if event.message.date >= begin_date:
-            cache.delete(str("list:%s:recent_participants_count" % l.name))
-            l.recent_participants_count
-            cache.delete(str("list:%s:recent_threads_count" % l.name))
-            l.recent_threads_count
+        _bump_list_generations(event.store, event.mlist, [event.message])
+
+    @events.subscribe_to(events.NewMessageBatch, replaces=on_new_message)
+    def on_new_message_batch(event):
+        _bump_list_generations(event.store, event.mlist, event.messages)
+
+
+def _bump_list_generations(store, mlist, messages):
+    # the values are recomputed on demand, not on ingestion
+    cache = store.db.cache
+    l = store.get_list(mlist.fqdn_listname)
+    namespaces = set()
+    # recent activity
+    begin_date = l.get_recent_dates()[0]
+    for message in messages:
+        if message.date >= begin_date:
+            namespaces.add("list:%s" % l.name)
         # month activity
-        year, month = event.message.date.year, event.message.date.month
-        cache.delete(str("list:%s:participants_count:%s:%s"
-                         % (l.name, year, month)))
-        l.get_month_activity(year, month)
+        year, month = message.date.year, message.date.month
+        namespaces.add("list:%s:month:%s:%s" % (l.name, year, month))
+    for namespace in namespaces:
+        bump_generation(cache, namespace)
 
 
 class User(Storm):
@@ -167,12 +182,13 @@ class User(Storm):
     def get_votes_in_list(self, list_name):
         store = Store.of(self)
         def getvotes():
-            req = self.votes.find(Vote.list_name == unicode(list_name))
-            likes = req.find(Vote.value == 1).count()
-            dislikes = req.find(Vote.value == -1).count()
-            return likes, dislikes
-        cache_key = str("user:%s:list:%s:votes" % (self.id, list_name))
-        return store.cache.get_or_create(cache_key, getvotes)
+            return get_vote_counts(store, And(
+                    Vote.user_id == self.id,
+                    Vote.list_name == unicode(list_name)))
+        return get_or_create_counters(store, (
+            str("user:%s:list:%s:likes" % (self.id, list_name)),
+            str("user:%s:list:%s:dislikes" % (self.id, list_name)),
+            ), getvotes)
 
 
 class Sender(Storm):
@@ -246,24 +262,27 @@ class Email(Storm):
         self.message_id_hash = unicode(get_message_id_hash(self.message_id))
 
     @property
-    def likes(self):
+    def vote_counts(self):
+        """The likes and dislikes counts, computed and cached together"""
         store = Store.of(self)
-        return store.cache.get_or_create(
+        return get_or_create_counters(store, (
             str("list:%s:email:%s:likes" % (self.list_name, self.message_id)),
-            lambda: self.votes.find(Vote.value == 1).count()
-            )
+            str("list:%s:email:%s:dislikes" % (self.list_name, self.message_id)),
+            ), lambda: get_vote_counts(store, And(
+                    Vote.list_name == self.list_name,
+                    Vote.message_id == self.message_id)))
+
+    @property
+    def likes(self):
+        return self.vote_counts[0]
 
     @property
     def dislikes(self):
-        store = Store.of(self)
-        return store.cache.get_or_create(
-            str("list:%s:email:%s:dislikes" % (self.list_name, self.message_id)),
-            lambda: self.votes.find(Vote.value == -1).count()
-            )
+        return self.vote_counts[1]
 
     @property
     def likestatus(self):
-        likes, dislikes = self.likes, self.dislikes
+        likes, dislikes = self.vote_counts
         # XXX: use an Enum?
         if likes - dislikes >= 10:
             return "likealot"
@@ -279,18 +298,10 @@ class Email(Storm):
             return # Vote already recorded (should I raise an exception?)
         if value not in (0, 1, -1):
             raise ValueError("A vote can only be +1 or -1 (or 0 to cancel)")
-        # The vote can be added, changed or cancelled. Keep it simple and
-        # delete likes and dislikes cached values.
-        store.cache.delete_multi((
-            # this message's (dis)likes count
-            str("list:%s:email:%s:likes" % (self.list_name, self.message_id)),
-            str("list:%s:email:%s:dislikes" % (self.list_name, self.message_id)),
-            # this thread (dis)likes count
-            str("list:%s:thread:%s:likes" % (self.list_name, self.thread_id)),
-            str("list:%s:thread:%s:dislikes" % (self.list_name, self.thread_id)),
-            # the user's vote count on this list
-            str("user:%s:list:%s:votes" % (user_id, self.list_name)),
-            ))
+        # The vote can be added, changed or cancelled.
+        previous = existing.value if existing is not None else 0
+        likes = int(value == 1) - int(previous == 1)
+        dislikes = int(value == -1) - int(previous == -1)
         if existing is not None:
             # vote changed or cancelled
             if value == 0:
@@ -302,6 +313,15 @@ class Email(Storm):
             if store.get(User, user_id) is None:
                 store.add(User(user_id))
             store.add(Vote(self.list_name, self.message_id, user_id, value))
+        # change the cached counts of this message, this thread and the
+        # user's votes on this list, after the commit
+        deltas = {}
+        for prefix in ("list:%s:email:%s" % (self.list_name, self.message_id),
+                       "list:%s:thread:%s" % (self.list_name, self.thread_id),
+                       "user:%s:list:%s" % (user_id, self.list_name)):
+            deltas[str("%s:likes" % prefix)] = likes
+            deltas[str("%s:dislikes" % prefix)] = dislikes
+        change_counters(store, deltas)
 
     def get_vote_by_user_id(self, user_id):
         if user_id is None:
@@ -417,8 +437,9 @@ class Thread(Storm):
     def participants_count(self):
         store = Store.of(self)
         return store.cache.get_or_create(
-            str("list:%s:thread:%s:participants_count"
-                % (self.list_name, self.thread_id)),
+            versioned_key(store.cache, "list:%s:thread:%s"
+                          % (self.list_name, self.thread_id),
+                          "participants_count"),
             lambda: self._get_participants().count())
 
     @property
@@ -456,8 +477,9 @@ class Thread(Storm):
     def emails_count(self):
         store = Store.of(self)
         return store.cache.get_or_create(
-            str("list:%s:thread:%s:emails_count"
-                % (self.list_name, self.thread_id)),
+            versioned_key(store.cache, "list:%s:thread:%s"
+                          % (self.list_name, self.thread_id),
+                          "emails_count"),
             lambda: self.emails.count())
 
     @property
@@ -468,9 +490,8 @@ class Thread(Storm):
                 % (self.list_name, self.thread_id)),
             lambda: self.starting_email.subject)
 
-    def _getvotes(self):
-        store = Store.of(self)
-        return store.find(Vote, And(
+    def _getvotes_conditions(self):
+        return And(
                 Vote.list_name == self.list_name,
                 Vote.message_id == Email.message_id,
                 Email.thread_id == self.thread_id,
@@ -478,27 +499,28 @@ class Thread(Storm):
                 # Vote.list_name selection. See the
                 # test_same_msgid_different_lists unit test.
                 Email.list_name == self.list_name,
-                ))
+                )
 
     @property
-    def likes(self):
+    def vote_counts(self):
+        """The likes and dislikes counts, computed and cached together"""
         store = Store.of(self)
-        return store.cache.get_or_create(
+        return get_or_create_counters(store, (
             str("list:%s:thread:%s:likes" % (self.list_name, self.thread_id)),
-            lambda: self._getvotes().find(Vote.value == 1).count()
-            )
+            str("list:%s:thread:%s:dislikes" % (self.list_name, self.thread_id)),
+            ), lambda: get_vote_counts(store, self._getvotes_conditions()))
+
+    @property
+    def likes(self):
+        return self.vote_counts[0]
 
     @property
     def dislikes(self):
-        store = Store.of(self)
-        return store.cache.get_or_create(
-            str("list:%s:thread:%s:dislikes" % (self.list_name, self.thread_id)),
-            lambda: self._getvotes().find(Vote.value == -1).count()
-            )
+        return self.vote_counts[1]
 
     @property
     def likestatus(self):
-        likes, dislikes = self.likes, self.dislikes
+        likes, dislikes = self.vote_counts
         # XXX: use an Enum?
         if likes - dislikes >= 10:
             return "likealot"
@@ -508,13 +530,16 @@ class Thread(Storm):
 
     @events.subscribe_to(events.NewMessage)
     def on_new_message(event): # will be called unbound (no self as 1st argument)
-        cache = event.store.db.cache
-        cache.delete(str("list:%s:thread:%s:emails_count"
-                         % (event.message.list_name, event.message.thread_id)))
-        event.message.thread.emails_count
-        cache.delete(str("list:%s:thread:%s:participants_count"
-                         % (event.message.list_name, event.message.thread_id)))
-        event.message.thread.participants_count
+        # the counts and the related threads are recomputed on demand
+        bump_generation(event.store.db.cache, "list:%s:thread:%s"
+                        % (event.message.list_name, event.message.thread_id))
+
+    @events.subscribe_to(events.NewMessageBatch, replaces=on_new_message)
+    def on_new_message_batch(event):
+        for thread_key in set((message.list_name, message.thread_id)
+                              for message in event.messages):
+            bump_generation(event.store.db.cache,
+                            "list:%s:thread:%s" % thread_key)
 
     @events.subscribe_to(events.NewThread)
     def on_new_thread(event): # will be called unbound (no self as 1st argument)
@@ -523,6 +548,14 @@ class Thread(Storm):
                     % (event.thread.list_name, event.thread.thread_id)),
                 event.thread.starting_email.subject)
 
+    @events.subscribe_to(events.NewThreadBatch, replaces=on_new_thread)
+    def on_new_thread_batch(event):
+        event.store.db.cache.set_multi(dict(
+                (str("list:%s:thread:%s:subject"
+                     % (thread.list_name, thread.thread_id)),
+                 thread.starting_email.subject)
+                for thread in event.threads))
+
     def __storm_pre_flush__(self):
         """Auto-set the active date from the last email in thread"""
         if self.date_active is not None:
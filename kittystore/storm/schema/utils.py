@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import threading
+
 from storm.locals import StormError
 from storm.schema.schema import Schema as StormSchema
-from storm.schema.patch import PatchApplier
 
 
 def get_db_type(store):
@@ -21,9 +22,21 @@ class CheckingSchema(StormSchema):
         Returns True if the schema needs an upgrade, False otherwise.
         """
         try:
-            store.execute("SELECT * FROM patch WHERE version=0")
+            applied = store.execute("SELECT MAX(version) FROM patch").get_one()
         except StormError:
             return True
-        else:
-            patch_applier = PatchApplier(store, self._patch_package)
-            return patch_applier.has_pending_patches()
+        return (applied[0] or 0) < self.get_latest_patch()
+
+    def get_latest_patch(self):
+        """The version of the last patch in the package, read once per
+        process"""
+        package = self._patch_set._package.__name__
+        with _latest_patches_lock:
+            if package not in _latest_patches:
+                _latest_patches[package] = max(
+                    self._patch_set.get_patch_versions())
+            return _latest_patches[package]
+
+
+_latest_patches = {}
+_latest_patches_lock = threading.Lock()
@@ -19,7 +19,7 @@ from email.utils import unquote
 
 from mailman.interfaces.archiver import ArchivePolicy
 from storm.locals import Desc
-from storm.expr import And, Count, Alias
+from storm.expr import And, Or, Count, Alias
 from dateutil.tz import tzutc
 
 from kittystore import MessageNotFound, events
@@ -29,9 +29,10 @@ from kittystore.utils import header_to_unicode
 from kittystore.scrub import Scrubber
 from kittystore.utils import get_ref_and_thread_id
 from kittystore.analysis import compute_thread_order_and_depth
+from kittystore.caching.mlist import refresh_list_props
 
 from .model import List, Email, Attachment, Thread, Category
-from .model import Sender, User
+from .model import Sender, User, Vote
 
 import logging
 logger = logging.getLogger(__name__)
@@ -52,6 +53,9 @@ class StormStore(Store):
             for propname in l.mailman_props:
                 setattr(l, propname, getattr(mlist, propname))
             self.db.add(l)
+        else:
+            # before the search indexing, which uses the archive_policy
+            refresh_list_props(self, mlist)
         if mlist.archive_policy == ArchivePolicy.never:
             logger.info("Archiving disabled by list policy for %s" % list_name)
             return None
@@ -141,12 +145,10 @@ class StormStore(Store):
             self.add_attachment(list_name, msg_id, *attachment)
         self.flush()
         # invalidate the cache
-        events.notify(events.NewMessage(self, mlist, email))
+        self._notify(events.NewMessage(self, mlist, email))
         if new_thread:
-            events.notify(events.NewThread(self, mlist, thread))
+            self._notify(events.NewThread(self, mlist, thread))
         # search indexing
-        # do it after caching because we need some list properties (like
-        # archive_policy)
         if self.search_index is not None:
             self.search_index.add(email)
 
@@ -166,6 +168,8 @@ class StormStore(Store):
         if len(thread.emails) == 0:
             self.db.remove(thread)
         self.flush()
+        if self.search_index is not None:
+            self.search_index.delete(msg.list_name, msg.message_id)
 
     def get_list_size(self, list_name):
         return self.db.find(Email,
@@ -383,6 +387,102 @@ class StormStore(Store):
             part = part.config(limit=limit)
         return list(part)
 
+    def _compute_thread_stats(self, name, threads):
+        thread_ids = {}
+        for thread in threads:
+            thread_ids.setdefault(thread.list_name, []).append(
+                    thread.thread_id)
+        in_threads = Or(*[ And(Email.list_name == list_name,
+                               Email.thread_id.is_in(ids))
+                           for list_name, ids in thread_ids.iteritems() ])
+        if name == "subject":
+            # the subject of the first email which is not a reply
+            rows = self.db.find(
+                    (Email.list_name, Email.thread_id, Email.subject),
+                    in_threads, Email.in_reply_to == None
+                ).order_by(Email.date)
+            subjects = {}
+            for list_name, thread_id, subject in rows:
+                subjects.setdefault((list_name, thread_id), subject)
+            return dict(((thread.list_name, thread.thread_id),
+                         subjects.get((thread.list_name, thread.thread_id),
+                                      thread.subject))
+                        for thread in threads)
+        if name == "emails_count":
+            count = Count(Email.message_id)
+            conditions = [in_threads]
+        elif name == "participants_count":
+            count = Count(Email.sender_email, distinct=True)
+            conditions = [in_threads]
+        elif name in ("likes", "dislikes"):
+            count = Count(Vote.user_id)
+            conditions = [in_threads,
+                          Vote.list_name == Email.list_name,
+                          Vote.message_id == Email.message_id,
+                          Vote.value == (1 if name == "likes" else -1)]
+        else:
+            raise ValueError("Unknown thread statistic: %s" % name)
+        counts = dict(((list_name, thread_id), value)
+                      for list_name, thread_id, value in self.db.find(
+                            (Email.list_name, Email.thread_id, count),
+                            *conditions
+                        ).group_by(Email.list_name, Email.thread_id))
+        return dict(((thread.list_name, thread.thread_id),
+                     counts.get((thread.list_name, thread.thread_id), 0))
+                    for thread in threads)
+
+    def _compute_vote_summaries(self, emails):
+        message_ids = {}
+        for email in emails:
+            message_ids.setdefault(email.list_name, []).append(
+                    email.message_id)
+        in_emails = Or(*[ And(Vote.list_name == list_name,
+                              Vote.message_id.is_in(ids))
+                          for list_name, ids in message_ids.iteritems() ])
+        summaries = {}
+        for list_name, message_id, value, count in self.db.find(
+                    (Vote.list_name, Vote.message_id, Vote.value,
+                     Count(Vote.user_id)), in_emails
+                ).group_by(Vote.list_name, Vote.message_id, Vote.value):
+            likes, dislikes = summaries.get((list_name, message_id), (0, 0))
+            if value == 1:
+                likes = count
+            elif value == -1:
+                dislikes = count
+            summaries[(list_name, message_id)] = (likes, dislikes)
+        return summaries
+
+    def get_vote_counters(self):
+        counters = {}
+        def add_counts(prefix, value, count):
+            for key in ("likes", "dislikes"):
+                counters.setdefault(str("%s:%s" % (prefix, key)), 0)
+            if value == 1:
+                counters[str("%s:likes" % prefix)] = count
+            elif value == -1:
+                counters[str("%s:dislikes" % prefix)] = count
+        for list_name, message_id, value, count in self.db.find(
+                    (Vote.list_name, Vote.message_id, Vote.value,
+                     Count(Vote.user_id))
+                ).group_by(Vote.list_name, Vote.message_id, Vote.value):
+            add_counts("list:%s:email:%s" % (list_name, message_id),
+                       value, count)
+        for list_name, thread_id, value, count in self.db.find(
+                    (Email.list_name, Email.thread_id, Vote.value,
+                     Count(Vote.user_id)),
+                    Vote.list_name == Email.list_name,
+                    Vote.message_id == Email.message_id,
+                ).group_by(Email.list_name, Email.thread_id, Vote.value):
+            add_counts("list:%s:thread:%s" % (list_name, thread_id),
+                       value, count)
+        for user_id, list_name, value, count in self.db.find(
+                    (Vote.user_id, Vote.list_name, Vote.value,
+                     Count(Vote.user_id))
+                ).group_by(Vote.user_id, Vote.list_name, Vote.value):
+            add_counts("user:%s:list:%s" % (user_id, list_name),
+                       value, count)
+        return counters
+
 
     def get_categories(self):
         """ Return the list of available categories
@@ -419,6 +519,10 @@ class StormStore(Store):
             self.db.add(sender)
         sender.user_id = user_id
 
+    def get_sender(self, email):
+        """ Returns the Sender object for an email address """
+        return self.db.get(Sender, unicode(email))
+
     def get_sender_name(self, user_id):
         """ Returns a user's fullname when given his user_id """
         result = self.db.find(Sender.name,
@@ -426,8 +530,11 @@ class StormStore(Store):
                     ).config(limit=1).one()
         return result
 
-    def get_senders_without_user(self, limit=None):
-        q = self.db.find(Sender, Sender.user_id == None)
+    def get_senders_without_user(self, limit=None, after=None):
+        clauses = [Sender.user_id == None]
+        if after is not None:
+            clauses.append(Sender.email > after)
+        q = self.db.find(Sender, And(*clauses)).order_by(Sender.email)
         if limit:
             q = q[:limit]
         return q
@@ -463,8 +570,26 @@ class StormStore(Store):
             clause = And(clause, Thread.list_name == unicode(list_name))
         return self.db.find(Thread, clause).config(distinct=True)
 
-    def get_all_messages(self):
-        return self.db.find(Email).order_by(Email.archived_date)
+    def get_all_messages(self, after=None, limit=None):
+        """
+        Return the messages in archival order. ``after`` is the
+        (archived_date, list_name, message_id) key of a message, to only
+        return the messages following it (keyset pagination).
+        """
+        clauses = []
+        if after is not None:
+            date, list_name, message_id = after
+            clauses.append(Or(
+                Email.archived_date > date,
+                And(Email.archived_date == date, Or(
+                    Email.list_name > unicode(list_name),
+                    And(Email.list_name == unicode(list_name),
+                        Email.message_id > unicode(message_id))))))
+        q = self.db.find(Email, *clauses).order_by(
+                Email.archived_date, Email.list_name, Email.message_id)
+        if limit:
+            q = q[:limit]
+        return q
 
     def get_message_dates(self, list_name, start, end):
         """ Return all email dates between two given dates.
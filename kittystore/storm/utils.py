@@ -18,21 +18,23 @@ license.
 from __future__ import absolute_import
 
 from storm.locals import And, Store
+from storm.expr import Count
 from dogpile.cache import make_region
 
+from kittystore.caching import DatabaseCreator
+
 
 def get_participants_count_between(store, list_name, begin_date, end_date):
         from .model import Email
         # We filter on emails dates instead of threads dates because that would
         # also include last month's participants when threads carry from one
         # month to the next
-        result = store.find(Email.sender_email, And(
+        result = store.find(Email, And(
                         Email.list_name == list_name,
                         Email.date >= begin_date,
                         Email.date < end_date,
-                        )).config(distinct=True)
-        #return result.count() # generates a sub-query
-        return len(list(result))
+                        ))
+        return result.count(Email.sender_email, distinct=True)
 
 def get_threads_between(store, list_name, begin_date, end_date):
         from .model import Thread
@@ -42,6 +44,24 @@ def get_threads_between(store, list_name, begin_date, end_date):
                     Thread.date_active < end_date,
                 ))
 
+def get_vote_counts(store, conditions):
+        """
+        Returns the likes and dislikes counts of the votes matching the
+        conditions, with a single database query.
+        """
+        from .model import Vote
+        counts = dict(store.find((Vote.value, Count(Vote.user_id)), conditions
+                        ).group_by(Vote.value))
+        return counts.get(1, 0), counts.get(-1, 0)
+
+def db_creator(store, query):
+    """
+    Returns a cache value creator calling the query function with a database
+    store (see kittystore.caching.DatabaseCreator).
+    """
+    return DatabaseCreator(query, store,
+                           lambda: Store(store.get_database()))
+
 
 class StoreWithCache(Store):
     """A storm store with an attribute to store the cache region"""
@@ -5,17 +5,31 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import os
+import json
+import time
 import unittest
 import datetime
 import uuid
-from urllib2 import HTTPError
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from urllib import unquote
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
-from mock import Mock
+import mailmanclient
+from mock import Mock, patch
+from dogpile.cache import make_region, register_backend
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.backends.memcached import GenericMemcachedBackend
 from mailman.email.message import Message
 from mailman.interfaces.archiver import ArchivePolicy
 
-from kittystore import get_store
-from kittystore.caching import mailman_user
+from kittystore import get_store, setup_mailman_resolver
+from kittystore import caching
+from kittystore.caching import mailman_user, mlist
+from kittystore.caching.local import LRUCache, LocalCacheProxy
 from kittystore.test import FakeList, SettingsModule
 
 
@@ -53,6 +67,54 @@ class ListCacheTestCase(unittest.TestCase):
         self.assertEqual(ml_db.description, "desc 2")
         self.assertEqual(ml_db.archive_policy, ArchivePolicy.private)
 
+    def test_unchanged_properties_not_written(self):
+        # the list row is not modified by each new message
+        ml = FakeList("example-list")
+        ml.display_name = u"name 1"
+        for num in range(3):
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<dummy%d>" % num
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+            if num > 0:
+                self.assertFalse(self.store.get_list("example-list")
+                                 in self.store.db.dirty)
+            self.store.commit()
+        # a change is still written
+        ml.display_name = u"name 2"
+        msg.replace_header("Message-ID", "<dummy3>")
+        self.store.add_to_list(ml, msg)
+        self.store.commit()
+        self.assertEqual(self.store.get_lists()[0].display_name, "name 2")
+
+    def test_sync_list_properties(self):
+        for name in ("list1", "list2"):
+            ml = FakeList(name)
+            ml.display_name = name
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<dummy-%s>" % name
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+        created_at = self.store.get_list("list1").created_at
+        class MMList(object):
+            def __init__(self, name):
+                self.display_name = name
+                self.description = None
+                self.subject_prefix = None
+                self.settings = {"archive_policy": "public",
+                                 "created_at": created_at.isoformat()}
+        mm_lists = {"list1": MMList("list1"), "list2": MMList("changed")}
+        mm_client = Mock()
+        mm_client.get_list.side_effect = mm_lists.get
+        with patch("kittystore.caching.mlist.get_mailman_client",
+                   return_value=mm_client):
+            mlist.sync_list_properties(self.store)
+        self.assertEqual(mm_client.get_list.call_count, 2)
+        self.assertFalse(self.store.get_list("list1") in self.store.db.dirty)
+        self.assertEqual(self.store.get_list("list2").display_name, "changed")
+
     def test_on_old_message(self):
         olddate = datetime.datetime.utcnow() - datetime.timedelta(days=40)
         ml = FakeList("example-list")
@@ -66,80 +128,488 @@ class ListCacheTestCase(unittest.TestCase):
         self.assertEqual(ml_db.recent_participants_count, 0)
         self.assertEqual(ml_db.recent_threads_count, 0)
 
+    def test_counts_on_new_message(self):
+        # the cached counts are recomputed on the next read
+        ml = FakeList("example-list")
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<dummy>"
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(ml, msg)
+        ml_db = self.store.get_lists()[0]
+        thread = self.store.get_message_by_id_from_list(
+                "example-list", "dummy").thread
+        self.assertEqual(ml_db.recent_participants_count, 1)
+        self.assertEqual(ml_db.recent_threads_count, 1)
+        self.assertEqual(thread.emails_count, 1)
+        self.assertEqual(thread.participants_count, 1)
+        msg.replace_header("From", "dummy2@example.com")
+        msg.replace_header("Message-ID", "<dummy2>")
+        msg["In-Reply-To"] = "<dummy>"
+        self.store.add_to_list(ml, msg)
+        self.assertEqual(ml_db.recent_participants_count, 2)
+        self.assertEqual(ml_db.recent_threads_count, 1)
+        self.assertEqual(thread.emails_count, 2)
+        self.assertEqual(thread.participants_count, 2)
 
 
-class FakeMMUser(object):
-    user_id = None
+class GenerationTestCase(unittest.TestCase):
 
-class UserIdCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = get_store(SettingsModule(), auto_create=True)
+        self.cache = self.store.db.cache
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_versioned_key(self):
+        key = caching.versioned_key(self.cache, "ns", "value")
+        self.assertEqual(key, caching.versioned_key(self.cache, "ns", "value"))
+        caching.bump_generation(self.cache, "ns")
+        self.assertNotEqual(
+            key, caching.versioned_key(self.cache, "ns", "value"))
+
+    def test_evicted_generation(self):
+        # an evicted generation must not bring back older values
+        key = caching.versioned_key(self.cache, "ns", "value")
+        caching.bump_generation(self.cache, "ns")
+        self.cache.delete("ns:generation")
+        self.assertNotEqual(
+            key, caching.versioned_key(self.cache, "ns", "value"))
+
+
+class AsyncCreationTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.store = get_store(SettingsModule(), auto_create=True)#, debug=True)
-        self.mm_client = Mock()
-        mailman_user._MAILMAN_CLIENT = self.mm_client
-        self.mm_client.get_user.side_effect = HTTPError(
-                None, 404, "dummy", {}, None)
+        # the background threads can't access an in-memory database
+        self.tmpdir = mkdtemp(prefix="kittystore-testing-")
+        settings = SettingsModule()
+        settings.KITTYSTORE_URL = "sqlite:///%s" % os.path.join(
+                self.tmpdir, "kittystore.sqlite")
+        self.store = get_store(settings, auto_create=True)
 
     def tearDown(self):
         self.store.close()
-        mailman_user._MAILMAN_CLIENT = None
+        rmtree(self.tmpdir)
 
-    def test_on_new_message_userid(self):
-        # Check that the user_id is set on a new message
+    def _add_message(self, num):
         msg = Message()
-        msg["From"] = "dummy@example.com"
-        msg["Message-ID"] = "<dummy>"
+        msg["From"] = "dummy%d@example.com" % num
+        msg["Message-ID"] = "<dummy%d>" % num
         msg.set_payload("Dummy message")
-        # setup Mailman's reply
-        new_user_id = FakeMMUser()
-        uid = uuid.uuid1()
-        new_user_id.user_id = uid.int
-        self.mm_client.get_user.side_effect = lambda addr: new_user_id
-        # check the User does not exist yet
-        self.assertEqual(0,
-                self.store.get_message_count_by_user_id(uid))
-        # do the test and check
         self.store.add_to_list(FakeList("example-list"), msg)
-        dbmsg = self.store.get_message_by_id_from_list(
-                "example-list", "dummy")
-        self.assertEqual(dbmsg.sender.user_id, uid)
-        self.assertTrue(dbmsg.sender.user is not None,
-                "A 'User' instance was not created")
-        self.assertEqual(dbmsg.sender.user.id, uid)
-        self.assertEqual(1,
-                self.store.get_message_count_by_user_id(uid))
-        self.assertEqual(self.store.get_users_count(), 1)
+        self.store.commit()
+
+    def _wait_for(self, getter, value):
+        for _i in range(50):
+            if getter() == value:
+                return
+            time.sleep(0.1)
+        self.fail("the value has not been regenerated")
+
+    def test_runner(self):
+        self.assertTrue(isinstance(self.store.db.cache.async_creation_runner,
+                                   caching.AsyncCreationRunner))
+
+    def test_stale_while_revalidate(self):
+        self._add_message(1)
+        ml_db = self.store.get_lists()[0]
+        self.assertEqual(ml_db.recent_participants_count, 1)
+        self._add_message(2)
+        # the previous value is served while the new one is computed
+        self.assertEqual(ml_db.recent_participants_count, 1)
+        self._wait_for(lambda: ml_db.recent_participants_count, 2)
+
+    def test_versioned_mutex(self):
+        # the background creation holds the backend's lock if it has one
+        cache = self.store.db.cache
+        caching.get_or_create_versioned(cache, "ns", "value",
+                caching.DatabaseCreator(lambda s: 1, None, None))
+        caching.bump_generation(cache, "ns")
+        mutex = Mock()
+        mutex.acquire.return_value = False # already being created
+        creator = caching.DatabaseCreator(lambda s: 2, None, None)
+        with patch.object(cache.backend, "get_mutex", return_value=mutex):
+            self.assertEqual(caching.get_or_create_versioned(
+                    cache, "ns", "value", creator), 1)
+        mutex.acquire.assert_called_once_with(False)
+        # otherwise a lock of the process is used
+        self.assertEqual(cache.backend.get_mutex("dummy"), None)
+        lock = caching._get_mutex(cache, "dummy")
+        self.assertTrue(lock.acquire(False))
+        self.assertFalse(caching._get_mutex(cache, "dummy").acquire(False))
+        lock.release()
+
+    def test_creator_sessions(self):
+        sessions = []
+        new_session = Mock()
+        creator = caching.DatabaseCreator(sessions.append, "caller",
+                                          lambda: new_session)
+        creator()
+        creator.in_new_session()
+        self.assertEqual(sessions, ["caller", new_session])
+        self.assertTrue(new_session.close.called)
+
+class LocalCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.local = LRUCache(60, 3)
+        self.cache = make_region().configure("dogpile.cache.memory",
+                wrap=[LocalCacheProxy(self.local)])
+        # the shared backend
+        self.shared = self.cache.backend.proxied
+
+    def test_local_read(self):
+        self.cache.set("key", "value")
+        # changed by another process
+        self.shared.delete("key")
+        self.assertEqual(self.cache.get("key"), "value")
+        self.cache.delete("key")
+        self.assertEqual(self.cache.get("key"), NO_VALUE)
+
+    def test_shared_read(self):
+        self.shared.set("key", self.cache._value("value"))
+        self.assertEqual(self.cache.get("key"), "value")
+        self.assertEqual(len(self.local), 1)
+
+    def test_ttl(self):
+        self.local.ttl = -1
+        self.cache.set("key", "value")
+        self.shared.delete("key")
+        self.assertEqual(self.cache.get("key"), NO_VALUE)
+
+    def test_size(self):
+        for num in range(5):
+            self.cache.set("key%d" % num, num)
+        self.assertEqual(len(self.local), 3)
+        self.shared.delete_multi(["key%d" % num for num in range(5)])
+        self.assertEqual(self.cache.get_multi(["key0", "key4"]),
+                         [NO_VALUE, 4])
+
+    def test_generation(self):
+        # a new generation is seen immediately in this process
+        key = caching.versioned_key(self.cache, "ns", "value")
+        self.cache.set(key, 1)
+        caching.bump_generation(self.cache, "ns")
+        self.assertEqual(self.cache.get(
+            caching.versioned_key(self.cache, "ns", "value")), NO_VALUE)
+
+
+class FakeMemcachedClient(object):
+    """The calls of python-memcached's client used by the counters"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get_multi(self, keys):
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def add(self, key, value, time=0):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+        return True
+
+    def incr(self, key, delta=1):
+        if key not in self.data:
+            return None
+        self.data[key] += delta
+        return self.data[key]
+
+    def decr(self, key, delta=1):
+        if key not in self.data:
+            return None
+        self.data[key] = max(self.data[key] - delta, 0)
+        return self.data[key]
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeMemcachedBackend(GenericMemcachedBackend):
+
+    def _imports(self):
+        pass
+
+    def _create_client(self):
+        return self.fake_client
 
-    def test_on_new_message_no_reply_from_mailman(self):
-        # Check that the user_id is set on a new message
+register_backend("kittystore.test.memcached", __name__, "FakeMemcachedBackend")
+
+
+class CountersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.local = LRUCache(60, 100)
+        self.cache = make_region().configure("dogpile.cache.memory",
+                wrap=[LocalCacheProxy(self.local)])
+        self.db = Mock(spec=["cache"])
+        self.db.cache = self.cache
+
+    def test_raw_integers(self):
+        # the counters are not stored in the local tier, nor pickled
+        caching.add_counters(self.cache, {"likes": 2})
+        self.assertEqual(self.cache.backend.proxied.get("likes"), 2)
+        self.assertEqual(len(self.local), 0)
+        self.assertEqual(caching.get_counters(self.cache,
+                         ["likes", "dislikes"]), [2, None])
+        # a value of a previous version is recounted
+        self.cache.set("dislikes", 1)
+        self.assertEqual(caching.get_counters(self.cache, ["dislikes"]),
+                         [None])
+
+    def test_add(self):
+        # recounted by another process in the meantime
+        caching.add_counters(self.cache, {"likes": 2})
+        caching.add_counters(self.cache, {"likes": 1})
+        self.assertEqual(caching.get_counters(self.cache, ["likes"]), [2])
+        caching.set_counters(self.cache, {"likes": 1})
+        self.assertEqual(caching.get_counters(self.cache, ["likes"]), [1])
+
+    def test_incr(self):
+        caching.add_counters(self.cache, {"likes": 2, "dislikes": 0})
+        caching.incr_counters(self.cache,
+                              {"likes": -1, "dislikes": -1, "missing": 1})
+        self.assertEqual(caching.get_counters(self.cache,
+                         ["likes", "dislikes", "missing"]), [1, 0, None])
+
+    def test_changes(self):
+        caching.add_counters(self.cache, {"likes": 2, "dislikes": 0})
+        caching.change_counters(self.db, {"likes": 1, "dislikes": 1})
+        caching.change_counters(self.db, {"dislikes": -1})
+        self.assertTrue(caching.counters_changed(self.db, ["likes"]))
+        self.assertFalse(caching.counters_changed(self.db, ["dislikes"]))
+        # recounted until the commit
+        self.assertEqual(caching.get_or_create_counters(self.db,
+                ["likes", "dislikes"], lambda: (3, 0)), (3, 0))
+        self.assertEqual(caching.get_counters(self.cache, ["likes"]), [2])
+        caching.apply_counter_changes(self.db)
+        self.assertEqual(caching.get_or_create_counters(self.db,
+                ["likes", "dislikes"], lambda: (0, 0)), (3, 0))
+        # the changes of a rolled back transaction are dropped
+        caching.change_counters(self.db, {"likes": 1})
+        caching.discard_counter_changes(self.db)
+        caching.apply_counter_changes(self.db)
+        self.assertEqual(caching.get_counters(self.cache, ["likes"]), [3])
+
+    def test_memcached(self):
+        cache = make_region().configure("kittystore.test.memcached",
+                arguments={"url": "127.0.0.1"},
+                wrap=[LocalCacheProxy(self.local)])
+        client = cache.backend.proxied.fake_client = FakeMemcachedClient()
+        caching.add_counters(cache, {"likes": 2, "dislikes": 1})
+        self.assertEqual(client.data, {"likes": 2, "dislikes": 1})
+        caching.incr_counters(cache, {"likes": 1, "dislikes": -2})
+        self.assertEqual(caching.get_counters(cache,
+                         ["likes", "dislikes", "missing"]), [3, 0, None])
+        caching.set_counters(cache, {"likes": 1})
+        self.assertEqual(client.data["likes"], 1)
+        self.assertEqual(len(self.local), 0)
+        # not an integer
+        client.incr = Mock(side_effect=ValueError)
+        caching.incr_counters(cache, {"likes": 1})
+        self.assertFalse("likes" in client.data)
+
+    def test_unsupported_backend(self):
+        # the counters are recounted on each read
+        cache = make_region().configure("dogpile.cache.null")
+        self.db.cache = cache
+        caching.add_counters(cache, {"likes": 2})
+        self.assertEqual(caching.get_or_create_counters(self.db,
+                ["likes"], lambda: (3, )), (3, ))
+
+class FakeMailmanHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        prefix = "/3.0/users/"
+        user_id = None
+        if self.path.startswith(prefix):
+            user_id = self.server.users.get(
+                    unquote(self.path[len(prefix):]).decode("utf-8"))
+        if user_id is None:
+            code, content = 404, b"404 Not Found"
+        else:
+            code, content = 200, json.dumps({"user_id": user_id.int})
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeMailmanServer(ThreadingMixIn, HTTPServer):
+    """A local server replying to the Mailman REST API's user lookups"""
+
+    daemon_threads = True
+
+    def __init__(self, users):
+        HTTPServer.__init__(self, (b"127.0.0.1", 0), FakeMailmanHandler)
+        self.users = users
+        self.requests = []
+        self.connections = 0
+
+    def verify_request(self, request, client_address):
+        self.connections += 1
+        return True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+
+class MailmanUserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.users = {}
+        self.server = FakeMailmanServer(self.users)
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        settings = SettingsModule()
+        settings.MAILMAN_REST_SERVER = self.server.url
+        self.store = get_store(settings, auto_create=True)
+        self.pending = mailman_user.defer_lookups(settings)
+        self.pending.clear()
+
+    def tearDown(self):
+        self.store.close()
+        mailman_user._pending.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _add_message(self, sender, num):
         msg = Message()
-        msg["From"] = "dummy@example.com"
-        msg["Message-ID"] = "<dummy>"
+        msg["From"] = sender
+        msg["Message-ID"] = "<dummy%d>" % num
         msg.set_payload("Dummy message")
         self.store.add_to_list(FakeList("example-list"), msg)
-        dbmsg = self.store.get_message_by_id_from_list(
-                "example-list", "dummy")
+        return self.store.get_message_by_id_from_list(
+                "example-list", "dummy%d" % num)
+
+    def test_on_new_message(self):
+        # The sender is queued, Mailman is not queried while archiving
+        dbmsg = self._add_message("dummy@example.com", 1)
+        self.assertEqual(self.server.requests, [])
         self.assertEqual(dbmsg.sender.user_id, None)
+        self.assertTrue("dummy@example.com" in self.pending)
+
+    def test_pending_by_database(self):
+        # the addresses are looked up with a store of their database
+        other_settings = SettingsModule()
+        other_settings.KITTYSTORE_URL = "sqlite:///other.sqlite"
+        other_pending = mailman_user.defer_lookups(other_settings)
+        self.assertFalse(other_pending is self.pending)
+        self.assertTrue(mailman_user.get_pending(self.store.settings)
+                        is self.pending)
+        self._add_message("dummy@example.com", 1)
+        self.assertEqual(len(self.pending), 1)
+        self.assertEqual(len(other_pending), 0)
+
+    def test_on_new_message_coalesced(self):
+        for num in range(3):
+            self._add_message("dummy@example.com", num)
+        self._add_message("other@example.com", 3)
+        self.assertEqual(len(self.pending), 2)
+
+    def test_on_new_message_unknown_address(self):
+        # Addresses unknown to Mailman are not queued again
+        mailman_user.set_unknown_addresses(self.store, ["dummy@example.com"])
+        self._add_message("dummy@example.com", 1)
+        self.assertEqual(len(self.pending), 0)
+
+    def test_process_pending(self):
+        self.store.search_index = Mock()
+        dbmsg = self._add_message("dummy@example.com", 1)
+        self._add_message("unknown@example.com", 2)
+        uid = uuid.uuid1()
+        self.users["dummy@example.com"] = uid
+        self.assertEqual(mailman_user.process_pending(self.store), 1)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(self.pending), 0)
+        self.assertEqual(dbmsg.sender.user_id, uid)
+        self.assertEqual(dbmsg.sender.user.id, uid)
+        # the message is re-indexed with the user_id
+        self.store.search_index.update.assert_called_with([dbmsg])
+        self.assertEqual(mailman_user.filter_unknown_addresses(
+                self.store, ["dummy@example.com", "unknown@example.com"]),
+                ["dummy@example.com"])
+
+    def test_process_pending_mailman_unreachable(self):
+        self._add_message("dummy@example.com", 1)
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertRaises(mailmanclient.MailmanConnectionError,
+                          mailman_user.process_pending, self.store)
+        # queued again for the next try
+        self.assertTrue("dummy@example.com" in self.pending)
+
+    def test_inline_lookup(self):
+        # Without a resolver thread, the sender is looked up while archiving
+        mailman_user._pending.clear()
+        uid = uuid.uuid1()
+        self.users["dummy@example.com"] = uid
+        dbmsg = self._add_message("dummy@example.com", 1)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(dbmsg.sender.user_id, uid)
+        self._add_message("unknown@example.com", 2)
+        self.assertEqual(mailman_user.filter_unknown_addresses(
+                self.store, ["unknown@example.com"]), [])
+
+    def test_inline_lookup_mailman_unreachable(self):
+        mailman_user._pending.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        dbmsg = self._add_message("dummy@example.com", 1) # should not raise
+        self.assertEqual(dbmsg.sender.user_id, None)
+
+    def test_resolver_drained_on_stop(self):
+        tmpdir = mkdtemp(prefix="kittystore-testing-")
+        settings = SettingsModule()
+        settings.MAILMAN_REST_SERVER = self.server.url
+        settings.KITTYSTORE_URL = "sqlite:///%s" % os.path.join(
+                tmpdir, "kittystore.sqlite")
+        settings.KITTYSTORE_MAILMAN_LOOKUP_DELAY = 3600
+        uid = uuid.uuid1()
+        self.users["dummy@example.com"] = uid
+        store = get_store(settings, auto_create=True)
+        try:
+            setup_mailman_resolver(settings)
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<dummy>"
+            msg.set_payload("Dummy message")
+            store.add_to_list(FakeList("example-list"), msg)
+            store.commit()
+            self.assertTrue("dummy@example.com" in
+                            mailman_user.get_pending(settings))
+            # the queue is processed without waiting for the delay
+            mailman_user.stop_resolvers()
+            self.assertEqual(mailman_user.get_pending(settings), None)
+            store.rollback() # new transaction
+            self.assertEqual(store.get_sender("dummy@example.com").user_id,
+                             uid)
+        finally:
+            mailman_user.stop_resolvers()
+            store.close()
+            rmtree(tmpdir)
 
     def test_sync_mailman_user(self):
         # Check that the user_id is set when sync_mailman_user is run
-        msg = Message()
-        msg["From"] = "dummy@example.com"
-        msg["Message-ID"] = "<dummy>"
-        msg.set_payload("Dummy message")
-        self.store.add_to_list(FakeList("example-list"), msg)
-        dbmsg = self.store.get_message_by_id_from_list(
-                "example-list", "dummy")
+        dbmsg = self._add_message("dummy@example.com", 1)
         self.assertEqual(dbmsg.sender.user_id, None)
-        # setup Mailman's reply
         uid = uuid.uuid1()
-        new_user_id = FakeMMUser()
-        new_user_id.user_id = uid.int
-        self.mm_client.get_user.side_effect = lambda addr: new_user_id
-        # do the test and check
+        self.users["dummy@example.com"] = uid
         mailman_user.sync_mailman_user(self.store)
-        #dbmsg = self.store.get_message_by_id_from_list(
-        #        "example-list", "dummy")
         self.assertEqual(dbmsg.sender.user_id, uid)
         self.assertTrue(dbmsg.sender.user is not None,
                 "A 'User' instance was not created")
@@ -147,17 +617,40 @@ class UserIdCacheTestCase(unittest.TestCase):
         self.assertEqual(1,
                 self.store.get_message_count_by_user_id(uid))
 
-    def test_on_new_message_bad_reply_from_mailman(self):
-        # Check that errors from mailmanclient are handled gracefully
-        self.mm_client.get_user.side_effect = ValueError
-        msg = Message()
-        msg["From"] = "dummy@example.com"
-        msg["Message-ID"] = "<dummy>"
-        msg.set_payload("Dummy message")
+    def test_sync_several_chunks(self):
+        uids = {}
+        for num in range(7):
+            sender = "dummy%d@example.com" % num
+            self._add_message(sender, num)
+            if num % 2 == 0:
+                uids[sender] = self.users[sender] = uuid.uuid1()
+        resolver = mailman_user.MailmanUserResolver(
+                self.store.settings, workers=2)
         try:
-            self.store.add_to_list(FakeList("example-list"), msg)
-        except ValueError, e:
-            self.fail("Errors from mailmanclient should be handled gracefully")
-        dbmsg = self.store.get_message_by_id_from_list(
-                "example-list", "dummy")
-        self.assertEqual(dbmsg.sender.user_id, None)
+            mailman_user.sync_mailman_user(self.store, resolver, chunk_size=3)
+        finally:
+            resolver.close()
+        self.assertEqual(len(self.server.requests), 7)
+        # the connections are re-used by the pool threads
+        self.assertTrue(self.server.connections <= 2)
+        for sender, uid in uids.items():
+            self.assertEqual(self.store.get_message_count_by_user_id(uid), 1)
+        self.assertEqual(self.store.get_senders_without_user().count(), 3)
+
+    def test_unknown_addresses_cached(self):
+        # Addresses unknown to Mailman are not looked up again
+        self._add_message("dummy@example.com", 1)
+        mailman_user.sync_mailman_user(self.store)
+        self.assertEqual(len(self.server.requests), 1)
+        mailman_user.sync_mailman_user(self.store)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.store.get_senders_without_user().count(), 1)
+
+    def test_mailman_unreachable(self):
+        self._add_message("dummy@example.com", 1)
+        self.server.shutdown()
+        self.server.server_close()
+        mailman_user.sync_mailman_user(self.store) # should not raise
+        self.assertEqual(self.store.get_senders_without_user().count(), 1)
+        self.assertEqual(mailman_user.filter_unknown_addresses(
+                self.store, ["dummy@example.com"]), ["dummy@example.com"])
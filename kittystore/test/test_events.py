@@ -8,13 +8,20 @@ from __future__ import absolute_import, print_function, unicode_literals
 import unittest
 import datetime
 
-from mock import Mock
+from mock import Mock, patch
 
 from kittystore import events
+from kittystore.caching import register_events
 
 
 class TestNotify(unittest.TestCase):
 
+    def test_register_events_once(self):
+        register_events()
+        with patch("kittystore.caching.resource_listdir") as listdir:
+            register_events()
+        self.assertFalse(listdir.called)
+
     def test_notify(self):
         class Event: pass
         dummy = []
@@ -44,6 +51,7 @@ class TestNotify(unittest.TestCase):
 
 
 from mailman.email.message import Message
+from mailman.interfaces.archiver import ArchivePolicy
 from kittystore.sa import get_sa_store
 from kittystore.test import FakeList, SettingsModule
 
@@ -67,28 +75,20 @@ class TestNotifyStore(unittest.TestCase):
         msg.set_payload("Dummy message")
         today = datetime.datetime.utcnow().date() # don't use datetime.date.today(), we need UTC
         self.store.add_to_list(FakeList("example-list"), msg)
-        # calls to cache.delete() -- invalidation
-        delete_args = [ call[0][0] for call in
-                        self.store.db.cache.delete.call_args_list ]
-        #from pprint import pprint; pprint(delete_args)
-        self.assertEqual(set(delete_args), set([
-            u'list:example-list:recent_participants_count',
-            u'list:example-list:recent_threads_count',
-            u'list:example-list:participants_count:%d:%d' % (today.year, today.month),
-            u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:emails_count',
-            u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:participants_count'
-            ]))
-        # calls to cache.get_or_create() -- repopulation
+        # calls to cache.set() -- invalidation of the versioned namespaces
+        set_args = [ call[0][0] for call in
+                     self.store.db.cache.set.call_args_list ]
+        self.assertTrue(set([
+            u'list:example-list:generation',
+            u'list:example-list:month:%d:%d:generation' % (today.year, today.month),
+            u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:generation',
+            ]).issubset(set(set_args)))
+        # calls to cache.get_or_create() -- no repopulation, the values are
+        # recomputed on demand
         goc_args = [ call[0][0] for call in
                      self.store.db.cache.get_or_create.call_args_list ]
         #from pprint import pprint; pprint(goc_args)
         self.assertEqual(set(goc_args), set([
-            u'list:example-list:recent_participants_count',
-            u'list:example-list:recent_threads_count',
-            u'list:example-list:participants_count:%d:%d' % (today.year, today.month),
-            u'list:example-list:threads_count:%d:%d' % (today.year, today.month),
-            u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:emails_count',
-            u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:participants_count',
             u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:starting_email_id',
             ]))
         #self.assertEqual(l.recent_participants_count, 1)
@@ -111,9 +111,333 @@ class TestNotifyStore(unittest.TestCase):
         call_args = [ call[0][0] for call in self.store.db.cache.set.call_args_list ]
         # we have duplicates because both the Storm and the SQLAlchemy model
         # subscribe to the event, so we must deduplicate
-        call_args = set(call_args)
+        # and the generations of the versioned namespaces and the list
+        # properties fingerprint are not relevant
+        call_args = set(key for key in call_args
+                        if not key.endswith(":generation")
+                        and not key.endswith(":props_fingerprint"))
         #from pprint import pprint; pprint(call_args)
         #print(repr(call_args))
         self.assertEqual(call_args, set([
             u'list:example-list:thread:QKODQBCADMDSP5YPOPKECXQWEQAMXZL3:subject'
             ]))
+
+
+class TestBatchEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.store = get_sa_store(SettingsModule(), auto_create=True)
+        self.subscribed = []
+
+    def tearDown(self):
+        for sub, eventclass, replaces in self.subscribed:
+            events.subscribers[eventclass].remove(sub)
+            if replaces is not None:
+                events.replaced.remove(replaces)
+        self.store.close()
+
+    def _subscribe(self, sub, eventclass, replaces=None):
+        events.subscribe(sub, eventclass, replaces)
+        self.subscribed.append((sub, eventclass, replaces))
+
+    def _add_message(self, list_name, num, reply_to=None):
+        msg = Message()
+        msg["From"] = "dummy%d@example.com" % num
+        msg["Message-ID"] = "<dummy%d>" % num
+        if reply_to is not None:
+            msg["In-Reply-To"] = "<dummy%d>" % reply_to
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(FakeList(list_name), msg)
+
+    def test_coalesce(self):
+        class Event: pass
+        other = Event()
+        e = [ events.NewMessage(self.store, FakeList("list-a"), 1),
+              events.NewMessage(self.store, FakeList("list-b"), 2),
+              other,
+              events.NewThread(self.store, FakeList("list-a"), 3),
+              events.NewMessage(self.store, FakeList("list-a"), 4) ]
+        batches = events.coalesce(e)
+        self.assertEqual([ b.__class__ for b in batches ], [
+            events.NewMessageBatch, events.NewMessageBatch, Event,
+            events.NewThreadBatch])
+        self.assertEqual(batches[0].messages, [1, 4])
+        self.assertEqual(batches[1].messages, [2])
+        self.assertEqual(batches[3].threads, [3])
+
+    def test_batch_events(self):
+        batches = []
+        singles = []
+        replaced = []
+        def replaced_sub(event):
+            replaced.append(event)
+        self._subscribe(batches.append, events.NewMessageBatch)
+        self._subscribe(singles.append, events.NewMessage)
+        self._subscribe(replaced_sub, events.NewMessage)
+        self._subscribe(lambda event: None, events.NewMessageBatch,
+                        replaces=replaced_sub)
+        with self.store.batch_events():
+            self._add_message("list-a", 1)
+            self._add_message("list-a", 2, reply_to=1)
+            self._add_message("list-b", 3)
+            self.assertEqual(batches, [])
+        self.assertEqual([ [ m.message_id for m in b.messages ]
+                           for b in batches ],
+                         [ ["dummy1", "dummy2"], ["dummy3"] ])
+        # the subscribers which are not batch-aware get every message
+        self.assertEqual([ e.message.message_id for e in singles ],
+                         ["dummy1", "dummy2", "dummy3"])
+        self.assertEqual(replaced, [])
+
+    def test_batch_events_error(self):
+        singles = []
+        self._subscribe(singles.append, events.NewMessage)
+        try:
+            with self.store.batch_events():
+                self._add_message("list-a", 1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(singles, [])
+        self._add_message("list-a", 2)
+        self.assertEqual(len(singles), 1)
+
+import os
+import time
+import threading
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from kittystore import get_store, setup_event_workers
+
+class TestAsyncDispatch(unittest.TestCase):
+
+    def setUp(self):
+        # the worker threads can't access an in-memory database
+        self.tmpdir = mkdtemp(prefix="kittystore-testing-")
+        self.settings = SettingsModule()
+        self.settings.KITTYSTORE_URL = "sqlite:///%s" % os.path.join(
+                self.tmpdir, "kittystore.sqlite")
+        self.store = get_store(self.settings, auto_create=True)
+        self.dispatcher = events.AsyncDispatcher(2,
+                lambda: get_store(self.settings))
+        events.dispatcher = self.dispatcher
+        self.received = []
+        self.subscribed = []
+
+    def tearDown(self):
+        events.dispatcher = None
+        self.dispatcher.close()
+        for sub in self.subscribed:
+            events.subscribers[events.NewMessage].remove(sub)
+        self.store.close()
+        rmtree(self.tmpdir)
+
+    def _subscribe(self, sub):
+        events.subscribe(sub, events.NewMessage)
+        self.subscribed.append(sub)
+
+    def _record(self, event):
+        self.received.append((event.message.list_name,
+                              event.message.message_id,
+                              event.store is self.store))
+
+    def _add_message(self, list_name, num):
+        msg = Message()
+        msg["From"] = "dummy%d@example.com" % num
+        msg["Message-ID"] = "<dummy%d>" % num
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(FakeList(list_name), msg)
+
+    def test_dispatch_after_commit(self):
+        self._subscribe(self._record)
+        for num in range(1, 4):
+            self._add_message("list-a", num)
+            self._add_message("list-b", num + 10)
+        self.dispatcher.drain()
+        self.assertEqual(self.received, [])
+        self.store.commit()
+        self.dispatcher.drain()
+        # ordered for each list, and run with the worker's store
+        for list_name, offset in (("list-a", 0), ("list-b", 10)):
+            self.assertEqual(
+                [ r for r in self.received if r[0] == list_name ],
+                [ (list_name, "dummy%d" % (num + offset), False)
+                  for num in range(1, 4) ])
+
+    def test_rollback(self):
+        self._subscribe(self._record)
+        self._add_message("list-a", 1)
+        self.store.rollback()
+        self.store.commit()
+        self.dispatcher.drain()
+        self.assertEqual(self.received, [])
+
+    def test_error_isolation(self):
+        def failing(event):
+            raise ValueError("failing subscriber")
+        self._subscribe(failing)
+        self._subscribe(self._record)
+        self._add_message("list-a", 1)
+        self._add_message("list-a", 2)
+        self.store.commit()
+        self.dispatcher.drain()
+        self.assertEqual(self.received, [
+            ("list-a", "dummy1", False), ("list-a", "dummy2", False)])
+
+    def test_queue_sizes(self):
+        release = threading.Event()
+        self._subscribe(lambda event: release.wait(5))
+        self._add_message("list-a", 1)
+        self._add_message("list-a", 2)
+        self.store.commit()
+        # 2 new messages and 2 new threads: the first event is being
+        # processed, the others are waiting
+        for _i in range(50):
+            if sum(self.dispatcher.queue_sizes()) == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(sum(self.dispatcher.queue_sizes()), 3)
+        release.set()
+        self.dispatcher.drain()
+        self.assertEqual(self.dispatcher.queue_sizes(), [0, 0])
+
+    def test_batch(self):
+        self._subscribe(self._record)
+        with self.store.batch_events():
+            for num in range(1, 4):
+                self._add_message("list-a", num)
+        self.assertEqual(len(self.store.pending_events), 2) # messages, threads
+        self.store.commit()
+        self.dispatcher.drain()
+        self.assertEqual(self.received, [ ("list-a", "dummy%d" % num, False)
+                                          for num in range(1, 4) ])
+
+    def test_close(self):
+        # the queued events are processed before the workers stop
+        def slow_record(event):
+            time.sleep(0.1)
+            self._record(event)
+        self._subscribe(slow_record)
+        self._add_message("list-a", 1)
+        self._add_message("list-a", 2)
+        self.store.commit()
+        self.dispatcher.close()
+        self.assertEqual(self.received, [
+            ("list-a", "dummy1", False), ("list-a", "dummy2", False)])
+        self.assertFalse(any(thread.is_alive()
+                             for thread in self.dispatcher.threads))
+
+    def test_opt_in(self):
+        # get_store() does not start the workers, the application does
+        events.dispatcher = None
+        self.settings.KITTYSTORE_EVENT_WORKERS = 3
+        get_store(self.settings).close()
+        self.assertTrue(events.dispatcher is None)
+        dispatcher = setup_event_workers(self.settings)
+        self.assertTrue(events.dispatcher is dispatcher)
+        self.assertEqual(len(dispatcher.queues), 3)
+        events.shutdown_dispatcher()
+        self.assertTrue(events.dispatcher is None)
+        self.assertFalse(any(thread.is_alive()
+                             for thread in dispatcher.threads))
+
+    def test_rollback_logged(self):
+        self._add_message("list-a", 1)
+        with patch("kittystore.store.logger") as logger:
+            self.store.rollback()
+        self.assertEqual(logger.info.call_count, 1)
+        self.assertEqual(self.store.pending_events, [])
+
+
+from kittystore.sa.model import OutboxEvent
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        settings = SettingsModule()
+        settings.KITTYSTORE_EVENT_OUTBOX = True
+        self.store = get_sa_store(settings, auto_create=True)
+        self.received = []
+        self.subscribed = []
+
+    def tearDown(self):
+        for sub in self.subscribed:
+            events.subscribers[events.NewMessage].remove(sub)
+        self.store.close()
+
+    def _subscribe(self, sub):
+        events.subscribe(sub, events.NewMessage)
+        self.subscribed.append(sub)
+
+    def _record(self, event):
+        self.received.append((event.message.message_id,
+                              event.mlist.display_name))
+
+    def _add_message(self, num, archive_policy=ArchivePolicy.public):
+        ml = FakeList("example-list")
+        ml.display_name = "Example list"
+        ml.archive_policy = archive_policy
+        msg = Message()
+        msg["From"] = "dummy%d@example.com" % num
+        msg["Message-ID"] = "<dummy%d>" % num
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(ml, msg)
+
+    def test_transactional(self):
+        self._subscribe(self._record)
+        self._add_message(1)
+        self.assertEqual(self.received, [])
+        # a message and a thread
+        self.assertEqual(self.store.db.query(OutboxEvent).count(), 2)
+        self.store.rollback()
+        self.assertEqual(self.store.db.query(OutboxEvent).count(), 0)
+
+    def test_process(self):
+        self._subscribe(self._record)
+        self._add_message(1)
+        self._add_message(2)
+        self.store.commit()
+        self.assertEqual(events.process_outbox(self.store), 4)
+        self.assertEqual(self.received, [
+            ("dummy1", "Example list"), ("dummy2", "Example list")])
+        self.assertEqual(self.store.db.query(OutboxEvent).count(), 0)
+        self.assertEqual(events.process_outbox(self.store), 0)
+
+    def test_list_properties_before_indexing(self):
+        # the list properties are not updated by a deferred subscriber, the
+        # search index needs them
+        indexed = []
+        self.store.search_index = Mock()
+        self.store.search_index.add.side_effect = lambda email: \
+                indexed.append(email.mlist.archive_policy)
+        self._add_message(1)
+        self._add_message(2, archive_policy=ArchivePolicy.private)
+        self.assertEqual(indexed,
+                         [ArchivePolicy.public, ArchivePolicy.private])
+
+    def test_claims(self):
+        self._add_message(1)
+        self.store.commit()
+        first = self.store.claim_outbox_events(1, 300)
+        second = self.store.claim_outbox_events(1, 300)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first[0][0], second[0][0])
+        self.assertEqual(self.store.claim_outbox_events(1, 300), [])
+
+    def test_retry(self):
+        def failing(event):
+            raise ValueError("failing subscriber")
+        self._subscribe(failing)
+        self._add_message(1)
+        self.store.commit()
+        # the lease expires immediately, the NewMessage event is retried
+        self.assertEqual(events.process_outbox(self.store, lease=0), 2)
+        for attempt in range(events.OUTBOX_MAX_ATTEMPTS - 1):
+            self.assertEqual(events.process_outbox(self.store, lease=0), 1)
+        outbox = self.store.db.query(OutboxEvent).one()
+        self.assertEqual(outbox.event_type, "NewMessage")
+        self.assertEqual(outbox.attempts, events.OUTBOX_MAX_ATTEMPTS)
+        # given up
+        self.assertEqual(events.process_outbox(self.store, lease=0), 0)
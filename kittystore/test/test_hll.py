@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=R0904
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import unittest
+
+from kittystore.hll import HyperLogLog
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def test_small_counts(self):
+        sketch = HyperLogLog()
+        self.assertEqual(sketch.count(), 0)
+        for i in range(10):
+            sketch.add("sender%d@example.com" % i)
+            sketch.add("sender%d@example.com" % i) # duplicates are ignored
+        self.assertEqual(sketch.count(), 10)
+
+    def test_large_count(self):
+        sketch = HyperLogLog()
+        for i in range(20000):
+            sketch.add("sender%d@example.com" % i)
+        self.assertAlmostEqual(sketch.count(), 20000, delta=20000 * 0.1)
+
+    def test_merge(self):
+        sketches = [HyperLogLog(), HyperLogLog()]
+        for i in range(3000):
+            sketches[i % 2].add("sender%d@example.com" % (i % 2000))
+        merged = HyperLogLog.merged(s.to_bytes() for s in sketches)
+        self.assertAlmostEqual(merged.count(), 2000, delta=2000 * 0.1)
+
+    def test_wrong_size(self):
+        self.assertRaises(ValueError, HyperLogLog, b"\0" * 10)
+        self.assertRaises(ValueError, HyperLogLog().update,
+                          HyperLogLog(precision=4))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=R0904,C0103
+# - Too many public methods
+# - Invalid name XXX (should match YYY)
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from mock import Mock, patch
+from storm.exceptions import DatabaseError
+
+from kittystore import events
+from kittystore.importer import DbImporter
+from kittystore.sa import get_sa_store
+from kittystore.test import FakeList, SettingsModule
+
+
+class TestDbImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="kittystore-testing-")
+        self.store = get_sa_store(SettingsModule(), auto_create=True)
+        self.store.search_index = Mock()
+        self.mbox = os.path.join(self.tmpdir, "example-list.mbox")
+        with open(self.mbox, "w") as mbox:
+            for num in range(1, 4):
+                mbox.write("From dummy@example.com Fri Nov  2 16:07:54 2012\n"
+                           "From: dummy@example.com\n"
+                           "Message-ID: <msg%d>\n"
+                           "Subject: Dummy message\n\n"
+                           "Dummy message\n\n" % num)
+        opts = Mock(duplicates=False, no_download=True, verbose=False,
+                    since=None, cont=False)
+        self.importer = DbImporter(FakeList("example-list"), self.store, opts)
+        self.received = []
+        events.subscribe(self._record, events.NewMessage)
+
+    def tearDown(self):
+        events.subscribers[events.NewMessage].remove(self._record)
+        self.store.close()
+        rmtree(self.tmpdir)
+
+    def _record(self, event):
+        self.received.append(event.message.message_id)
+
+    def _fail_on(self, message_id, exception):
+        add_to_list = self.store.add_to_list
+        def failing_add_to_list(mlist, message):
+            add_to_list(mlist, message)
+            if message["Message-ID"] == "<%s>" % message_id:
+                raise exception
+        return patch.object(self.store, "add_to_list", failing_add_to_list)
+
+    def test_import(self):
+        self.importer.from_mbox(self.mbox)
+        self.assertEqual(self.received, ["msg1", "msg2", "msg3"])
+
+    def test_database_error(self):
+        # the message is skipped, and so are its events
+        with self._fail_on("msg2", DatabaseError("failed")):
+            self.importer.from_mbox(self.mbox)
+        self.assertEqual(self.received, ["msg1", "msg3"])
+        self.assertEqual(self.store.get_list_size("example-list"), 2)
+
+    def test_error(self):
+        # the events of the messages which were committed are still emitted
+        with self._fail_on("msg3", ValueError("failed")):
+            self.assertRaises(ValueError, self.importer.from_mbox, self.mbox)
+        self.assertEqual(self.received, ["msg1", "msg2"])
+        self.assertEqual(self.store.get_list_size("example-list"), 2)
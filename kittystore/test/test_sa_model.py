@@ -13,7 +13,8 @@ import uuid
 from mailman.email.message import Message
 
 from kittystore.sa import get_sa_store
-from kittystore.sa.model import Email, Thread, User
+from kittystore.sa.model import Email, Thread, User, Vote
+from kittystore.caching import get_counters, set_counters, reconcile_counters
 
 from kittystore.test import FakeList, SettingsModule
 
@@ -102,6 +103,24 @@ class TestSAModel(unittest.TestCase):
         self.store.db.add(thread)
         self.store.flush()
 
+    def test_thread_summary_sender(self):
+        ml = FakeList("example-list")
+        for num in range(1, 4):
+            msg = Message()
+            msg["From"] = "Sender %d <sender%d@example.com>" % (
+                    num % 2, num % 2)
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Subject %d" % num
+            if num > 1:
+                msg["In-Reply-To"] = "<msg1>"
+            msg.set_payload("message %d" % num)
+            self.store.add_to_list(ml, msg)
+        thread = self.store.db.query(Thread).one()
+        self.assertEqual(thread.starter_name, "Sender 1")
+        self.assertEqual(thread.subject, "Subject 1")
+        self.assertEqual(thread._emails_count, 3)
+        self.assertEqual(thread._participants_count, 2)
+
     def test_long_subject(self):
         # PostgreSQL will raise an OperationalError if the subject's index is
         # longer than 2712, but SQLite will accept anything, so we must test
@@ -217,3 +236,66 @@ class TestStormModelVoting(unittest.TestCase):
         msg2.vote(-1, self.user.id)
         user = self.store.db.query(User).one()
         self.assertEqual(user.get_votes_in_list("example-list"), (1, 1))
+
+    def test_vote_counters(self):
+        # the cached counts are changed after the commit, not recounted
+        self._create_email(1)
+        msg1 = self.store.db.query(Email).filter(Email.message_id == "msg1").one()
+        self.assertEqual(msg1.likes, 0)
+        self.assertEqual(self.user.get_votes_in_list("example-list"), (0, 0))
+        likes_key = str("list:example-list:email:msg1:likes")
+        self.assertEqual(get_counters(self.store.db.cache, [likes_key]), [0])
+        msg1.vote(1, self.user.id)
+        # the transaction reads its own changes
+        self.assertEqual(msg1.vote_counts, (1, 0))
+        self.assertEqual(self.user.get_votes_in_list("example-list"), (1, 0))
+        self.assertEqual(get_counters(self.store.db.cache, [likes_key]), [0])
+        self.store.commit()
+        self.assertEqual(get_counters(self.store.db.cache, [likes_key]), [1])
+        # not recounted
+        self.store.db.execute(Vote.__table__.delete())
+        self.assertEqual(msg1.vote_counts, (1, 0))
+        self.assertEqual(self.user.get_votes_in_list("example-list"), (1, 0))
+        self.store.rollback()
+        # the changes of a rolled back transaction are not applied
+        msg1.vote(-1, self.user.id)
+        self.assertEqual(msg1.vote_counts, (0, 1))
+        self.store.rollback()
+        self.assertEqual(msg1.vote_counts, (1, 0))
+        self.assertEqual(self.user.get_votes_in_list("example-list"), (1, 0))
+
+    def test_reconcile_counters(self):
+        self._create_email(1)
+        msg1 = self.store.db.query(Email).filter(Email.message_id == "msg1").one()
+        msg1.vote(1, self.user.id)
+        self.store.commit()
+        cache = self.store.db.cache
+        keys = [ str("list:example-list:email:msg1:likes"),
+                 str("list:example-list:thread:%s:likes" % msg1.thread_id),
+                 str("user:%s:list:example-list:likes" % self.user.id.int) ]
+        set_counters(cache, dict((key, 5) for key in keys))
+        reconcile_counters(self.store)
+        self.assertEqual(get_counters(cache, keys), [1, 1, 1])
+
+    def test_thread_summary(self):
+        # the summary columns follow the votes and the deletions
+        self._create_email(1)
+        self._create_email(2, reply_to=1)
+        self._create_email(3, reply_to=2)
+        thread = self.store.db.query(Thread).one()
+        self.assertEqual(thread.starting_email_id, "msg1")
+        self.assertEqual(thread.last_email_id, "msg3")
+        self.assertEqual(thread._emails_count, 3)
+        self.assertEqual(thread._participants_count, 3)
+        msg2 = self.store.db.query(Email).filter(
+                Email.message_id == "msg2").one()
+        msg2.vote(1, self.user.id)
+        self.assertEqual((thread._likes, thread._dislikes), (1, 0))
+        msg2.vote(-1, self.user.id)
+        self.assertEqual((thread._likes, thread._dislikes), (0, 1))
+        msg2.vote(0, self.user.id)
+        self.assertEqual((thread._likes, thread._dislikes), (0, 0))
+        self.store.delete_message_from_list("example-list", "msg3")
+        self.assertEqual(thread.last_email_id, "msg2")
+        self.assertEqual(thread._emails_count, 2)
+        self.assertEqual(thread._participants_count, 2)
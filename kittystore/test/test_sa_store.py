@@ -5,20 +5,28 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import os
 import unittest
 import email
 import datetime
 import uuid
 from shutil import rmtree
 from tempfile import mkdtemp
+import threading
+import warnings
 #from traceback import format_exc
 
 from mailman.email.message import Message
 from mailman.interfaces.archiver import ArchivePolicy
+from mock import patch
+from sqlalchemy.exc import SAWarning
 
 from kittystore import _get_search_index
-from kittystore.sa import get_sa_store
-from kittystore.sa.model import Email, Attachment, Thread, List, Category
+from kittystore.sa import get_sa_store, get_store_factory
+from kittystore.sa.model import Email, Attachment, Thread, List, Category, User
+from kittystore.sa.model import ListActivity
+from kittystore.sa.utils import (get_participants_count_between,
+    get_approximate_participants_count)
 from kittystore.utils import get_message_id_hash
 
 from kittystore.test import get_test_file, FakeList, SettingsModule
@@ -264,6 +272,160 @@ class TestSAStore(unittest.TestCase):
     #    for e in emails:
     #        print e.content
 
+    def test_thread_stats(self):
+        ml = FakeList("example-list")
+        for num, reply_to in ((1, None), (2, 1), (3, 1), (4, None)):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % min(num, 2)
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Subject %d" % num
+            if reply_to is not None:
+                msg["In-Reply-To"] = "<msg%d>" % reply_to
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+        user = User(id=uuid.uuid1())
+        self.store.db.add(user)
+        self.store.db.flush()
+        user_id = user.id
+        self.store.get_message_by_id_from_list("example-list", "msg2"
+                ).vote(1, user_id)
+        threads = [ self.store.get_message_by_id_from_list(
+                        "example-list", "msg%d" % num).thread
+                    for num in (1, 4) ]
+        self.store.db.cache.invalidate()
+        expected = [
+            dict(emails_count=3, participants_count=2, likes=1, dislikes=0,
+                 subject="Subject 1"),
+            dict(emails_count=1, participants_count=1, likes=0, dislikes=0,
+                 subject="Subject 4"),
+            ]
+        self.assertEqual(self.store.get_thread_stats(threads), expected)
+        # the values are cached, also for the model properties
+        self.store._compute_thread_stats = None
+        self.assertEqual(self.store.get_thread_stats(threads), expected)
+        self.assertEqual(threads[0].emails_count, 3)
+        self.assertEqual(threads[0].likes, 1)
+
+    def test_vote_summaries(self):
+        ml = FakeList("example-list")
+        for num in range(1, 4):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+        user_ids = [uuid.uuid1(), uuid.uuid1()]
+        for user_id in user_ids:
+            self.store.db.add(User(id=user_id))
+        self.store.db.flush()
+        emails = [ self.store.get_message_by_id_from_list(
+                        "example-list", "msg%d" % num) for num in range(1, 4) ]
+        emails[0].vote(1, user_ids[0])
+        emails[0].vote(1, user_ids[1])
+        emails[1].vote(-1, user_ids[0])
+        # the counts changed by the transaction are not cached before it ends
+        expected = [ (2, 0), (0, 1), (0, 0) ]
+        self.assertEqual(self.store.get_vote_summaries(emails), expected)
+        self.store.commit()
+        self.assertEqual(self.store.get_vote_summaries(emails), expected)
+        # the values are cached, also for the model properties
+        self.store._compute_vote_summaries = None
+        self.assertEqual(self.store.get_vote_summaries(emails), expected)
+        self.assertEqual(emails[0].likes, 2)
+        self.assertEqual(emails[1].dislikes, 1)
+
+    def _add_dated_message(self, num, date, sender=None, reply_to=None):
+        msg = Message()
+        msg["From"] = sender or "sender%d@example.com" % num
+        msg["Message-ID"] = "<msg%d>" % num
+        msg["Date"] = date
+        if reply_to is not None:
+            msg["In-Reply-To"] = "<msg%d>" % reply_to
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(FakeList("example-list"), msg)
+
+    def test_delete_last_message_of_thread(self):
+        self._add_dated_message(1, "Fri, 02 Nov 2012 10:00:00 +0000")
+        msg = self.store.get_message_by_id_from_list("example-list", "msg1")
+        thread_id = msg.thread_id
+        self.assertEqual(len(msg.thread.emails), 1) # load the collection
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", SAWarning)
+            self.store.delete_message_from_list("example-list", "msg1")
+        self.assertEqual(self.store.get_thread("example-list", thread_id),
+                         None)
+
+    def _get_activity(self):
+        return [ (a.day.day, a.messages_count, a.new_threads_count,
+                  a.senders_count, a.active_threads_count)
+                 for a in self.store.get_daily_activity("example-list",
+                    datetime.datetime(2012, 11, 1),
+                    datetime.datetime(2012, 12, 1)) ]
+
+    def test_daily_activity(self):
+        self._add_dated_message(1, "Fri, 02 Nov 2012 10:00:00 +0000")
+        self._add_dated_message(2, "Fri, 02 Nov 2012 11:00:00 +0000",
+                                sender="sender1@example.com", reply_to=1)
+        self._add_dated_message(3, "Fri, 02 Nov 2012 12:00:00 +0000")
+        self._add_dated_message(4, "Sat, 03 Nov 2012 12:00:00 +0000",
+                                reply_to=1)
+        expected = [ (2, 3, 2, 2, 1), (3, 1, 0, 1, 1) ]
+        self.assertEqual(self._get_activity(), expected)
+        self.store.rebuild_activity()
+        self.assertEqual(self._get_activity(), expected)
+        # deletions
+        self.store.delete_message_from_list("example-list", "msg3")
+        self.assertEqual(self._get_activity(),
+                         [ (2, 2, 1, 1, 0), (3, 1, 0, 1, 1) ])
+        thread_id = self.store.get_message_by_id_from_list(
+                "example-list", "msg1").thread_id
+        self.store.delete_thread("example-list", thread_id)
+        self.assertEqual(self._get_activity(), [])
+
+    def test_daily_activity_concurrent_insert(self):
+        # another archiver creates the day's row between the UPDATE and the
+        # INSERT
+        insert_activity = self.store._insert_activity
+        def concurrent_insert(list_name, day, values):
+            insert_activity(list_name, day, values)
+            self.store.flush()
+            return False
+        with patch.object(self.store, "_insert_activity", concurrent_insert):
+            self._add_dated_message(1, "Fri, 02 Nov 2012 10:00:00 +0000")
+        self.assertEqual(self._get_activity(), [ (2, 2, 2, 2, 2) ])
+
+    def test_activity_counts(self):
+        today = datetime.datetime.utcnow()
+        self._add_dated_message(1, today.isoformat())
+        self._add_dated_message(2, today.isoformat(), reply_to=1)
+        self._add_dated_message(3, today.isoformat())
+        mlist = self.store.get_list("example-list")
+        self.assertEqual(mlist.recent_threads_count, 2)
+        self.assertEqual(mlist.get_month_activity(
+                today.year, today.month).threads_count, 2)
+
+    def test_participants_count(self):
+        self._add_dated_message(1, "Fri, 02 Nov 2012 10:00:00 +0000")
+        self._add_dated_message(2, "Fri, 02 Nov 2012 11:00:00 +0000",
+                                sender="sender1@example.com", reply_to=1)
+        self._add_dated_message(3, "Sat, 03 Nov 2012 12:00:00 +0000")
+        self._add_dated_message(4, "Sat, 03 Nov 2012 13:00:00 +0000",
+                                sender="sender1@example.com", reply_to=3)
+        begin = datetime.datetime(2012, 11, 1)
+        end = datetime.datetime(2012, 12, 1)
+        for approximate in (False, True):
+            self.assertEqual(get_participants_count_between(self.store.db,
+                    "example-list", begin, end, approximate), 2)
+        self.store.rebuild_activity()
+        self.assertEqual(get_participants_count_between(self.store.db,
+                "example-list", begin, end, approximate=True), 2)
+        # a missing sketch falls back to the exact count
+        self.store.db.query(ListActivity).update({"senders_sketch": None})
+        self.assertEqual(get_approximate_participants_count(self.store.db,
+                "example-list", begin, end), None)
+        self.assertEqual(get_participants_count_between(self.store.db,
+                "example-list", begin, end, approximate=True), 2)
+
     #def test_non_ascii_headers(self):
     #    """add_to_list must handle non-ascii headers"""
     #    mbox = mailbox.mbox(get_test_file("non-ascii-headers.txt"))
@@ -305,3 +467,59 @@ class TestStormStoreWithSearch(unittest.TestCase):
         self.store.add_to_list(ml, msg)
         result = self.store.search("dummy")
         self.assertEqual(result["total"], 0)
+
+
+class TestStoreFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="kittystore-testing-")
+        self.settings = SettingsModule()
+        self.settings.KITTYSTORE_URL = "sqlite:///%s" % os.path.join(
+                self.tmpdir, "kittystore.sqlite")
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        rmtree(self.tmpdir)
+
+    def _get_store(self):
+        store = get_sa_store(self.settings, auto_create=True)
+        self.stores.append(store)
+        return store
+
+    def test_shared_resources(self):
+        store1 = self._get_store()
+        store2 = self._get_store()
+        self.assertTrue(store1.db.bind is store2.db.bind)
+        self.assertTrue(store1.db.cache is store2.db.cache)
+        self.assertTrue(get_store_factory(self.settings).engine
+                        is store1.db.bind)
+
+    def test_session_per_thread(self):
+        store = self._get_store()
+        self.assertTrue(store.db is self._get_store().db)
+        other = []
+        thread = threading.Thread(
+                target=lambda: other.append(self._get_store()))
+        thread.start()
+        thread.join()
+        self.assertFalse(store.db is other[0].db)
+        self.assertTrue(store.db.bind is other[0].db.bind)
+
+    def test_remove(self):
+        store = self._get_store()
+        get_store_factory(self.settings).remove()
+        self.assertFalse(store.db is self._get_store().db)
+
+    def test_memory_db_not_shared(self):
+        store1 = get_sa_store(SettingsModule(), auto_create=True)
+        store2 = get_sa_store(SettingsModule(), auto_create=True)
+        self.stores.extend([store1, store2])
+        self.assertFalse(store1.db.bind is store2.db.bind)
+        self.assertFalse(store1.db.cache is store2.db.cache)
+
+    def test_shared_search_index(self):
+        self.settings.KITTYSTORE_SEARCH_INDEX = self.tmpdir
+        self.assertTrue(_get_search_index(self.settings)
+                        is _get_search_index(self.settings))
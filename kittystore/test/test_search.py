@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=R0904,C0103
+# - Too many public methods
+# - Invalid name XXX (should match YYY)
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import unittest
+import datetime
+import threading
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from mailman.email.message import Message
+from mailman.interfaces.archiver import ArchivePolicy
+from whoosh.index import create_in, exists_in
+
+from kittystore import search
+from kittystore.caching import versioned_key
+from kittystore.sa import get_sa_store
+from kittystore.search import SearchEngine, whoosh_engine
+
+from kittystore.test import FakeList, SettingsModule
+
+
+class TestSearchUpgrade(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="kittystore-testing-")
+        settings = SettingsModule()
+        # not in memory, the background upgrade runs in another thread
+        settings.KITTYSTORE_URL = "sqlite:///%s" % os.path.join(
+                self.tmpdir, "kittystore.sqlite")
+        self.store = get_sa_store(settings, auto_create=True)
+        self.search_index = SearchEngine(os.path.join(self.tmpdir, "index"))
+        self.store.search_index = self.search_index
+
+    def tearDown(self):
+        self.store.close()
+        rmtree(self.tmpdir)
+
+    def _add_message(self, num):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % num
+        msg["Subject"] = "Dummy message"
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(FakeList("example-list"), msg)
+
+    def _create_legacy_index(self):
+        # An index created by a release without schema versions
+        os.mkdir(self.search_index.location)
+        index = create_in(self.search_index.location,
+                          self.search_index._get_schema())
+        writer = index.writer()
+        writer.add_document(list_name="example-list", message_id="legacy",
+                            content="dummy")
+        writer.commit()
+
+    def test_no_index(self):
+        self.assertEqual(self.search_index.get_version(), None)
+        self.assertTrue(self.search_index.needs_upgrade())
+
+    def test_create(self):
+        self.search_index.upgrade(self.store)
+        self.assertEqual(self.search_index.get_version(),
+                         whoosh_engine.SCHEMA_VERSION)
+        self.assertFalse(self.search_index.needs_upgrade())
+        self._add_message(1)
+        self.assertEqual(self.store.search("dummy")["total"], 1)
+
+    def test_legacy_index_is_used_until_upgraded(self):
+        self._create_legacy_index()
+        self.assertEqual(self.search_index.get_version(), 0)
+        self.assertTrue(self.search_index.needs_upgrade())
+        results = self.search_index.search("dummy", "example-list")
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["legacy"])
+
+    def test_outdated_index_fields(self):
+        # The outdated index is used until the upgrade is done, even if it
+        # lacks the new fields
+        os.mkdir(self.search_index.location)
+        schema = self.search_index._get_schema()
+        schema.remove("thread_id")
+        create_in(self.search_index.location, schema)
+        self._add_message(1)
+        results = self.search_index.search("dummy", "example-list",
+                                           collapse="thread")
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["msg1"])
+
+    def test_upgrade_backfills_and_switches(self):
+        self._create_legacy_index()
+        for num in range(5):
+            self._add_message(num)
+        migration = self.search_index.upgrade(self.store)
+        self.assertEqual(migration.done, 5)
+        self.assertEqual(self.search_index.get_version(),
+                         whoosh_engine.SCHEMA_VERSION)
+        results = self.search_index.search("dummy", "example-list", limit=10)
+        self.assertEqual(sorted(r["message_id"] for r in results["results"]),
+                         ["msg%d" % num for num in range(5)])
+        # the old index has been removed
+        self.assertFalse(exists_in(self.search_index.location))
+        self.assertFalse([ f for f in os.listdir(self.search_index.location)
+                           if "MAIN" in f ])
+
+    def test_upgrade_in_batches(self):
+        self.search_index.upgrade(self.store)
+        for num in range(5):
+            self._add_message(num)
+        whoosh_engine.SCHEMA_VERSION += 1
+        try:
+            migration = search.IndexMigration(self.search_index, self.store)
+            migration.batch_size = 2
+            migration.run()
+            self.assertEqual(migration.done, 5)
+            self.assertEqual(self.search_index.search("dummy")["total"], 5)
+        finally:
+            whoosh_engine.SCHEMA_VERSION -= 1
+
+    def test_upgrade_cross_posted(self):
+        # the copies of a message in several lists are all indexed, even
+        # when they are in different batches
+        self.search_index.upgrade(self.store)
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg>"
+        msg["Subject"] = "Dummy message"
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(FakeList("example-list-1"), msg)
+        self.store.add_to_list(FakeList("example-list-2"), msg)
+        whoosh_engine.SCHEMA_VERSION += 1
+        try:
+            migration = search.IndexMigration(self.search_index, self.store)
+            migration.batch_size = 1
+            migration.run()
+            self.assertEqual(self.search_index.search("dummy")["total"], 2)
+        finally:
+            whoosh_engine.SCHEMA_VERSION -= 1
+
+    def test_upgrade_in_background(self):
+        self._create_legacy_index()
+        self._add_message(1)
+        self.store.commit()
+        migration = self.search_index.upgrade(self.store, background=True)
+        migration.thread.join()
+        self.assertEqual(self.search_index.get_version(),
+                         whoosh_engine.SCHEMA_VERSION)
+        self.assertEqual(self.search_index.search("dummy")["total"], 1)
+
+
+
+class TestSearch(unittest.TestCase):
+
+    backend = SearchEngine
+    engine_module = whoosh_engine
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="kittystore-testing-")
+        self.store = get_sa_store(SettingsModule(), auto_create=True)
+        self.search_index = self.backend(self.tmpdir)
+        self.store.search_index = self.search_index
+        self.search_index.upgrade(self.store)
+
+    def tearDown(self):
+        self.store.close()
+        rmtree(self.tmpdir)
+
+    def _add_message(self, num, date, list_name="example-list"):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % num
+        msg["Subject"] = "Dummy message"
+        msg["Date"] = date
+        msg.set_payload("Dummy message")
+        self.store.add_to_list(FakeList(list_name), msg)
+
+    def test_upgrade_with_deletions(self):
+        # the messages deleted during an upgrade don't make it skip others,
+        # and are removed from the index being built
+        for num in range(5):
+            self._add_message(num, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self.store.commit()
+        migration = search.IndexMigration(self.search_index, self.store)
+        migration.batch_size = 2
+        index_batch = self.search_index._index_batch
+        def index_and_delete(index, messages):
+            index_batch(index, messages)
+            if migration.done == 0:
+                # a message which was just indexed, and a message from a
+                # later batch
+                self.store.delete_message_from_list("example-list", "msg0")
+                self.store.delete_message_from_list("example-list", "msg3")
+                self.store.commit()
+        self.search_index._index_batch = index_and_delete
+        self.engine_module.SCHEMA_VERSION += 1
+        try:
+            migration.run()
+        finally:
+            self.engine_module.SCHEMA_VERSION -= 1
+        self.assertEqual(migration.done, 4)
+        results = self.search_index.search("dummy", limit=10)
+        self.assertEqual(sorted(r["message_id"] for r in results["results"]),
+                         ["msg1", "msg2", "msg4"])
+
+    def test_sort_by_date(self):
+        self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self._add_message(2, "Fri, 04 Jan 2013 16:07:54 +0000")
+        self._add_message(3, "Fri, 07 Dec 2012 16:07:54 +0000")
+        results = self.search_index.search("dummy", sortedby="date",
+                                           reverse=True)
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["msg2", "msg3", "msg1"])
+
+    def test_date_range(self):
+        self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self._add_message(2, "Fri, 04 Jan 2013 16:07:54 +0000")
+        self._add_message(3, "Fri, 07 Dec 2012 16:07:54 +0000")
+        results = self.search_index.search("dummy",
+                start=datetime.datetime(2012, 12, 1),
+                end=datetime.datetime(2013, 1, 4, 16, 7, 54))
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["msg3"])
+        results = self.search_index.search("dummy",
+                start=datetime.datetime(2012, 12, 1))
+        self.assertEqual(results["total"], 2)
+        results = self.search_index.search("dummy", "example-list",
+                end=datetime.datetime(2012, 12, 1))
+        self.assertEqual(results["total"], 1)
+
+    def test_filter_cache(self):
+        self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self.search_index.search("dummy", "example-list")
+        cached = dict(self.search_index._filter_cache)
+        self.assertEqual(len(cached), 1)
+        self.search_index.search("message", "example-list")
+        self.assertEqual(self.search_index._filter_cache, cached)
+        # the cache is reset when the index changes
+        self._add_message(2, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self.assertEqual(
+            self.search_index.search("dummy", "example-list")["total"], 2)
+        self.assertNotEqual(self.search_index._filter_cache, cached)
+
+    def test_timeout(self):
+        for num in range(5):
+            self._add_message(num, "Fri, 02 Nov 2012 16:07:54 +0000")
+        results = self.search_index.search("dummy")
+        self.assertFalse(results["partial"])
+        self.assertEqual(results["total"], 5)
+        # a timeout that has already expired when the collector starts
+        results = self.search_index.search("dummy", timeout=0.000001)
+        self.assertTrue(results["partial"])
+        self.assertTrue(len(results["results"]) < 5)
+
+    def test_timeout_page(self):
+        for num in range(5):
+            self._add_message(num, "Fri, 02 Nov 2012 16:07:54 +0000")
+        results = self.search_index.search("dummy", page=2, limit=2,
+                                           sortedby="date", timeout=10)
+        self.assertFalse(results["partial"])
+        self.assertEqual(results["total"], 5)
+        self.assertEqual(len(results["results"]), 2)
+
+    def test_strip_quoted(self):
+        self.search_index.strip_quoted = True
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg["Subject"] = "Dummy message"
+        msg.set_payload("On Monday, Someone wrote:\n> quoted text\n\n"
+                        "Answer text\n-- \nSignature text\n")
+        self.store.add_to_list(FakeList("example-list"), msg)
+        self.assertEqual(self.search_index.search("answer")["total"], 1)
+        self.assertEqual(self.search_index.search("quoted")["total"], 0)
+        self.assertEqual(self.search_index.search("someone")["total"], 0)
+        self.assertEqual(self.search_index.search("signature")["total"], 0)
+        # the database is untouched
+        email = self.store.get_message_by_id_from_list("example-list", "msg1")
+        self.assertTrue("> quoted text" in email.content)
+        self.assertTrue("Signature text" in email.content)
+
+    def _add_list_messages(self):
+        for num, list_name in enumerate(["public-list", "private-list-1",
+                                         "private-list-2", "private-list-3"]):
+            mlist = FakeList(list_name)
+            if list_name.startswith("private"):
+                mlist.archive_policy = ArchivePolicy.private
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Dummy message"
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(mlist, msg)
+
+    def test_list_names(self):
+        self._add_list_messages()
+        self.assertEqual(self.search_index.search("dummy")["total"], 1)
+        results = self.search_index.search("dummy", list_names=[
+                "public-list", "private-list-1", "private-list-3"])
+        self.assertEqual(sorted(r["list_name"] for r in results["results"]),
+                         ["private-list-1", "private-list-3", "public-list"])
+        self.assertEqual(
+            self.search_index.search("dummy", list_names=[])["total"], 0)
+
+    def test_list_names_filter_cache(self):
+        self._add_list_messages()
+        self.search_index.search("dummy", list_names=[
+                "public-list", "private-list-1", "private-list-3"])
+        self.assertEqual(len(self.search_index._filter_cache), 3)
+        # the per-list filters are cached and reused
+        results = self.search_index.search("message", list_names=[
+                "private-list-1", "private-list-2"])
+        self.assertEqual(sorted(r["list_name"] for r in results["results"]),
+                         ["private-list-1", "private-list-2"])
+        self.assertEqual(len(self.search_index._filter_cache), 4)
+
+    def test_pagination(self):
+        for num in range(5):
+            self._add_message(num,
+                    "Fri, 0%d Nov 2012 16:07:54 +0000" % (num + 1))
+        results = self.search_index.search("dummy", page=2, limit=2,
+                                           sortedby="date")
+        self.assertEqual(results["total"], 5)
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["msg2", "msg3"])
+        # past the end: the last page
+        results = self.search_index.search("dummy", page=10, limit=2,
+                                           sortedby="date")
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["msg4"])
+
+    def test_collapse_thread(self):
+        self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self._add_message(2, "Fri, 03 Nov 2012 16:07:54 +0000")
+        for num in (3, 4):
+            msg = Message()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["In-Reply-To"] = "<msg1>"
+            msg["Subject"] = "Re: Dummy message"
+            msg["Date"] = "Fri, 0%d Nov 2012 16:07:54 +0000" % (num + 1)
+            msg.set_payload("Dummy reply")
+            self.store.add_to_list(FakeList("example-list"), msg)
+        results = self.store.search("dummy", sortedby="date", reverse=True,
+                                    collapse="thread")
+        self.assertEqual(results["total"], 2)
+        self.assertEqual([e.message_id for e in results["results"]],
+                         ["msg4", "msg2"])
+        self.assertEqual(results["hits"], [3, 1])
+        # pagination is done on threads
+        results = self.store.search("dummy", sortedby="date", page=2, limit=1,
+                                    collapse="thread")
+        self.assertEqual(results["total"], 2)
+        self.assertEqual([e.message_id for e in results["results"]], ["msg2"])
+        self.assertRaises(ValueError, self.search_index.search, "dummy",
+                          collapse="list")
+
+    def _add_thread_message(self, num, subject, content, in_reply_to=None):
+        msg = Message()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % num
+        msg["Subject"] = subject
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<msg%d>" % in_reply_to
+        msg.set_payload(content)
+        self.store.add_to_list(FakeList("example-list"), msg)
+        return self.store.get_message_by_id_from_list(
+                "example-list", "msg%d" % num).thread_id
+
+    def test_related_threads(self):
+        thread_1 = self._add_thread_message(1, "Kernel compilation fails",
+                "The kernel compilation fails with a gcc error")
+        self._add_thread_message(2, "Re: Kernel compilation fails",
+                "Which gcc version?", in_reply_to=1)
+        thread_2 = self._add_thread_message(3, "gcc error",
+                "Building the kernel with gcc gives me an error")
+        self._add_thread_message(4, "Holiday party",
+                "The pictures of the party are online")
+        related = self.store.get_related_threads("example-list", thread_1)
+        self.assertEqual([t.thread_id for t in related], [thread_2])
+        # the results are cached
+        namespace = "list:example-list:thread:%s" % thread_1
+        cache_key = versioned_key(self.store.db.cache, namespace, "related")
+        self.assertEqual(self.store.db.cache.get(cache_key), [thread_2])
+        # and invalidated when the thread changes
+        self._add_thread_message(5, "Re: Kernel compilation fails",
+                "Use a newer gcc", in_reply_to=1)
+        self.assertNotEqual(
+            versioned_key(self.store.db.cache, namespace, "related"),
+            cache_key)
+
+    def test_delete(self):
+        self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self._add_message(2, "Fri, 02 Nov 2012 16:07:54 +0000")
+        self.store.delete_message_from_list("example-list", "msg1")
+        results = self.search_index.search("dummy")
+        self.assertEqual([r["message_id"] for r in results["results"]],
+                         ["msg2"])
+
+    def test_update_waits_for_writer(self):
+        # another writer (the archiver) holds the index lock
+        self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000")
+        doc = search.email_to_search_doc(
+                self.store.get_message_by_id_from_list("example-list", "msg1"))
+        doc["user_id"] = "42"
+        writer = self.search_index.index.writer()
+        timer = threading.Timer(0.5, writer.commit)
+        timer.start()
+        try:
+            self.search_index.update([doc])
+        finally:
+            timer.join()
+        self.assertEqual(self.search_index.search("user_id:42")["total"], 1)
+
+    def test_update_cross_posted(self):
+        # re-indexing a copy of a message does not remove the other copies
+        for list_name in ("example-list-1", "example-list-2"):
+            self._add_message(1, "Fri, 02 Nov 2012 16:07:54 +0000",
+                              list_name)
+        docs = [ search.email_to_search_doc(
+                    self.store.get_message_by_id_from_list(
+                        list_name, "msg1"))
+                 for list_name in ("example-list-1", "example-list-2") ]
+        docs[1]["user_id"] = "42"
+        self.search_index.update(docs[1:])
+        results = self.search_index.search("dummy")
+        self.assertEqual(sorted(r["list_name"] for r in results["results"]),
+                         ["example-list-1", "example-list-2"])
+        results = self.search_index.search("user_id:42")
+        self.assertEqual([r["list_name"] for r in results["results"]],
+                         ["example-list-2"])
+
+
+class TestStripQuotes(unittest.TestCase):
+
+    def test_quoted_lines(self):
+        self.assertEqual(search.strip_quotes(
+            "Hi\n> quoted\n  >> quoted again\nreply"), "Hi\nreply")
+
+    def test_attribution(self):
+        self.assertEqual(search.strip_quotes(
+            "Hi\nOn Mon, Jan 7, 2013, John <john@example.com> wrote:\n\n"
+            "> quoted\n\nreply"), "Hi\n\nreply")
+        # not followed by quoted text
+        self.assertEqual(search.strip_quotes("I wrote:\nsomething"),
+                         "I wrote:\nsomething")
+
+    def test_signature(self):
+        self.assertEqual(search.strip_quotes("reply\n-- \nJohn\n> not quoted"),
+                         "reply")
+
+    def test_empty(self):
+        self.assertEqual(search.strip_quotes(None), None)
+        self.assertEqual(search.strip_quotes(""), "")
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=R0904,C0103
+# - Too many public methods
+# - Invalid name XXX (should match YYY)
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import unittest
+
+from mailman.email.message import Message
+
+from kittystore.search import get_backend_class
+from kittystore.search import sqlite_engine
+from kittystore.search.sqlite_engine import SQLiteSearchEngine, to_fts_query
+
+from kittystore.test import FakeList, test_search
+
+
+class TestSQLiteSearch(test_search.TestSearch):
+    """Same behaviour as the Whoosh backend"""
+
+    backend = SQLiteSearchEngine
+    engine_module = sqlite_engine
+
+    def test_backend_setting(self):
+        self.assertTrue(get_backend_class("sqlite") is SQLiteSearchEngine)
+        self.assertRaises(ValueError, get_backend_class, "nonexistant")
+
+    def test_version(self):
+        self.assertEqual(self.search_index.get_version(),
+                         sqlite_engine.SCHEMA_VERSION)
+        self.assertFalse(self.search_index.needs_upgrade())
+
+    def test_no_index(self):
+        search_index = SQLiteSearchEngine(os.path.join(self.tmpdir, "new"))
+        self.assertEqual(search_index.get_version(), None)
+        self.assertEqual(search_index.search("dummy"),
+                         {"total": 0, "results": [], "partial": False})
+        self.assertEqual(search_index.get_key_terms("dummy message"), [])
+        self.assertRaises(RuntimeError, search_index.add,
+                {"list_name": "example-list", "message_id": "msg1"})
+
+    def test_update_waits_for_writer(self):
+        pass # the SQLite connection waits for the lock
+
+    def test_filter_cache(self):
+        pass # filtering is done by SQLite
+
+    def test_list_names_filter_cache(self):
+        pass
+
+    def test_timeout(self):
+        for num in range(5):
+            self._add_message(num, "Fri, 02 Nov 2012 16:07:54 +0000")
+        results = self.search_index.search("dummy", timeout=10)
+        self.assertFalse(results["partial"])
+        self.assertEqual(results["total"], 5)
+        # a timeout that has already expired when the query starts
+        results = self.search_index.search("dummy", timeout=-1)
+        self.assertTrue(results["partial"])
+        self.assertEqual(results["results"], [])
+
+    def test_fields(self):
+        msg = Message()
+        msg["From"] = "Dummy Sender <dummy@example.com>"
+        msg["Message-ID"] = "<msg1>"
+        msg["Subject"] = "Release announcement"
+        msg.set_payload("The new version is available")
+        self.store.add_to_list(FakeList("example-list"), msg)
+        for query, total in (("subject:release", 1), ("subject:version", 0),
+                             ("sender", 1), ("releases", 1), ("announc*", 1),
+                             ('"new version"', 1), ('"version new"', 0),
+                             ("release OR missing", 1), ("release missing", 0),
+                             ("version NOT release", 0), ("http://x", 0),
+                             ("OR", 0), ('"', 0), ("AND release", 1)):
+            self.assertEqual(self.search_index.search(query)["total"], total,
+                             "wrong result for %r" % query)
+
+
+
+class TestQueryConversion(unittest.TestCase):
+
+    def test_terms(self):
+        self.assertEqual(to_fts_query('word "a phrase"'),
+            '{sender subject content attachments} : "word" '
+            '{sender subject content attachments} : "a phrase"')
+
+    def test_fields(self):
+        self.assertEqual(to_fts_query("subject:word user_id:42"),
+                         'subject : "word" user_id : "42"')
+        self.assertEqual(to_fts_query("http://example.com"),
+            '{sender subject content attachments} : "http://example.com"')
+
+    def test_operators(self):
+        self.assertEqual(to_fts_query("OR a OR NOT"),
+            '{sender subject content attachments} : "a"')
+        self.assertEqual(to_fts_query('pref* "quoted""'),
+            '{sender subject content attachments} : "pref" * '
+            '{sender subject content attachments} : "quoted"')
@@ -19,7 +19,7 @@ from mailman.interfaces.archiver import ArchivePolicy
 
 from kittystore import _get_search_index
 from kittystore.storm import get_storm_store
-from kittystore.storm.model import Email, Attachment, Thread
+from kittystore.storm.model import Email, Attachment, Thread, User
 from kittystore.utils import get_message_id_hash
 
 from kittystore.test import get_test_file, FakeList, SettingsModule
@@ -33,6 +33,14 @@ class TestStormStore(unittest.TestCase):
     def tearDown(self):
         self.store.close()
 
+    def test_pending_patches(self):
+        from kittystore.storm import _get_schema
+        schema = _get_schema(SettingsModule())
+        self.assertFalse(schema.has_pending_patches(self.store.db))
+        self.store.db.execute("DELETE FROM patch WHERE version = %d"
+                              % schema.get_latest_patch())
+        self.assertTrue(schema.has_pending_patches(self.store.db))
+
     def test_no_message_id(self):
         msg = Message()
         self.assertRaises(ValueError, self.store.add_to_list,
@@ -222,6 +230,94 @@ class TestStormStore(unittest.TestCase):
     #    for e in emails:
     #        print e.content
 
+    def test_thread_stats(self):
+        ml = FakeList("example-list")
+        for num, reply_to in ((1, None), (2, 1), (3, 1), (4, None)):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % min(num, 2)
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Subject %d" % num
+            if reply_to is not None:
+                msg["In-Reply-To"] = "<msg%d>" % reply_to
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+        user_id = u"userid"
+        self.store.db.add(User(user_id))
+        self.store.db.flush()
+        self.store.get_message_by_id_from_list("example-list", "msg2"
+                ).vote(1, user_id)
+        threads = [ self.store.get_message_by_id_from_list(
+                        "example-list", "msg%d" % num).thread
+                    for num in (1, 4) ]
+        self.store.db.cache.invalidate()
+        expected = [
+            dict(emails_count=3, participants_count=2, likes=1, dislikes=0,
+                 subject="Subject 1"),
+            dict(emails_count=1, participants_count=1, likes=0, dislikes=0,
+                 subject="Subject 4"),
+            ]
+        self.assertEqual(self.store.get_thread_stats(threads), expected)
+        # the values are cached, also for the model properties
+        self.store._compute_thread_stats = None
+        self.assertEqual(self.store.get_thread_stats(threads), expected)
+        self.assertEqual(threads[0].emails_count, 3)
+        self.assertEqual(threads[0].likes, 1)
+
+    def test_vote_summaries(self):
+        ml = FakeList("example-list")
+        for num in range(1, 4):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+        user_ids = [u"userid1", u"userid2"]
+        for user_id in user_ids:
+            self.store.db.add(User(user_id))
+        self.store.db.flush()
+        emails = [ self.store.get_message_by_id_from_list(
+                        "example-list", "msg%d" % num) for num in range(1, 4) ]
+        emails[0].vote(1, user_ids[0])
+        emails[0].vote(1, user_ids[1])
+        emails[1].vote(-1, user_ids[0])
+        # the counts changed by the transaction are not cached before it ends
+        expected = [ (2, 0), (0, 1), (0, 0) ]
+        self.assertEqual(self.store.get_vote_summaries(emails), expected)
+        self.store.commit()
+        self.assertEqual(self.store.get_vote_summaries(emails), expected)
+        # the values are cached, also for the model properties
+        self.store._compute_vote_summaries = None
+        self.assertEqual(self.store.get_vote_summaries(emails), expected)
+        self.assertEqual(emails[0].likes, 2)
+        self.assertEqual(emails[1].dislikes, 1)
+
+    def test_vote_counters(self):
+        ml = FakeList("example-list")
+        for num in range(1, 3):
+            msg = Message()
+            msg["From"] = "sender%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            if num > 1:
+                msg["In-Reply-To"] = "<msg1>"
+            msg.set_payload("Dummy message")
+            self.store.add_to_list(ml, msg)
+        self.store.db.add(User(u"userid"))
+        emails = [ self.store.get_message_by_id_from_list(
+                        "example-list", "msg%d" % num) for num in range(1, 3) ]
+        emails[0].vote(1, u"userid")
+        emails[1].vote(-1, u"userid")
+        thread_id = emails[0].thread_id
+        self.assertEqual(self.store.get_vote_counters(), {
+            b"list:example-list:email:msg1:likes": 1,
+            b"list:example-list:email:msg1:dislikes": 0,
+            b"list:example-list:email:msg2:likes": 0,
+            b"list:example-list:email:msg2:dislikes": 1,
+            str("list:example-list:thread:%s:likes" % thread_id): 1,
+            str("list:example-list:thread:%s:dislikes" % thread_id): 1,
+            b"user:userid:list:example-list:likes": 1,
+            b"user:userid:list:example-list:dislikes": 1,
+            })
+
     #def test_non_ascii_headers(self):
     #    """add_to_list must handle non-ascii headers"""
     #    mbox = mailbox.mbox(get_test_file("non-ascii-headers.txt"))
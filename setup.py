@@ -53,6 +53,10 @@ setup(
             'kittystore-updatedb = kittystore.scripts:updatedb',
             'kittystore-download21 = kittystore.scripts:dl_archives',
             'kittystore-sync-mailman = kittystore.scripts:sync_mailman_cmd',
+            'kittystore-search-benchmark = kittystore.scripts:search_benchmark',
+            'kittystore-rebuild-activity = kittystore.scripts:rebuild_activity_cmd',
+            'kittystore-reconcile-counters = kittystore.scripts:reconcile_counters_cmd',
+            'kittystore-outbox-consumer = kittystore.scripts:outbox_consumer_cmd',
             ],
         },
     )